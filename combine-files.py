@@ -28,11 +28,20 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import argparse
 import sys
 import re
+import tempfile
+import zipfile
 from pathlib import Path
 
 
+parser = argparse.ArgumentParser(description="Combine all cheribuild modules into a single script that is printed to"
+                                             " stdout")
+parser.add_argument("--zipapp", metavar="OUTPUT", type=Path,
+                    help="Write a python zip application (containing the script and its bytecode) to OUTPUT instead")
+args = parser.parse_args()
+
 scriptDir = Path(__file__).resolve().parent / "pycheribuild"  # type: Path
 
 imports = []
@@ -99,6 +108,36 @@ def addFilteredFile(p: Path):
         for line in f.readlines():
             handleLine(line, p)
 
+def writeZipapp(source: str, output: Path):
+    """
+    Write the combined script (with all files/ resources already inlined by includeLocalFile) as a zipapp. It also
+    contains unchecked hash-based bytecode (Python >= 3.7) that is used when the remote python3 has the same version
+    as the one running this script, so the script doesn't have to be compiled on every run. The archive contents
+    only depend on the input so the hash of the archive can be used to cache it (see remote-cheribuild.py).
+    """
+    entries = [("__main__.py", b"import cheribuild\ncheribuild.main()\n"), ("cheribuild.py", source.encode("utf-8"))]
+    if sys.version_info >= (3, 7):
+        import py_compile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = Path(tmpdir, "cheribuild.py")
+            with src.open("wb") as f:
+                f.write(source.encode("utf-8"))
+            pyc = Path(tmpdir, "cheribuild.pyc")
+            py_compile.compile(str(src), cfile=str(pyc), dfile="cheribuild.py", doraise=True,
+                               invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+            with pyc.open("rb") as f:
+                entries.append(("cheribuild.pyc", f.read()))
+    with output.open("wb") as f:
+        f.write(b"#!/usr/bin/env python3\n")
+        with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            for name, data in entries:
+                info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                z.writestr(info, data)
+    output.chmod(0o755)
+
+
 def checkAllFilesUsed(directory: Path):
     for p in directory.iterdir():
         if not p.is_file():
@@ -111,13 +150,27 @@ def checkAllFilesUsed(directory: Path):
 
 # append all the individual files in the right order
 addFilteredFile(scriptDir / "colour.py")
+addFilteredFile(scriptDir / "probecache.py")
+addFilteredFile(scriptDir / "resourceusage.py")
+addFilteredFile(scriptDir / "tracing.py")
 addFilteredFile(scriptDir / "utils.py")
 addFilteredFile(scriptDir / "mtree.py")
 addFilteredFile(scriptDir / "config/loader.py")
 addFilteredFile(scriptDir / "config/chericonfig.py")
 addFilteredFile(scriptDir / "config/defaultconfig.py")
+addFilteredFile(scriptDir / "jobserver.py")
+addFilteredFile(scriptDir / "memoryadmission.py")
+addFilteredFile(scriptDir / "outputfilter.py")
+addFilteredFile(scriptDir / "processrunner.py")
+addFilteredFile(scriptDir / "dashboard.py")
+addFilteredFile(scriptDir / "systemdeps.py")
+addFilteredFile(scriptDir / "buildlog.py")
+addFilteredFile(scriptDir / "buildstate.py")
+addFilteredFile(scriptDir / "telemetry.py")
 addFilteredFile(scriptDir / "targets.py")
+addFilteredFile(scriptDir / "remoteworkers.py")
 addFilteredFile(scriptDir / "filesystemutils.py")
+addFilteredFile(scriptDir / "targetmanifest.py")
 addFilteredFile(scriptDir / "projects/project.py")
 
 # for now keep the original order
@@ -184,4 +237,7 @@ fullFile = ("#!/usr/bin/env python3\n" +
             "".join(fromImports) +
             "\n# See https://ctsrd-trac.cl.cam.ac.uk/projects/cheri/wiki/QemuCheri\n" +
             "".join(lines))
-print(fullFile)
+if args.zipapp:
+    writeZipapp(fullFile, args.zipapp)
+else:
+    print(fullFile)
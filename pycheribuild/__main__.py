@@ -32,6 +32,7 @@ import shlex
 import shutil
 import subprocess
 import sys
+import time
 from pathlib import Path
 
 # First thing we need to do is set up the config loader (before importing anything else!)
@@ -41,11 +42,11 @@ from .config.loader import JsonAndCommandLineConfigLoader, JsonAndCommandLineCon
 from .config.defaultconfig import DefaultCheriConfig, CheribuildAction
 from .utils import *
 from .targets import targetManager
+from .buildlog import print_log_errors
+from .telemetry import print_build_report
+from .tracing import finish_tracing, start_tracing
+from .targetmanifest import complete_from_target_manifest, import_project_modules, save_target_manifest
 from .projects.project import SimpleProject
-# noinspection PyUnresolvedReferences
-from .projects import *  # make sure all projects are loaded so that targetManager gets populated
-# noinspection PyUnresolvedReferences
-from .projects.cross import *  # make sure all projects are loaded so that targetManager gets populated
 
 
 def updateCheck():
@@ -72,6 +73,11 @@ def updateCheck():
 
 
 def real_main():
+    # Answer tab completion requests from the target manifest if possible (building the full parser is slow)
+    if "_ARGCOMPLETE" in os.environ and complete_from_target_manifest(__package__):  # no-combine
+        sys.exit(0)  # no-combine
+    # Only import the projects that are needed for this command line (see TargetManifest)
+    import_project_modules(__package__, sys.argv[1:])  # no-combine
     allTargetNames = list(sorted(targetManager.targetNames))
     runEverythingTarget = "__run_everything__"
     configLoader = JsonAndCommandLineConfigLoader()
@@ -79,9 +85,14 @@ def real_main():
     cheriConfig = DefaultCheriConfig(configLoader, allTargetNames + [runEverythingTarget])
     SimpleProject._configLoader = configLoader
     targetManager.registerCommandLineOptions()
+    save_target_manifest(configLoader)  # no-combine
     # load them from JSON/cmd line
+    config_load_start = time.monotonic()
     cheriConfig.load()
     setCheriConfig(cheriConfig)
+    if cheriConfig.trace_file:
+        tracer = start_tracing(cheriConfig.trace_file.absolute())
+        tracer.complete("load configuration", "config", config_load_start)
 
     if cheriConfig.docker or JsonAndCommandLineConfigLoader.get_config_prefix() == "docker-":
         # check that the docker build won't override native binaries
@@ -103,6 +114,15 @@ def real_main():
     elif CheribuildAction.DUMP_CONFIGURATION in cheriConfig.action:
         print(cheriConfig.getOptionsJSON())
         sys.exit()
+    elif CheribuildAction.BUILD_REPORT in cheriConfig.action:
+        print_build_report(cheriConfig)
+        sys.exit()
+    elif cheriConfig.show_log_errors:
+        if cheriConfig.show_log_errors not in targetManager.targetNames:
+            fatalError("Unknown target", cheriConfig.show_log_errors)
+        print_log_errors(cheriConfig.show_log_errors,
+                         targetManager.build_directories(cheriConfig.show_log_errors, cheriConfig))
+        sys.exit()
     elif cheriConfig.getConfigOption:
         if cheriConfig.getConfigOption not in configLoader.options:
             fatalError("Unknown config key", cheriConfig.getConfigOption)
@@ -111,7 +131,16 @@ def real_main():
         print(option.__get__(cheriConfig, option._owningClass if option._owningClass else cheriConfig))
         sys.exit()
 
-    assert any(x in cheriConfig.action for x in (CheribuildAction.TEST, CheribuildAction.PRINT_CHOSEN_TARGETS, CheribuildAction.BUILD))
+    if cheriConfig.what_rebuilds:
+        affected = targetManager.what_rebuilds(cheriConfig.what_rebuilds, cheriConfig)
+        statusUpdate("Changing", cheriConfig.what_rebuilds, "requires rebuilding", len(affected), "targets:")
+        print(" ", " ".join(t.name for t in affected))
+        if not cheriConfig.rebuild_affected:
+            sys.exit()
+        cheriConfig.targets = [t.name for t in affected]
+
+    assert any(x in cheriConfig.action for x in (CheribuildAction.TEST, CheribuildAction.PRINT_CHOSEN_TARGETS,
+                                                 CheribuildAction.BUILD, CheribuildAction.ESTIMATE))
 
     # create the required directories
     for d in (cheriConfig.sourceRoot, cheriConfig.outputRoot, cheriConfig.buildRoot):
@@ -195,6 +224,8 @@ def real_main():
     if CheribuildAction.PRINT_CHOSEN_TARGETS in cheriConfig.action:
         for target in targetManager.get_all_chosen_targets(cheriConfig):
             print("Would run", target)
+    if CheribuildAction.ESTIMATE in cheriConfig.action:
+        targetManager.estimate(cheriConfig)
     if CheribuildAction.BUILD in cheriConfig.action:
         targetManager.run(cheriConfig)
     if CheribuildAction.TEST in cheriConfig.action:
@@ -211,6 +242,10 @@ def main():
         cwd = (". Working directory was ", err.cwd) if hasattr(err, "cwd") else ()
         fatalError("Command ", "`" + commandline_to_str(err.cmd) + "` failed with non-zero exit code ",
                    err.returncode, *cwd, fatalWhenPretending=True, sep="")
+    finally:
+        trace_file = finish_tracing()
+        if trace_file:
+            statusUpdate("Wrote trace of this run to", trace_file)
 
 
 if __name__ == "__main__":
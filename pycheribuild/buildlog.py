@@ -0,0 +1,310 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import bisect
+import gzip
+import json
+import os
+import re
+import zlib
+from pathlib import Path
+
+from .utils import typing, statusUpdate, warningMessage
+
+# Lines that are recorded in the index. The patterns are matched against the whole chunk of output using re.MULTILINE
+# so that we don't have to split the output into lines in python.
+_INDEX_PATTERNS = (
+    ("phase", re.compile(rb"^>>> .*$", re.MULTILINE)),
+    ("error", re.compile(rb"^.*(?:\berror:|\bError \d+|^\*\*\* |\bFAILED:|undefined reference to|Error code \d+).*$",
+                         re.MULTILINE)),
+    ("warning", re.compile(rb"^.*\bwarning:.*$", re.MULTILINE)),
+)
+
+
+def _uncompressed_size(path: Path) -> int:
+    with gzip.open(str(path), "rb") as f:
+        return sum(len(chunk) for chunk in iter(lambda: f.read(1024 * 1024), b""))
+
+
+def index_path(logfile: Path) -> Path:
+    return logfile.with_name(logfile.name + ".index.json")
+
+
+class BuildLogWriter(object):
+    """
+    A file-like object for build logs that records the offsets of errors, warnings and phase markers ('>>> ' lines)
+    in a sidecar index (<logfile>.index.json) so that they can be found without scanning the whole log.
+
+    Compressed logs are written as a sequence of independent gzip members (which zcat/zless treat as a single file).
+    The index stores the compressed offset of every member so that a reader only has to decompress the member that
+    contains the line it is interested in.
+    """
+    member_size = 4 * 1024 * 1024  # uncompressed bytes per gzip member
+    max_entries = 1000  # per kind, to keep the index small for builds with lots of warnings
+    max_line_length = 400
+
+    def __init__(self, path: Path, compress: bool, append: bool=False):
+        self.path = path
+        self.name = str(path)
+        self.compress = compress
+        self._index = BuildLogIndex.load(path) if append else None
+        if self._index is None or self._index.compressed != compress:
+            self._index = BuildLogIndex(path, compress)
+            if append and path.exists():
+                # a log without a (valid) index: entries will only be recorded for the newly appended output
+                self._index.size = _uncompressed_size(path) if compress else path.stat().st_size
+        self._file = path.open("ab" if append else "wb")
+        self._compressor = None  # type: typing.Optional[zlib.compressobj]
+        self._member_start = None  # type: typing.Optional[int]
+        self._scan_buffer = b""  # incomplete last line of the output
+        self._counts = dict((kind, len(self._index.entries_of_kind(kind))) for kind, _ in _INDEX_PATTERNS)
+        self._external_output = False  # whether a child process may have written to the file descriptor
+
+    def fileno(self) -> int:
+        """
+        :return: the file descriptor of an uncompressed log so that a child process can write to it directly.
+        Output written this way is added to the index by the next write() or close() (scanning the file once).
+        """
+        assert not self.compress, "Compressed logs must be written using write()"
+        self.flush()
+        self._external_output = True
+        return self._file.fileno()
+
+    def _scan_external_output(self):
+        self._external_output = False
+        with self.path.open("rb") as f:
+            f.seek(self._index.size)
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                self._scan(chunk)
+                self._index.size += len(chunk)
+
+    def write(self, data: bytes) -> int:
+        if not data:
+            return 0
+        if self._external_output:
+            self._scan_external_output()
+        if self.compress:
+            if self._compressor is None or self._index.size - self._member_start >= self.member_size:
+                self._start_member()
+            self._file.write(self._compressor.compress(data))
+        else:
+            self._file.write(data)
+        self._scan(data)
+        self._index.size += len(data)
+        return len(data)
+
+    def _start_member(self):
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush())
+        self._file.flush()
+        # wbits=31 -> gzip header and trailer
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self._member_start = self._index.size
+        self._index.members.append([self._file.tell(), self._index.size])
+
+    def _scan(self, data: bytes):
+        end = data.rfind(b"\n")
+        if end < 0:
+            self._scan_buffer += data
+            return
+        start_offset = self._index.size - len(self._scan_buffer)
+        chunk = self._scan_buffer + data[:end + 1]
+        self._scan_buffer = data[end + 1:]
+        matches = []
+        for kind, pattern in _INDEX_PATTERNS:
+            for m in pattern.finditer(chunk):
+                matches.append((m.start(), kind, m.group(0)))
+        if not matches:
+            self._index.lines += chunk.count(b"\n")
+            return
+        # every line is only recorded once (e.g. a phase marker line that mentions 'error:' is a phase marker)
+        seen = set()
+        position = 0
+        for start, kind, text in sorted(matches, key=lambda m: m[0]):
+            if start in seen:
+                continue
+            seen.add(start)
+            self._index.lines += chunk.count(b"\n", position, start)
+            position = start
+            if self._counts[kind] < self.max_entries:
+                self._index.entries.append({"kind": kind, "offset": start_offset + start, "line": self._index.lines + 1,
+                                            "text": text[:self.max_line_length].decode("utf-8", errors="replace")})
+            self._counts[kind] += 1
+        self._index.lines += chunk.count(b"\n", position)
+
+    def flush(self):
+        if self._compressor is not None:
+            # Make everything written so far readable (e.g. for tail -f | zcat) without ending the member
+            self._file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._external_output:
+            self._scan_external_output()
+        if self._scan_buffer:
+            self._scan(b"\n")  # make sure the incomplete last line is also scanned
+            self._index.lines -= 1  # but don't count the newline that was added
+        if self._compressor is not None:
+            self._file.write(self._compressor.flush())
+        self._file.close()
+        self._index.counts = self._counts
+        self._index.file_size = self.path.stat().st_size
+        self._index.save()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BuildLogIndex(object):
+    def __init__(self, logfile: Path, compressed: bool):
+        self.logfile = logfile
+        self.compressed = compressed
+        self.size = 0  # uncompressed size
+        self.file_size = 0
+        self.lines = 0
+        self.members = []  # type: typing.List[typing.List[int]] # [compressed offset, uncompressed offset]
+        self.entries = []  # type: typing.List[dict]
+        self.counts = dict()  # type: typing.Dict[str, int]
+
+    @classmethod
+    def load(cls, logfile: Path) -> "typing.Optional[BuildLogIndex]":
+        try:
+            with index_path(logfile).open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            result = cls(logfile, bool(data["compressed"]))
+            result.size = data["size"]
+            result.file_size = data["file_size"]
+            result.lines = data["lines"]
+            result.members = data["members"]
+            result.entries = data["entries"]
+            result.counts = data.get("counts", {})
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            warningMessage("Ignoring corrupt log index for", logfile, "-", e)
+            return None
+        # the index is only valid if the log has not been modified since
+        if not logfile.exists() or logfile.stat().st_size != result.file_size:
+            return None
+        return result
+
+    def save(self):
+        data = {"compressed": self.compressed, "size": self.size, "file_size": self.file_size, "lines": self.lines,
+                "members": self.members, "entries": self.entries, "counts": self.counts}
+        path = index_path(self.logfile)
+        tmp = path.with_name(path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+        os.replace(str(tmp), str(path))
+
+    def entries_of_kind(self, kind: str) -> "typing.List[dict]":
+        return [e for e in self.entries if e["kind"] == kind]
+
+    @property
+    def first_error(self) -> "typing.Optional[dict]":
+        return next((e for e in self.entries if e["kind"] == "error"), None)
+
+    def read(self, offset: int, length: int) -> bytes:
+        """:return: length bytes of the uncompressed log starting at offset (only reading the required members)"""
+        offset = max(0, offset)
+        with self.logfile.open("rb") as f:
+            if not self.compressed:
+                f.seek(offset)
+                return f.read(length)
+            if not self.members:
+                return b""
+            member = max(0, bisect.bisect_right([m[1] for m in self.members], offset) - 1)
+            f.seek(self.members[member][0])
+            position = self.members[member][1]
+            result = b""
+            decompressor = zlib.decompressobj(31)
+            while position + len(result) < offset + length:
+                data = f.read(64 * 1024)
+                if not data:
+                    break
+                while data:
+                    result += decompressor.decompress(data)
+                    if not decompressor.eof:
+                        break
+                    # the remaining data belongs to the next gzip member
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(31)
+            skip = offset - position
+            return result[skip:skip + length]
+
+    def context(self, entry: dict, lines_before=5, lines_after=15) -> "typing.List[str]":
+        """:return: the lines surrounding an index entry"""
+        before = self.read(entry["offset"] - 16 * 1024, min(entry["offset"], 16 * 1024))
+        after = self.read(entry["offset"], 64 * 1024)
+        result = before.splitlines()[-lines_before:] if lines_before else []
+        result += after.splitlines()[:lines_after + 1]
+        return [l.decode("utf-8", errors="replace") for l in result]
+
+
+def find_log_indexes(directory: Path) -> "typing.List[BuildLogIndex]":
+    """:return: the indexes of all logfiles in directory (most recently modified first)"""
+    result = []
+    for path in directory.glob("*.index.json"):
+        logfile = path.with_name(path.name[:-len(".index.json")])
+        index = BuildLogIndex.load(logfile)
+        if index is not None:
+            result.append(index)
+    return sorted(result, key=lambda i: index_path(i.logfile).stat().st_mtime, reverse=True)
+
+
+def print_log_errors(target: str, directories: "typing.List[Path]"):
+    """Print the first error (with some context) in the most recent build log of target that contains errors"""
+    indexes = [i for d in directories if d.is_dir() for i in find_log_indexes(d)]
+    if not indexes:
+        statusUpdate("No indexed build logs found for", target, "in", " ".join(map(str, directories)))
+        return
+    for index in indexes:
+        entry = index.first_error
+        if entry is None:
+            continue
+        phases = index.entries_of_kind("phase")
+        statusUpdate("First error in", index.logfile, "(line " + str(entry["line"]) + "):")
+        previous_phases = [p for p in phases if p["offset"] < entry["offset"]]
+        if previous_phases:
+            print("  during phase", previous_phases[-1]["text"])
+        for line in index.context(entry):
+            print("   ", line)
+        print("{} errors and {} warnings were recorded in {}".format(
+            index.counts.get("error", 0), index.counts.get("warning", 0), index.logfile.name))
+        return
+    statusUpdate("No errors found in the build logs of", target + ":", " ".join(i.logfile.name for i in indexes))
@@ -0,0 +1,357 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import copy
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from enum import Enum
+from pathlib import Path
+
+from .utils import typing, runCmd, warningMessage
+
+
+class PersistentJsonFile(object):
+    """
+    A JSON dictionary stored on disk that can be shared between threads and concurrent cheribuild invocations.
+    Updates are serialized using a lock file and written atomically (write to a temporary file and rename).
+    """
+    _thread_locks = dict()  # type: typing.Dict[Path, threading.RLock]
+    _thread_locks_guard = threading.Lock()
+
+    def __init__(self, path: Path):
+        self.path = path
+        with self._thread_locks_guard:
+            self._thread_lock = self._thread_locks.setdefault(path, threading.RLock())
+
+    def load(self) -> dict:
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                result = json.load(f)
+                return result if isinstance(result, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            warningMessage("Ignoring corrupt state file", self.path, "-", e)
+            return {}
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        :return: the current contents of the file. Any changes made to the dict will be saved on exit.
+        """
+        with self._thread_lock:
+            os.makedirs(str(self.path.parent), exist_ok=True)
+            with Path(str(self.path) + ".lock").open("w") as lockfile:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+                try:
+                    data = self.load()
+                    yield data
+                    self._write(data)
+                finally:
+                    fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+    def _write(self, data: dict):
+        fd, tmpname = tempfile.mkstemp(dir=str(self.path.parent), prefix=self.path.name + ".")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, sort_keys=True, indent=1, default=str)
+            os.replace(tmpname, str(self.path))
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+
+def _file_identity(path: Path) -> "typing.Optional[str]":
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return "{}:{}:{}".format(path, st.st_size, st.st_mtime_ns)
+
+
+def get_source_revision(source_dir: Path) -> "typing.Optional[str]":
+    if not (source_dir / ".git").exists():
+        return None
+    try:
+        head = runCmd("git", "rev-parse", "HEAD", cwd=source_dir, captureOutput=True, printVerboseOnly=True,
+                      runInPretendMode=True).stdout.decode("utf-8").strip()
+        # Include uncommitted changes to tracked files in the revision
+        diff = runCmd("git", "diff", "HEAD", "--no-ext-diff", "--ignore-submodules=dirty", cwd=source_dir,
+                      captureOutput=True, printVerboseOnly=True, runInPretendMode=True).stdout
+    except subprocess.CalledProcessError as e:
+        warningMessage("Could not determine git revision of", source_dir, "-", e)
+        return None
+    if diff:
+        head += "-dirty-" + hashlib.sha1(diff).hexdigest()
+    return head
+
+
+def _option_value_str(value) -> str:
+    if isinstance(value, Enum):
+        return value.name.lower()
+    return str(value)
+
+
+class BuildFingerprint(object):
+    """Everything that determines the output of a target: sources, options, toolchain and dependency outputs"""
+    def __init__(self, components: "typing.Dict[str, typing.Any]"):
+        self.components = components
+
+    @classmethod
+    def for_project(cls, project: "Project", dependencies: "typing.List[str]",
+                    state: "BuildStateDatabase") -> "BuildFingerprint":
+        config = project.config
+        options = dict()
+        prefix = project.target + "/"
+        # noinspection PyProtectedMember
+        for name, option in project._configLoader.options.items():
+            # noinspection PyProtectedMember
+            if name.startswith(prefix) and issubclass(project.__class__, option._owningClass or object):
+                options[name] = _option_value_str(option.__get__(project, project.__class__))
+        # global options that change the build output
+        for name in ("cheriBits", "crossCompileTarget", "mips_float_abi", "cheri_cap_table_abi", "crosscompile_linkage",
+                     "unified_sdk", "with_libstatcounters", "cross_target_suffix", "use_sdk_clang_for_native_xbuild"):
+            options["global:" + name] = _option_value_str(getattr(config, name, None))
+        toolchain = [_file_identity(p) for p in (config.clangPath, config.clangPlusPlusPath, config.sdkBinDir / "clang")]
+        return cls({
+            "source-revision": project.source_revision(),
+            "options": options,
+            "toolchain": toolchain,
+            "dependencies": dict((dep, state.digest(dep)) for dep in dependencies),
+        })
+
+    @property
+    def inputs_digest(self) -> str:
+        """Like digest but also returns a value if the source revision or a dependency digest is not known"""
+        return hashlib.sha256(json.dumps(self.components, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @property
+    def digest(self) -> "typing.Optional[str]":
+        if self.components.get("source-revision") is None:
+            return None  # can't tell whether the sources changed
+        if any(v is None for v in self.components["dependencies"].values()):
+            return None  # a dependency has not been recorded yet
+        return self.inputs_digest
+
+    def differences(self, previous: "typing.Optional[dict]") -> "typing.List[str]":
+        """:return: human readable reasons why this fingerprint does not match the previous one"""
+        if previous is None:
+            return ["target has not been built successfully before"]
+        result = []
+        if self.components["source-revision"] is None:
+            result.append("source directory is not a git repository")
+        elif self.components["source-revision"] != previous.get("source-revision"):
+            result.append("source revision changed from {} to {}".format(previous.get("source-revision"),
+                                                                           self.components["source-revision"]))
+        old_options = previous.get("options", {})
+        for k, v in sorted(self.components["options"].items()):
+            if old_options.get(k) != v:
+                result.append("option {} changed from {} to {}".format(k, old_options.get(k), v))
+        if self.components["toolchain"] != previous.get("toolchain"):
+            result.append("toolchain changed")
+        old_deps = previous.get("dependencies", {})
+        for k, v in sorted(self.components["dependencies"].items()):
+            if v is None:
+                result.append("dependency {} has no recorded build state".format(k))
+            elif old_deps.get(k) != v:
+                result.append("dependency {} was rebuilt".format(k))
+        return result
+
+
+class BuildStateDatabase(object):
+    """
+    Records the fingerprint of every successfully built target in $BUILD_ROOT/.cheribuild-state.json
+    """
+    def __init__(self, path: Path):
+        self.file = PersistentJsonFile(path)
+        self._targets = self.file.load().get("targets", {})  # type: typing.Dict[str, dict]
+
+    def digest(self, target: str) -> "typing.Optional[str]":
+        return self._targets.get(target, {}).get("digest")
+
+    def check(self, target: str, fingerprint: BuildFingerprint) -> "typing.List[str]":
+        """:return: an empty list if the target is up-to-date or the reasons why it must be rebuilt"""
+        previous = self._targets.get(target)
+        if previous is not None and fingerprint.digest is not None and previous.get("digest") == fingerprint.digest:
+            return []
+        reasons = fingerprint.differences(previous.get("components") if previous else None)
+        return reasons or ["build state could not be determined"]
+
+    def was_installed(self, target: str) -> bool:
+        """:return: False if the last successful build of target was run with --skip-install"""
+        return self._targets.get(target, {}).get("installed", True)
+
+    def record(self, target: str, fingerprint: BuildFingerprint, installed: bool=True):
+        entry = {"digest": fingerprint.digest, "components": fingerprint.components, "installed": installed}
+        with self.file.locked() as data:
+            data.setdefault("targets", {})[target] = entry
+            self._targets = data["targets"]
+
+    def forget(self, target: str):
+        with self.file.locked() as data:
+            data.setdefault("targets", {}).pop(target, None)
+            self._targets = data["targets"]
+
+
+_build_state_databases = dict()  # type: typing.Dict[Path, BuildStateDatabase]
+
+
+def get_build_state_database(config: "CheriConfig") -> BuildStateDatabase:
+    path = config.buildRoot / ".cheribuild-state.json"
+    if path not in _build_state_databases:
+        _build_state_databases[path] = BuildStateDatabase(path)
+    return _build_state_databases[path]
+
+
+class BuildTimingDatabase(object):
+    """
+    Records the duration of the last few successful builds of every target (and each phase of the build) in
+    $BUILD_ROOT/.cheribuild-timings.json so that the scheduler and --estimate can predict how long a target will take.
+    """
+    max_samples = 5
+
+    def __init__(self, path: Path):
+        self.file = PersistentJsonFile(path)
+        self._targets = self.file.load().get("targets", {})  # type: typing.Dict[str, dict]
+
+    def record(self, target: str, total: float, phases: "typing.Dict[str, float]", max_rss_kb: int=None):
+        values = [("total", total)] + [("phase:" + k, v) for k, v in phases.items()]
+        if max_rss_kb:
+            values.append(("max-rss-kb", max_rss_kb))
+        with self.file.locked() as data:
+            entry = data.setdefault("targets", {}).setdefault(target, {})
+            for key, value in values:
+                samples = entry.setdefault(key, [])
+                samples.append(round(value, 3))
+                del samples[:-self.max_samples]
+            self._targets = data["targets"]
+
+    def _median(self, target: str, key: str) -> "typing.Optional[float]":
+        samples = sorted(self._targets.get(target, {}).get(key, []))
+        if not samples:
+            return None
+        mid = len(samples) // 2
+        return samples[mid] if len(samples) % 2 else (samples[mid - 1] + samples[mid]) / 2
+
+    def estimate(self, target: str) -> "typing.Optional[float]":
+        """:return: the expected duration of building target in seconds or None if it has never been built"""
+        return self._median(target, "total")
+
+    def peak_memory_mb(self, target: str) -> int:
+        """:return: the largest resident set size of any process that was started by a recent build of target"""
+        return int(max(self._targets.get(target, {}).get("max-rss-kb", [0])) // 1024)
+
+    def phase_estimates(self, target: str) -> "typing.Dict[str, float]":
+        result = dict()
+        for key in self._targets.get(target, {}):
+            if key.startswith("phase:"):
+                result[key[len("phase:"):]] = self._median(target, key)
+        return result
+
+
+_build_timing_databases = dict()  # type: typing.Dict[Path, BuildTimingDatabase]
+
+
+def get_build_timing_database(config: "CheriConfig") -> BuildTimingDatabase:
+    path = config.buildRoot / ".cheribuild-timings.json"
+    if path not in _build_timing_databases:
+        _build_timing_databases[path] = BuildTimingDatabase(path)
+    return _build_timing_databases[path]
+
+
+class BuildCheckpoint(object):
+    """
+    Records which phases of which targets have completed in the current run in $BUILD_ROOT/.cheribuild-checkpoint.json
+    so that --resume can continue at the phase that failed. Every entry also stores a digest of the inputs of the
+    target (sources, options and compiler) and is ignored if they have changed since.
+    """
+    def __init__(self, path: Path):
+        self.file = PersistentJsonFile(path)
+        self._data = self.file.load()
+
+    def start_run(self, targets: "typing.List[str]", resume: bool):
+        with self.file.locked() as data:
+            if resume:
+                if not data.get("targets"):
+                    warningMessage("--resume passed but there is no checkpoint in", self.file.path)
+                elif data.get("targets") != targets:
+                    warningMessage("--resume passed but the targets differ from the previous run:",
+                                   " ".join(data.get("targets")))
+            else:
+                data.clear()
+            data["targets"] = targets
+            data.setdefault("phases", {})
+            data.setdefault("completed", {})
+            self._data = copy.deepcopy(data)
+
+    def _entry(self, target: str, inputs: str) -> dict:
+        entry = self._data.get("phases", {}).get(target)
+        if entry is None or entry.get("inputs") != inputs:
+            return {}
+        return entry
+
+    def completed_phases(self, target: str, inputs: str) -> "typing.List[str]":
+        return list(self._entry(target, inputs).get("completed", []))
+
+    def completed_inputs(self, target: str) -> "typing.Optional[str]":
+        """:return: the inputs that target was completed with in the checkpointed run (or None)"""
+        return self._data.get("completed", {}).get(target)
+
+    def is_target_completed(self, target: str, inputs: str) -> bool:
+        return self.completed_inputs(target) == inputs
+
+    def phase_completed(self, target: str, phase: str, inputs: str):
+        with self.file.locked() as data:
+            entry = data.setdefault("phases", {}).get(target)
+            if entry is None or entry.get("inputs") != inputs:
+                entry = data["phases"][target] = {"inputs": inputs, "completed": []}
+            if phase not in entry["completed"]:
+                entry["completed"].append(phase)
+            self._data = copy.deepcopy(data)
+
+    def target_completed(self, target: str, inputs: str):
+        with self.file.locked() as data:
+            data.setdefault("completed", {})[target] = inputs
+            self._data = copy.deepcopy(data)
+
+
+_build_checkpoints = dict()  # type: typing.Dict[Path, BuildCheckpoint]
+
+
+def get_build_checkpoint(config: "CheriConfig") -> BuildCheckpoint:
+    path = config.buildRoot / ".cheribuild-checkpoint.json"
+    if path not in _build_checkpoints:
+        _build_checkpoints[path] = BuildCheckpoint(path)
+    return _build_checkpoints[path]
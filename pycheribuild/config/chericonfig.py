@@ -36,7 +36,7 @@ from enum import Enum
 from collections import OrderedDict
 from pathlib import Path
 # Need to import loader here and not `from loader import ConfigLoader` because that copies the reference
-from .loader import ConfigLoaderBase
+from .loader import ConfigLoaderBase, ComputedDefaultValue, ConfigOptionBase
 from ..utils import latestClangTool, warningMessage
 
 
@@ -77,6 +77,7 @@ class MipsFloatAbi(Enum):
 
 class CheriConfig(object):
     def __init__(self, loader: ConfigLoaderBase, action_class):
+        self._option_attributes = OrderedDict()  # attribute name -> ConfigOptionBase
         loader._cheriConfig = self
         self.loader = loader
         self.pretend = loader.addCommandLineOnlyBoolOption("pretend", "p",
@@ -96,6 +97,30 @@ class CheriConfig(object):
                                                 action="append_const", const=action.actions)
         self.print_targets_only = loader.addBoolOption("print-targets-only", helpHidden=False, group=loader.actionGroup,
             help="Don't run the build but instead only print the targets that would be executed")
+        self.parallel_targets = loader.addOption("parallel-targets", type=int, default=1, metavar="N",
+            help="Build up to N independent targets concurrently. The --make-jobs budget is shared between all "
+                 "targets that are running at the same time")
+        self.use_jobserver = loader.addBoolOption("jobserver", default=ComputedDefaultValue(
+            function=lambda config, cls: config.parallel_targets > 1, asString="true if --parallel-targets > 1"),
+            help="Share a single pool of --make-jobs job slots between all make/bmake/ninja processes that are started "
+                 "by cheribuild (using the GNU make jobserver protocol)")
+        self.remote_workers = loader.addOption("remote-worker", type=list, default=[], action="append",
+            metavar="HOST[:DIR]", help="Build targets on the given host (using ssh and rsync) instead of locally. Can "
+                                       "be passed multiple times to distribute the build across several hosts.")
+        self.remote_worker_dir = loader.addOption("remote-worker-dir", type=str, default="cheribuild-worker",
+            metavar="DIR", help="Directory on the --remote-worker hosts that sources, build and output are stored in")
+        self.update_jobs = loader.addOption("update-jobs", type=int, default=ComputedDefaultValue(
+            function=lambda config, cls: 4 if config.parallel_targets > 1 else 1,
+            asString="4 if --parallel-targets > 1, otherwise 1"), metavar="N",
+            help="Update the sources of up to N targets concurrently while the first targets are being built (1 "
+                 "updates every target just before building it)")
+        self.memory_budget = loader.addOption("memory-budget", type=int, default=0, metavar="MiB",
+            help="With --parallel-targets, only start a memory intensive build phase if the estimated peak memory of "
+                 "all running phases stays below this limit and enough memory is free (default: 90%% of the "
+                 "available memory)")
+        self.trace_file = loader.addCommandLineOnlyOption("trace-file", type=Path, metavar="FILE",
+            help="Write a trace (Trace Event Format JSON) of the targets, build steps and commands that were run to "
+                 "FILE. It can be viewed with chrome://tracing or https://ui.perfetto.dev")
 
 
         self.clangPath = loader.addPathOption("clang-path",
@@ -132,6 +157,7 @@ class CheriConfig(object):
         self.clean = None  # type: bool
         self.force = None  # type: bool
         self.noLogfile = None  # type: bool
+        self.compress_logs = False  # type: bool
         self.skipUpdate = None  # type: bool
         self.skipConfigure = None  # type: bool
         self.forceConfigure = None  # type: bool
@@ -157,6 +183,14 @@ class CheriConfig(object):
         self.configureOnly = loader.addBoolOption("configure-only",
                                                   help="Only run the configure step (skip build and install)")
         self.skipInstall = loader.addBoolOption("skip-install", help="Skip the install step (only do the build)")
+        self.skip_unchanged = loader.addBoolOption("skip-unchanged",
+            help="Skip targets if the source revision, the target's configuration options, the compiler and the "
+                 "dependencies are the same as for the last successful build (state is stored in $BUILD_ROOT)")
+        self.explain_rebuild = loader.addBoolOption("explain-rebuild",
+            help="Print the reason why a target could not be skipped by --skip-unchanged")
+        self.resume = loader.addBoolOption("resume",
+            help="Continue the last run at the step that failed: Targets and build steps (update/configure/compile/"
+                 "install) that completed in that run are skipped unless their sources, options or compiler changed")
         self.skipSdk = loader.addBoolOption("skip-sdk", help="When building with --include-dependencies ignore the "
                                                              "CHERI sdk dependencies. Saves a lot of time when "
                                                              "building libc++, etc. with dependencies but the sdk "
@@ -231,7 +265,15 @@ class CheriConfig(object):
 
     @property
     def makeJFlag(self):
-        return "-j" + str(self.makeJobs)
+        return "-j" + str(self.makeJobsPerTarget)
+
+    @property
+    def makeJobsPerTarget(self) -> int:
+        # When building multiple targets concurrently each one only gets a share of the -j budget (this is only used
+        # for tools that can't use the jobserver)
+        if self.parallel_targets > 1:
+            return max(1, self.makeJobs // self.parallel_targets)
+        return self.makeJobs
 
     @property
     def cheriBitsStr(self):
@@ -251,7 +293,7 @@ class CheriConfig(object):
 
     def _ensureRequiredPropertiesSet(self) -> bool:
         for key in self.__dict__.keys():
-            if key in self.__optionalProperties:
+            if key in self.__optionalProperties or key in self._option_attributes:
                 continue
             # don't do the descriptor stuff:
             value = object.__getattribute__(self, key)
@@ -259,12 +301,31 @@ class CheriConfig(object):
                 raise RuntimeError("Required property " + key + " is not set!")
         return True
 
-    # FIXME: not sure why this is needed
-    def __getattribute__(self, item):
-        v = object.__getattribute__(self, item)
-        if hasattr(v, '__get__'):
-            return v.__get__(self, self.__class__)
-        return v
+    # Config options are stored in self._option_attributes instead of the instance dict. The first access to an option
+    # goes through __getattr__(), which loads the value and stores it in the instance dict so that all further accesses
+    # (e.g. config.verbose in every runCmd() call) are plain attribute lookups. Assigning a value (e.g. in load())
+    # overrides the option until the next reset_option_values().
+    def __setattr__(self, name, value):
+        if isinstance(value, ConfigOptionBase):
+            self.__dict__.pop(name, None)
+            self._option_attributes[name] = value
+        else:
+            object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        option = self.__dict__.get("_option_attributes", {}).get(name)
+        if option is None:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, name))
+        value = option.__get__(self, self.__class__)
+        self.__dict__[name] = value
+        return value
+
+    def reset_option_values(self):
+        """
+        Forget the loaded values (and values assigned to options) so that they are loaded again on next access
+        """
+        for name in self._option_attributes:
+            self.__dict__.pop(name, None)
 
     def getOptionsJSON(self):
         jsonDict = OrderedDict()
@@ -43,6 +43,9 @@ class CheribuildAction(Enum):
                       ["build", "test"])
     LIST_TARGETS = ("--list-targets", "List all available targets and exit")
     PRINT_CHOSEN_TARGETS = ("--print-chosen-targets", "List all the targets that would be built")
+    BUILD_REPORT = ("--build-report", "Summarise the recorded telemetry of the last builds (see --build-report-runs)."
+                                      " Only the newest records are kept once the telemetry file exceeds 8 MiB")
+    ESTIMATE = ("--estimate", "Predict the wall-clock time for building the chosen targets based on previous builds")
     DUMP_CONFIGURATION = ("--dump-configuration", "Print the current configuration as JSON. This can be saved to "
                                                   "~/.config/cheribuild.json to make it persistent")
 
@@ -63,12 +66,22 @@ class DefaultCheriConfig(CheriConfig):
         # The run mode:
         self.getConfigOption = loader.addOption("get-config-option", type=str, metavar="KEY", group=loader.actionGroup,
                                                 help="Print the value of config option KEY and exit")
+        self.what_rebuilds = loader.addOption("what-rebuilds", type=str, metavar="TARGET|PATH", group=loader.actionGroup,
+                                              help="Print the targets that need to be rebuilt after changing the "
+                                                   "sources of TARGET (or the target that contains PATH) and exit")
+        self.rebuild_affected = loader.addBoolOption("rebuild-affected", group=loader.actionGroup,
+                                                     help="Build the targets printed by --what-rebuilds instead of "
+                                                          "exiting")
+        self.show_log_errors = loader.addOption("show-log-errors", type=str, metavar="TARGET", group=loader.actionGroup,
+                                                help="Print the first error in the build logs of TARGET (using the "
+                                                     "index that is written alongside every logfile) and exit")
         # boolean flags
         self.quiet = loader.addBoolOption("quiet", "q", help="Don't show stdout of the commands that are executed")
         self.verbose = loader.addBoolOption("verbose", "v", help="Print all commmands that are executed")
         self.clean = loader.addBoolOption("clean", "c", help="Remove the build directory before build")
         self.force = loader.addBoolOption("force", "f", help="Don't prompt for user input but use the default action")
         self.noLogfile = loader.addBoolOption("no-logfile", help="Don't write a logfile for the build steps")
+        self.compress_logs = loader.addBoolOption("compress-logs", help="Write gzip compressed logfiles (*.log.gz)")
         self.skipUpdate = loader.addBoolOption("skip-update", help="Skip the git pull step")
         self.force_update = loader.addBoolOption("force-update", help="Always update (with autostash) even if there "
                                                                       "are uncommitted changes")
@@ -108,6 +121,9 @@ class DefaultCheriConfig(CheriConfig):
                                                         help="Make cross compile projects target the host system and "
                                                              "use cheri clang to compile (tests that we didn't break x86)")
 
+        self.build_report_runs = loader.addOption("build-report-runs", type=int, default=20, metavar="N",
+                                                  help="Number of cheribuild invocations to include in --build-report")
+
         self.makeWithoutNice = loader.addBoolOption("make-without-nice", help="Run make/ninja without nice(1)")
 
         self.makeJobs = loader.addOption("make-jobs", "j", type=int, default=defaultNumberOfMakeJobs(),
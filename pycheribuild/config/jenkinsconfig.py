@@ -220,8 +220,7 @@ class JenkinsConfig(CheriConfig):
         assert self._ensureRequiredPropertiesSet()
         if os.getenv("DEBUG") is not None:
             import pprint
-            for k, v in self.__dict__.items():
-                if hasattr(v, "__get__"):
-                    setattr(self, k, v.__get__(self, self.__class__))
+            for k in self._option_attributes:
+                getattr(self, k)  # load all options so that they are included in vars(self)
 
             pprint.pprint(vars(self))
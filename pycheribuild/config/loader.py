@@ -28,11 +28,13 @@
 # SUCH DAMAGE.
 #
 import argparse
+import hashlib
 import json
 import os
 import shlex
 import shutil
 import sys
+import tempfile
 import collections.abc
 
 try:
@@ -104,6 +106,8 @@ class ConfigLoaderBase(object):
     _cheriConfig = None  # type: CheriConfig
 
     options = dict()  # type: typing.Dict[str, ConfigOptionBase]
+    # Options of targets that will only be imported if needed (they are valid keys in the JSON config file)
+    lazy_option_names = frozenset()  # type: typing.AbstractSet[str]
     _parsedArgs = None
     _JSON = {}  # type: dict
 
@@ -184,13 +188,19 @@ class ConfigLoaderBase(object):
 
     def reset(self):
         for option in self.options.values():
-            option._cached = None
+            option._cached = _NOT_LOADED
+        if self._cheriConfig is not None:
+            self._cheriConfig.reset_option_values()
 
     @property
     def targets(self) -> "typing.List[str]":
         return self._parsedArgs.targets
 
 
+# Marker for options that have not been loaded yet (None is a valid option value)
+_NOT_LOADED = object()
+
+
 class ConfigOptionBase(object):
     def __init__(self, name: str, shortname: str, default, valueType: "typing.Type", _owningClass=None,
                  _loader: ConfigLoaderBase=None, _fallback_name: str=None):
@@ -214,7 +224,7 @@ class ConfigOptionBase(object):
                     self.default_str = default.name.lower()
             else:
                 self.default_str = str(default)
-        self._cached = None
+        self._cached = _NOT_LOADED
         self._loader = _loader
         self._owningClass = _owningClass  # if none it means the global CheriConfig is the class containing this option
         self._fallback_name = _fallback_name  # for targets such as gdb-mips, etc
@@ -255,7 +265,7 @@ class ConfigOptionBase(object):
         # if instance is None:
         #     return self
         assert not self._owningClass or issubclass(owner, self._owningClass)
-        if self._cached is None:
+        if self._cached is _NOT_LOADED:
             # noinspection PyProtectedMember
             # allow getting the value when used on a class as well:
             if instance is None:
@@ -358,8 +368,9 @@ class CommandLineConfigOption(ConfigOptionBase):
     def loadFromCommandLine(self):
         assert self._loader._parsedArgs  # load() must have been called before using this object
         # FIXME: check the fallback name here
-        assert hasattr(self._loader._parsedArgs, self.action.dest)
-        return getattr(self._loader._parsedArgs, self.action.dest)  # from command line
+        # Options of targets that were imported after parsing the command line (see TargetManifest) are not in
+        # _parsedArgs but they can't have been passed on the command line either.
+        return getattr(self._loader._parsedArgs, self.action.dest, None)  # from command line
 
 
 # noinspection PyProtectedMember
@@ -386,17 +397,8 @@ class JsonAndCommandLineConfigOption(CommandLineConfigOption):
         return None  # not found -> fall back to default
 
     def _lookupKeyInJson(self, fullOptionName: str):
-        if fullOptionName in self._loader._JSON:
-            return self._loader._JSON[fullOptionName]
-        # if there are any / characters treat these as an object reference
-        jsonPath = fullOptionName.split(sep="/")
-        jsonKey = jsonPath[-1]  # last item is the key (e.g. llvm/build-type -> build-type)
-        jsonPath = jsonPath[:-1]  # all but the last item is the path (e.g. llvm/build-type -> llvm)
-        jsonObject = self._loader._JSON
-        for objRef in jsonPath:
-            # Return an empty dict if it is not found
-            jsonObject = jsonObject.get(objRef, {})
-        return jsonObject.get(jsonKey, None)
+        # The JSON config has already been flattened (e.g. {"llvm": {"build-type": x}} -> {"llvm/build-type": x})
+        return self._loader._JSON.get(fullOptionName, None)
 
     def _loadFromJson(self, fullOptionName: str) -> "typing.Tuple[typing.Optional[typing.Any], typing.Optional[str]]":
         result = self._lookupKeyInJson(fullOptionName)
@@ -441,6 +443,84 @@ class DefaultValueOnlyConfigLoader(ConfigLoaderBase):
         pass
 
 
+def flatten_json_config(config: dict, prefix: str="") -> "typing.Dict[str, typing.Any]":
+    """
+    Convert nested objects to option names: {"llvm": {"build-type": x}} -> {"llvm/build-type": x}.
+    Keys that already contain the full option name ({"llvm/build-type": y}) take precedence over nested objects.
+    """
+    result = dict()
+    for key, value in config.items():
+        if isinstance(value, dict):
+            result.update(flatten_json_config(value, prefix + key + "/"))
+    for key, value in config.items():
+        if not isinstance(value, dict) and prefix + key != "#include":
+            result[prefix + key] = value
+    return result
+
+
+def _default_config_cache_dir() -> "typing.Optional[Path]":
+    path = os.getenv("CHERIBUILD_CONFIG_CACHE")
+    if path is None:
+        cache_home = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        return Path(cache_home, "cheribuild", "config")
+    return Path(path) if path else None
+
+
+class FlattenedConfigCache(object):
+    """
+    Stores the flattened JSON config (including all #include files) so that the next invocation only has to hash
+    the config files instead of parsing and merging them. The entries are keyed by the path of the main config file
+    and are only used if the SHA256 of every file that was read is unchanged.
+    Set $CHERIBUILD_CONFIG_CACHE to another directory (or an empty string to disable the cache).
+    """
+    def __init__(self, directory: "typing.Optional[Path]"):
+        self.directory = directory
+
+    @staticmethod
+    def file_digest(path: Path) -> "typing.Optional[str]":
+        try:
+            with path.open("rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def _cache_file(self, config_path: Path) -> Path:
+        return self.directory / (hashlib.sha1(str(config_path).encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, config_path: Path) -> "typing.Optional[typing.Dict[str, typing.Any]]":
+        if self.directory is None:
+            return None
+        try:
+            with self._cache_file(config_path).open("r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("config") != str(config_path) or not entry.get("files"):
+            return None
+        for path, digest in entry["files"]:
+            if digest is None or self.file_digest(Path(path)) != digest:
+                return None
+        return entry["values"]
+
+    def put(self, config_path: Path, files: "typing.List[typing.Tuple[str, typing.Optional[str]]]",
+            values: "typing.Dict[str, typing.Any]") -> None:
+        if self.directory is None or any(digest is None for path, digest in files):
+            return  # don't cache config files that could not be parsed
+        try:
+            os.makedirs(str(self.directory), exist_ok=True)
+            # write atomically since concurrent cheribuild invocations may use the same config file
+            fd, tmpname = tempfile.mkstemp(dir=str(self.directory), prefix="config.")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump({"config": str(config_path), "files": files, "values": values}, f)
+                os.replace(tmpname, str(self._cache_file(config_path)))
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+        except OSError:
+            pass  # e.g. read-only home directory -> parse the config file again next time
+
+
 # https://stackoverflow.com/a/14902564/894271
 def dict_raise_on_duplicates(ordered_pairs):
     """Reject duplicate keys."""
@@ -474,6 +554,7 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
         self.crossCompileGroup = self._parser.add_mutually_exclusive_group()
         self.configureGroup = self._parser.add_mutually_exclusive_group()
         self.completion_excludes = []
+        self.config_cache = FlattenedConfigCache(_default_config_cache_dir())
 
     @staticmethod
     def get_config_prefix():
@@ -503,37 +584,41 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
                                                  help=argparse.SUPPRESS, choices=availableTargets)
             unparsed.completer = targetCompleter
 
-    def __load_json_with_comments(self, config_path: Path) -> "typing.Dict[str, typing.Any]":
+    def __load_json_with_comments(self, config_path: Path, files: list) -> "typing.Dict[str, typing.Any]":
         """
         Loads a JSON file ignoring any lines that start with '#' or '//'
         :param config_path: path to the json file
+        :param files: (path, sha256) of the parsed file will be appended to this list
         :return: a parsed json dict
         """
-        with config_path.open("r", encoding="utf-8") as f:
-            json_lines = []
-            for line in f.readlines():
-                stripped = line.strip()
-                if not stripped.startswith("#") and not stripped.startswith("//"):
-                    json_lines.append(line)
-            # print("".join(jsonLines))
-            result = json.loads("".join(json_lines), object_pairs_hook=dict_raise_on_duplicates, encoding="utf-8")
-            if self._parsedArgs and self._parsedArgs.verbose is True:
-                print("Parsed", config_path, "as", coloured(AnsiColour.cyan, json.dumps(result)))
-            return result
+        with config_path.open("rb") as f:
+            contents = f.read()
+        json_lines = []
+        for line in contents.decode("utf-8").splitlines(keepends=True):
+            stripped = line.strip()
+            if not stripped.startswith("#") and not stripped.startswith("//"):
+                json_lines.append(line)
+        # print("".join(jsonLines))
+        result = json.loads("".join(json_lines), object_pairs_hook=dict_raise_on_duplicates)
+        files.append((str(config_path), hashlib.sha256(contents).hexdigest()))
+        if self._parsedArgs and self._parsedArgs.verbose is True:
+            print("Parsed", config_path, "as", coloured(AnsiColour.cyan, json.dumps(result)))
+        return result
 
-    def __load_json_with_includes(self, config_path: Path):
+    def __load_json_with_includes(self, config_path: Path, files: list):
         result = dict()
         try:
-            result = self.__load_json_with_comments(config_path)
+            result = self.__load_json_with_comments(config_path, files)
         except Exception as e:
             print(coloured(AnsiColour.red, "Could not load config file", config_path, "-", e), file=sys.stderr)
             if not sys.__stdin__.isatty() or not input("Invalid config file " + str(config_path) +
                                                        ". Continue? y/[N]").lower().startswith("y"):
                 raise
+            files.append((str(config_path), None))  # never cache the result
         include_value = result.get("#include")
         if include_value:
             included_path = config_path.parent / include_value
-            base_json = self.__load_json_with_includes(included_path)
+            base_json = self.__load_json_with_includes(included_path, files)
             base_json.update(result)
             result = base_json
             if self._parsedArgs and self._parsedArgs.verbose is True:
@@ -547,7 +632,11 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
         if not self._configPath:
             self._configPath = Path(os.path.expanduser(self._parsedArgs.config_file)).absolute()
         if self._configPath.exists():
-            self._JSON = self.__load_json_with_includes(self._configPath)
+            self._JSON = self.config_cache.get(self._configPath)
+            if self._JSON is None:
+                files = []  # type: typing.List[typing.Tuple[str, typing.Optional[str]]]
+                self._JSON = flatten_json_config(self.__load_json_with_includes(self._configPath, files))
+                self.config_cache.put(self._configPath, files, self._JSON)
         else:
             print(coloured(AnsiColour.green, "Configuration file", self._configPath,
                            "does not exist, using only command line arguments."), file=sys.stderr)
@@ -567,17 +656,8 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
         # Now validate the config file
         self._validateConfigFile()
 
-    def __validate(self, prefix: str, key: str, value) -> bool:
-        fullname = prefix + key
-        if isinstance(value, dict):
-            for k, v in value.items():
-                self.__validate(fullname + "/", k, v)
-            return True
-
-        if fullname == "#include":
-            return True
-
-        if fullname in self.options:
+    def __validate(self, fullname: str) -> bool:
+        if fullname in self.options or fullname in self.lazy_option_names:
             return True
         # see if it is one of the alternate names is valid
         for option in self.options.values():
@@ -591,8 +671,8 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
         return False
 
     def _validateConfigFile(self):
-        for k, v in self._JSON.items():
-            self.__validate("", k, v)
+        for k in self._JSON.keys():
+            self.__validate(k)
 
     def reset(self) -> None:
         super().reset()
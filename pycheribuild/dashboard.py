@@ -0,0 +1,359 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import re
+import shutil
+import sys
+import threading
+import time
+
+from .outputfilter import LineAction, OutputFilter
+from .utils import typing
+
+# ninja prints "[123/4567] Building CXX object ..." and the CMake generated makefiles "[ 42%] Building ..."
+_NINJA_PROGRESS = re.compile(rb"^\[(\d+)/(\d+)\] ")
+_PERCENT_PROGRESS = re.compile(rb"^\[\s*(\d+)%\] ")
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(max(0, seconds))
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+
+
+class TargetProgress(object):
+    """The state of one running target that is shown in its row of the dashboard"""
+    def __init__(self, name: str, estimate: "typing.Optional[float]", clock: "typing.Callable[[], float]"):
+        self.name = name
+        self.estimate = estimate  # from the timings of previous builds
+        self.clock = clock
+        self.started = clock()
+        self.phase = "starting"
+        self.phase_started = self.started
+        self.stage = ""  # e.g. '>>> stage 4.2: building libraries'
+        self.status = ""  # the last line that was not important enough to be shown
+        self.done = None  # type: typing.Optional[int]
+        self.total = None  # type: typing.Optional[int]
+        self.last_plain_progress = self.started
+
+    def set_phase(self, phase: str):
+        self.phase = phase
+        self.phase_started = self.clock()
+        self.stage = ""
+        self.status = ""
+        self.done = self.total = None
+
+    def parse_progress(self, line: bytes):
+        m = _NINJA_PROGRESS.match(line)
+        if m:
+            self.done, self.total = int(m.group(1)), int(m.group(2))
+            return
+        m = _PERCENT_PROGRESS.match(line)
+        if m:
+            self.done, self.total = int(m.group(1)), 100
+
+    @property
+    def fraction(self) -> "typing.Optional[float]":
+        return self.done / self.total if self.total else None
+
+    def eta(self) -> "typing.Optional[float]":
+        now = self.clock()
+        if self.estimate is not None:
+            return self.estimate - (now - self.started)
+        fraction = self.fraction
+        if fraction and fraction > 0.02:
+            # no history for this target -> extrapolate from the progress of the current phase
+            elapsed = now - self.phase_started
+            return elapsed / fraction - elapsed
+        return None
+
+    def progress_str(self) -> str:
+        if self.fraction is None:
+            return ""
+        if self.total == 100:
+            return "{}%".format(self.done)
+        return "{}/{} {:.0f}%".format(self.done, self.total, 100 * self.fraction)
+
+    def row(self) -> str:
+        parts = ["{:<24}".format(self.name), "{:<9}".format(self.phase),
+                 _format_duration(self.clock() - self.started)]
+        eta = self.eta()
+        if eta is not None:
+            parts.append("ETA " + _format_duration(eta) if eta > 0 else "overdue")
+        progress = self.progress_str()
+        if progress:
+            parts.append("[" + progress + "]")
+        for detail in (self.stage, self.status):
+            if detail:
+                parts.append(detail)
+        return " ".join(parts)
+
+
+class BuildDashboard(object):
+    """
+    Shows the progress of all targets that are built concurrently (--parallel-targets) with one status row per
+    running target at the bottom of the terminal. Important lines (e.g. warnings) are printed above the rows and
+    prefixed with the name of the target.
+
+    If stdout is not a terminal there are no rows that can be updated, so phase changes and (every
+    plain_progress_interval seconds) the progress of each target are printed as normal lines instead.
+
+    Note: Commands that are not run using SimpleProject.runWithLogfile() (e.g. runCmd()) write directly to the terminal
+    which can leave stale rows behind until the next redraw.
+    """
+    plain_progress_interval = 60.0
+
+    def __init__(self, stdout: "typing.BinaryIO", stderr: "typing.BinaryIO", tty: bool, *,
+                 max_redraws_per_second=4, clock: "typing.Callable[[], float]"=time.monotonic,
+                 width: "typing.Callable[[], int]"=lambda: shutil.get_terminal_size().columns):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.tty = tty
+        self.clock = clock
+        self.width = width
+        self.min_redraw_interval = 1.0 / max_redraws_per_second
+        self.targets = dict()  # type: typing.Dict[str, TargetProgress]
+        self._lock = threading.RLock()
+        self._drawn_rows = 0
+        self._last_redraw = None  # type: typing.Optional[float]
+        # output that has not been terminated by a newline yet (per stream)
+        self._partial = dict()  # type: typing.Dict[typing.BinaryIO, bytes]
+        self._incomplete_line_shown = False
+
+    # Terminal handling:
+    def _erase(self) -> bytes:
+        if not self._drawn_rows:
+            return b""
+        rows = self._drawn_rows
+        self._drawn_rows = 0
+        # move to the first row and clear everything below
+        return b"\r\x1b[" + str(rows).encode() + b"A\x1b[J"
+
+    def _rows(self) -> bytes:
+        if self._incomplete_line_shown or not self.targets:
+            return b""
+        width = max(20, self.width() - 1)  # rows must not wrap, otherwise _erase() doesn't remove all of them
+        rows = [t.row()[:width] for t in sorted(self.targets.values(), key=lambda t: t.started)]
+        self._drawn_rows = len(rows)
+        self._last_redraw = self.clock()
+        return "".join(r + "\n" for r in rows).encode("utf-8", errors="replace")
+
+    def _write(self, stream: "typing.BinaryIO", data: bytes, final=False):
+        """Write data to stream and then redraw the rows (the caller must hold self._lock)"""
+        if not self.tty:
+            stream.write(data)
+            stream.flush()
+            return
+        data = self._partial.pop(stream, b"") + data
+        end = data.rfind(b"\n") + 1
+        if end < len(data) and not final:
+            # only write complete lines, otherwise the rows would be drawn after the incomplete line
+            self._partial[stream] = data[end:]
+            data = data[:end]
+        if not data:
+            return
+        # e.g. a prompt -> don't draw the rows below it until the line has been completed
+        self._incomplete_line_shown = not data.endswith(b"\n")
+        self.stdout.write(self._erase())
+        self.stdout.flush()
+        stream.write(data)
+        stream.flush()
+        rows = self._rows()
+        if rows:
+            self.stdout.write(rows)
+            self.stdout.flush()
+
+    def redraw(self, force=False):
+        with self._lock:
+            if not self.tty or self._incomplete_line_shown:
+                return
+            if not force and self._last_redraw is not None and \
+                    self.clock() - self._last_redraw < self.min_redraw_interval:
+                return
+            self.stdout.write(self._erase() + self._rows())
+            self.stdout.flush()
+
+    def write_stdout(self, data: bytes, final=False):
+        with self._lock:
+            self._write(self.stdout, data, final)
+
+    def write_stderr(self, data: bytes, final=False):
+        with self._lock:
+            self._write(self.stderr, data, final)
+
+    def _print_plain(self, target: TargetProgress, message: str):
+        if not self.tty:
+            self.stdout.write(("[" + target.name + "] " + message + "\n").encode("utf-8"))
+            self.stdout.flush()
+
+    # Progress updates:
+    def target_started(self, name: str, estimate: "typing.Optional[float]"):
+        with self._lock:
+            target = self.targets[name] = TargetProgress(name, estimate, self.clock)
+            if estimate is not None:
+                self._print_plain(target, "started (usually takes " + _format_duration(estimate) + ")")
+            else:
+                self._print_plain(target, "started")
+            self.redraw(force=True)
+
+    def target_finished(self, name: str, success: bool):
+        with self._lock:
+            target = self.targets.pop(name, None)
+            if target is not None:
+                self._print_plain(target, ("finished" if success else "failed") + " after " +
+                                  _format_duration(self.clock() - target.started))
+            self.redraw(force=True)
+
+    def phase_started(self, name: str, phase: str):
+        with self._lock:
+            target = self.targets.get(name)
+            if target is not None:
+                target.set_phase(phase)
+                self._print_plain(target, "running " + phase)
+                self.redraw(force=True)
+
+    def command_output(self, name: str, output_filter: "typing.Optional[OutputFilter]",
+                       lines: "typing.Iterable[bytes]"):
+        """Handle the (stdout) output of a command that is run by target name"""
+        prefix = b"[" + name.encode("utf-8") + b"] "
+        shown = []
+        with self._lock:
+            target = self.targets.get(name)
+            for line in lines:
+                action = output_filter.classify(line) if output_filter else LineAction.SHOW
+                if target is not None:
+                    target.parse_progress(line)
+                if action is LineAction.HIDE:
+                    continue
+                if target is not None:
+                    text = line.rstrip().decode("utf-8", errors="replace")
+                    if action is LineAction.HEADING:
+                        target.stage = text
+                        target.status = ""
+                    elif action is LineAction.STATUS:
+                        target.status = text
+                if action is not LineAction.STATUS:
+                    shown.append(prefix + line if line.endswith(b"\n") else prefix + line + b"\n")
+            if shown:
+                self._write(self.stdout, b"".join(shown))
+            elif target is not None and not self.tty and target.fraction is not None and \
+                    self.clock() - target.last_plain_progress >= self.plain_progress_interval:
+                target.last_plain_progress = self.clock()
+                self._print_plain(target, target.phase + " " + target.progress_str())
+            self.redraw()
+
+    def command_error(self, name: str, line: bytes):
+        with self._lock:
+            self._write(self.stderr, b"[" + name.encode("utf-8") + b"] " + line, final=not line.endswith(b"\n"))
+
+    def close(self):
+        with self._lock:
+            for stream, data in list(self._partial.items()):
+                self._write(stream, b"", final=True)
+            if self.tty:
+                self.stdout.write(self._erase())
+                self.stdout.flush()
+            self.targets.clear()
+
+
+class _DashboardTextStream(object):
+    """Replaces sys.stdout/sys.stderr while the dashboard is shown so that all output appears above the rows"""
+    def __init__(self, stream: "typing.TextIO", write: "typing.Callable[[bytes, bool], None]"):
+        self._stream = stream
+        self._write = write
+        self.buffer = _DashboardBinaryStream(stream.buffer, write)
+
+    def write(self, text: str) -> int:
+        self._write(text.encode(self._stream.encoding or "utf-8", errors="replace"), False)
+        return len(text)
+
+    def flush(self):
+        # make sure prompts (e.g. from queryYesNo()) become visible
+        self._write(b"", True)
+
+    def __getattr__(self, item):
+        return getattr(self._stream, item)
+
+
+class _DashboardBinaryStream(object):
+    def __init__(self, buffer: "typing.BinaryIO", write: "typing.Callable[[bytes, bool], None]"):
+        self._buffer = buffer
+        self._write = write
+
+    def write(self, data: bytes) -> int:
+        self._write(bytes(data), False)
+        return len(data)
+
+    def flush(self):
+        self._write(b"", True)
+
+    def __getattr__(self, item):
+        return getattr(self._buffer, item)
+
+
+_dashboard = None  # type: typing.Optional[BuildDashboard]
+
+
+@contextlib.contextmanager
+def show_dashboard():
+    """Show the build dashboard (and redirect sys.stdout and sys.stderr to it) until the end of the with block"""
+    global _dashboard
+    tty = sys.stdout.isatty()
+    dashboard = BuildDashboard(sys.stdout.buffer, sys.stderr.buffer, tty)
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    stop = threading.Event()
+    refresher = None
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if tty:
+        sys.stdout = _DashboardTextStream(old_stdout, dashboard.write_stdout)
+        sys.stderr = _DashboardTextStream(old_stderr, dashboard.write_stderr)
+
+        def refresh():
+            # update the elapsed times even if there is no output
+            while not stop.wait(1.0):
+                dashboard.redraw()
+        refresher = threading.Thread(target=refresh, name="dashboard", daemon=True)
+        refresher.start()
+    _dashboard = dashboard
+    try:
+        yield dashboard
+    finally:
+        _dashboard = None
+        stop.set()
+        if refresher is not None:
+            refresher.join()
+        dashboard.close()
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+
+
+def get_dashboard() -> "typing.Optional[BuildDashboard]":
+    return _dashboard
@@ -35,6 +35,7 @@ import subprocess
 
 from pathlib import Path
 from .config.chericonfig import CheriConfig
+from .tracing import trace_span
 from .utils import *
 
 
@@ -74,7 +75,8 @@ class FileSystemUtils(object):
             try:
                 if self.parent.config.verbose:
                     statusUpdate("Deleting", self.path, "asynchronously")
-                self.parent._deleteDirectories(self.path)
+                with trace_span("delete " + str(self.path), "filesystem", path=str(self.path)):
+                    self.parent._deleteDirectories(self.path)
                 if self.parent.config.verbose:
                     statusUpdate("Async delete of", self.path, "finished")
             except Exception as e:
@@ -130,7 +132,7 @@ class FileSystemUtils(object):
 
     def copyRemoteFile(self, remotePath: str, targetFile: Path):
         # if we have rsync we can skip the copy if file is already up-to-date
-        if shutil.which("rsync"):
+        if which("rsync"):
             try:
                 runCmd("rsync", "-aviu", "--progress", remotePath, targetFile)
             except subprocess.CalledProcessError as err:
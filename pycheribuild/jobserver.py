@@ -0,0 +1,103 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import os
+
+from .utils import typing, statusUpdate
+
+
+class JobServer(object):
+    """
+    A GNU make compatible jobserver (https://www.gnu.org/software/make/manual/html_node/Job-Slots.html).
+
+    Every child process that is started with the jobserver fds implicitly owns one job slot and has to read a token
+    from the pipe before starting any additional jobs. To keep the total number of jobs within the budget we therefore
+    put all tokens into the pipe and take one ourselves for the duration of every child process.
+    """
+    # Both GNU make and bmake use '+' as the token character (bmake treats any other character as an abort request)
+    TOKEN = b"+"
+
+    def __init__(self, jobs: int):
+        assert jobs >= 1
+        self.jobs = jobs
+        self.read_fd, self.write_fd = os.pipe()
+        os.write(self.write_fd, self.TOKEN * jobs)
+
+    def acquire(self) -> None:
+        token = os.read(self.read_fd, 1)
+        assert token == self.TOKEN, "Unexpected jobserver token " + repr(token)
+
+    def release(self) -> None:
+        os.write(self.write_fd, self.TOKEN)
+
+    @contextlib.contextmanager
+    def reserve(self, count: int):
+        """Hold count job slots for the duration of the with block"""
+        acquired = 0
+        try:
+            while acquired < min(count, self.jobs):
+                self.acquire()
+                acquired += 1
+            yield
+        finally:
+            for _ in range(acquired):
+                self.release()
+
+    def implicit_token(self):
+        """Reserve the implicit job slot of a child process while it is running"""
+        return self.reserve(1)
+
+    @property
+    def pass_fds(self) -> "typing.Tuple[int, int]":
+        return self.read_fd, self.write_fd
+
+    def gnu_makeflags(self, legacy_fds_flag=False) -> str:
+        # GNU make before 4.2 called the option --jobserver-fds
+        flag = "--jobserver-fds" if legacy_fds_flag else "--jobserver-auth"
+        return " -j" + str(self.jobs) + " " + flag + "=" + str(self.read_fd) + "," + str(self.write_fd)
+
+    def bsd_make_args(self) -> "typing.List[str]":
+        # bmake uses the same protocol but only accepts the pipe via the (internal) -J flag
+        return ["-j", str(self.jobs), "-J", str(self.read_fd) + "," + str(self.write_fd)]
+
+
+_jobserver = None  # type: typing.Optional[JobServer]
+
+
+def start_jobserver(jobs: int) -> JobServer:
+    global _jobserver
+    if _jobserver is None:
+        statusUpdate("Sharing", jobs, "make jobs between all build commands using a jobserver")
+        _jobserver = JobServer(jobs)
+    return _jobserver
+
+
+def get_jobserver() -> "typing.Optional[JobServer]":
+    return _jobserver
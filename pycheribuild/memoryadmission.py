@@ -0,0 +1,117 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import threading
+import time
+
+from .utils import typing, statusUpdate
+
+
+def read_meminfo() -> "typing.Optional[typing.Dict[str, int]]":
+    """:return: the values from /proc/meminfo in KiB or None if not available (i.e. not running on Linux)"""
+    result = dict()
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                parts = value.split()
+                if parts and parts[0].isdigit():
+                    result[key] = int(parts[0])
+    except OSError:
+        return None
+    return result
+
+
+def available_memory_mb() -> "typing.Optional[int]":
+    meminfo = read_meminfo()
+    if not meminfo or "MemAvailable" not in meminfo:
+        return None
+    return meminfo["MemAvailable"] // 1024
+
+
+class MemoryAdmissionController(object):
+    """
+    Holds back memory intensive build phases (e.g. linking LLVM or building the CheriBSD world) until enough memory is
+    available. A phase is started if the sum of the estimated peak memory of all running phases stays within the budget
+    and /proc/meminfo reports that the required amount of memory is currently available.
+    If nothing else is running a phase is always started (even if it needs more than the budget) to avoid deadlocks.
+    """
+    poll_interval = 5.0  # memory may be freed by processes outside cheribuild -> check /proc/meminfo regularly
+
+    def __init__(self, budget_mb: int, available_memory: "typing.Callable[[], typing.Optional[int]]"=None):
+        self.budget_mb = budget_mb
+        self.reserved_mb = 0
+        self._running = 0
+        self._available_memory = available_memory or available_memory_mb
+        self._condition = threading.Condition()
+
+    def _can_admit(self, amount_mb: int) -> bool:
+        if self._running == 0:
+            return True
+        if self.reserved_mb + amount_mb > self.budget_mb:
+            return False
+        available = self._available_memory()
+        return available is None or available >= amount_mb
+
+    @contextlib.contextmanager
+    def reserve(self, amount_mb: int, description: str):
+        with self._condition:
+            if not self._can_admit(amount_mb):
+                statusUpdate("Waiting for", amount_mb, "MiB of memory to become available before starting", description)
+                while not self._can_admit(amount_mb):
+                    self._condition.wait(self.poll_interval)
+            self.reserved_mb += amount_mb
+            self._running += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.reserved_mb -= amount_mb
+                self._running -= 1
+                self._condition.notify_all()
+
+
+_memory_admission = None  # type: typing.Optional[MemoryAdmissionController]
+
+
+def start_memory_admission(budget_mb: int) -> MemoryAdmissionController:
+    global _memory_admission
+    if _memory_admission is None:
+        if not budget_mb:
+            # Default to 90% of the memory that is available when the build starts
+            budget_mb = int((available_memory_mb() or 0) * 0.9)
+        if budget_mb:
+            statusUpdate("Limiting the estimated memory usage of concurrent build phases to", budget_mb, "MiB")
+            _memory_admission = MemoryAdmissionController(budget_mb)
+    return _memory_admission
+
+
+def get_memory_admission() -> "typing.Optional[MemoryAdmissionController]":
+    return _memory_admission
@@ -0,0 +1,158 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import time
+from enum import Enum
+
+from .utils import typing
+
+
+class LineAction(Enum):
+    SHOW = "show"  # keep the line visible (below the current status line)
+    HEADING = "heading"  # replace the current status line with this line and keep it visible
+    STATUS = "status"  # show the line on the status line which will be overwritten by the next line
+    HIDE = "hide"  # don't show the line at all
+
+
+class OutputFilter(object):
+    """
+    A declarative filter for the output of build commands. Lines are classified by looking them up in precompiled
+    tables of exact lines, prefixes and suffixes (in that order, the longest matching prefix/suffix wins) instead of
+    calling a python function for every line.
+    """
+    def __init__(self, default: LineAction, *, lines: "typing.Dict[bytes, LineAction]"=None,
+                 prefixes: "typing.Dict[bytes, LineAction]"=None, suffixes: "typing.Dict[bytes, LineAction]"=None):
+        self.default = default
+        self.lines = dict(lines or {})
+        self.prefixes = dict(prefixes or {})
+        self.suffixes = dict(suffixes or {})
+        self._prefix_tables = self._compile(self.prefixes)
+        self._suffix_tables = self._compile(self.suffixes)
+
+    @staticmethod
+    def _compile(table: "typing.Dict[bytes, LineAction]") -> "typing.List[typing.Tuple[int, dict]]":
+        # group the entries by length so that every lookup is a single slice + dict lookup
+        by_length = dict()  # type: typing.Dict[int, typing.Dict[bytes, LineAction]]
+        for key, action in table.items():
+            assert key, "Empty prefix/suffix would match every line"
+            by_length.setdefault(len(key), dict())[key] = action
+        return sorted(by_length.items(), reverse=True)
+
+    def extend(self, default: LineAction=None, **kwargs) -> "OutputFilter":
+        """:return: a new filter that contains all entries of this one and the ones passed in kwargs"""
+        tables = dict(lines=dict(self.lines), prefixes=dict(self.prefixes), suffixes=dict(self.suffixes))
+        for name, entries in kwargs.items():
+            tables[name].update(entries)
+        return OutputFilter(self.default if default is None else default, **tables)
+
+    def classify(self, line: bytes) -> LineAction:
+        action = self.lines.get(line)
+        if action is not None:
+            return action
+        for length, table in self._prefix_tables:
+            action = table.get(line[:length])
+            if action is not None:
+                return action
+        for length, table in self._suffix_tables:
+            action = table.get(line[-length:])
+            if action is not None:
+                return action
+        return self.default
+
+
+class StatusLineWriter(object):
+    """
+    Writes the lines accepted by an OutputFilter to the terminal. All the output for a batch of lines is written
+    with a single write() + flush() and the status line is redrawn at most max_redraws_per_second times (status
+    lines that would have been overwritten before the next redraw are skipped).
+    """
+    def __init__(self, stream: "typing.BinaryIO", clear_line_sequence: bytes, *, max_redraws_per_second=10,
+                 flush: "typing.Callable[[], None]"=None, clock: "typing.Callable[[], float]"=time.monotonic):
+        self.stream = stream
+        self.clear_line_sequence = clear_line_sequence
+        self.min_redraw_interval = 1.0 / max_redraws_per_second if max_redraws_per_second > 0 else 0.0
+        self.flush = flush or stream.flush
+        self.clock = clock
+        self.status_line_visible = False
+        self._pending_status = None  # type: typing.Optional[bytes]
+        self._last_redraw = None  # type: typing.Optional[float]
+
+    def _status_line(self, line: bytes) -> bytes:
+        prefix = self.clear_line_sequence if self.status_line_visible else b""
+        self.status_line_visible = True
+        # remove the newline at the end and add a space so that there is a gap before error messages
+        return prefix + (line[:-1] if line.endswith(b"\n") else line) + b" "
+
+    def _render(self, output_filter: OutputFilter, lines: "typing.Iterable[bytes]") -> "typing.List[bytes]":
+        result = []
+        for line in lines:
+            action = output_filter.classify(line)
+            if action is LineAction.STATUS:
+                self._pending_status = line
+            elif action is LineAction.HEADING:
+                self._pending_status = None  # would be overwritten by this line anyway
+                if self.status_line_visible:
+                    result.append(self.clear_line_sequence)
+                result.append(line)
+                self.status_line_visible = False
+            elif action is LineAction.SHOW:
+                if self._pending_status is not None:
+                    # keep the context (e.g. the current directory) of this line visible
+                    result.append(self._status_line(self._pending_status))
+                    self._pending_status = None
+                if self.status_line_visible:
+                    result.append(b"\n")
+                result.append(line)
+                self.status_line_visible = False
+        return result
+
+    def write_lines(self, output_filter: OutputFilter, lines: "typing.Iterable[bytes]") -> None:
+        output = self._render(output_filter, lines)
+        if self._pending_status is not None:
+            now = self.clock()
+            if self._last_redraw is None or now - self._last_redraw >= self.min_redraw_interval:
+                output.append(self._status_line(self._pending_status))
+                self._pending_status = None
+                self._last_redraw = now
+        if output:
+            self.stream.write(b"".join(output))
+            self.flush()
+
+    def end_status_line(self) -> None:
+        """Draw the latest status line and move to a new line (e.g. before writing to stderr or at the end)"""
+        output = []
+        if self._pending_status is not None:
+            output.append(self._status_line(self._pending_status))
+            self._pending_status = None
+        if self.status_line_visible:
+            output.append(b"\n")
+            self.status_line_visible = False
+        if output:
+            self.stream.write(b"".join(output))
+            self.flush()
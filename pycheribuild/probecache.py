@@ -0,0 +1,150 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+# Note: This module is imported by utils.py so it must not import anything from pycheribuild.
+
+
+def _default_cache_path() -> Path:
+    cache_home = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(cache_home, "cheribuild", "toolchain-probes.json")
+
+
+class ProbeCache(object):
+    """
+    Caches the results of running compilers and other tools to find out their version or supported flags (e.g.
+    `clang -v` or `cc -fuse-ld=lld`) across cheribuild invocations.
+    Every result is keyed by the real path of the binary and is only used if its inode, size and mtime (and those of
+    any other binaries that the probe depends on) are unchanged.
+
+    The cache file is shared by concurrent cheribuild invocations: updates are serialized using a lock file and
+    written atomically. Set $CHERIBUILD_PROBE_CACHE to another path (or an empty string to disable the cache).
+    """
+    def __init__(self, path: "typing.Optional[Path]"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None  # type: typing.Optional[dict]
+
+    @staticmethod
+    def _identity(binary: "typing.Union[str, Path]") -> "typing.Optional[typing.Tuple[str, list]]":
+        binary = str(binary)
+        if os.sep not in binary:
+            binary = shutil.which(binary)
+            if binary is None:
+                return None
+        try:
+            real_path = os.path.realpath(binary)
+            st = os.stat(real_path)
+        except OSError:
+            return None
+        return real_path, [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def _load(self) -> dict:
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}  # missing or corrupt -> the probes will just be rerun
+
+    def get(self, kind: str, binary: "typing.Union[str, Path]", compute: "typing.Callable[[], typing.Any]",
+            args: "typing.Sequence[str]"=(), dependencies: "typing.Sequence[typing.Union[str, Path]]"=(),
+            cacheable: "typing.Callable[[typing.Any], bool]"=None):
+        """
+        :param kind: the kind of probe (e.g. "compiler-info")
+        :param binary: the tool that is probed
+        :param compute: a function that runs the probe, the result must be JSON-serializable
+        :param args: additional parameters that affect the result
+        :param dependencies: other binaries that the result depends on (e.g. the linker used by the compiler)
+        :param cacheable: returns False for results that should not be stored (e.g. because the probe failed)
+        :return: the cached result or the result of compute()
+        """
+        identity = self._identity(binary) if self.path else None
+        if identity is None:
+            return compute()
+        key = "\0".join([kind, identity[0]] + [str(a) for a in args])
+        dependency_identities = [self._identity(d) for d in dependencies]
+        dependency_identities = [list(d) if d else None for d in dependency_identities]
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            entry = self._entries.get(key)
+        if entry is not None and entry.get("identity") == identity[1] and \
+                entry.get("dependencies", []) == dependency_identities:
+            return entry["value"]
+        value = compute()
+        if cacheable is not None and not cacheable(value):
+            return value
+        new_entry = {"identity": identity[1], "value": value}
+        if dependency_identities:
+            new_entry["dependencies"] = dependency_identities
+        with self._lock:
+            self._entries[key] = new_entry
+        self._store(key, new_entry)
+        return value
+
+    def _store(self, key: str, entry: dict):
+        try:
+            os.makedirs(str(self.path.parent), exist_ok=True)
+            with open(str(self.path) + ".lock", "w") as lockfile:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+                # merge with the entries that were added by other invocations in the meantime
+                data = self._load()
+                data[key] = entry
+                fd, tmpname = tempfile.mkstemp(dir=str(self.path.parent), prefix=self.path.name + ".")
+                try:
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        json.dump(data, f, indent=1, sort_keys=True)
+                    os.replace(tmpname, str(self.path))
+                except BaseException:
+                    os.unlink(tmpname)
+                    raise
+        except OSError:
+            pass  # e.g. read-only home directory -> the probe will be rerun next time
+
+
+_probe_cache = None  # type: typing.Optional[ProbeCache]
+
+
+def get_probe_cache() -> ProbeCache:
+    global _probe_cache
+    if _probe_cache is None:
+        path = os.getenv("CHERIBUILD_PROBE_CACHE")
+        if path is None:
+            _probe_cache = ProbeCache(_default_cache_path())
+        else:
+            _probe_cache = ProbeCache(Path(path) if path else None)
+    return _probe_cache
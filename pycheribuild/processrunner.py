@@ -0,0 +1,206 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import concurrent.futures
+import subprocess
+import threading
+
+from .utils import typing
+
+# Note: This module deliberately doesn't use async def/await since cheribuild still supports python 3.4. The event
+# loop only uses callbacks (protocols and call_later) so it works with all versions of asyncio.
+# asyncio is only imported when the first ProcessRunner is created since importing it takes a significant part of
+# the startup time of cheribuild.
+
+
+class OutputHandler(object):
+    """
+    Receives the output of a process that is started by ProcessRunner. All methods are called on the event loop
+    thread so implementations don't need any locking (as long as they are only used for a single process).
+    """
+    def stdout_data(self, data: bytes) -> None:
+        pass
+
+    def stderr_data(self, data: bytes) -> None:
+        pass
+
+    def finished(self, returncode: int) -> None:
+        pass
+
+
+class LineBufferedOutputHandler(OutputHandler):
+    """Splits the output into lines and calls stdout_line()/stderr_line() for every complete line"""
+    def __init__(self):
+        self._partial = {"stdout": b"", "stderr": b""}
+
+    def _split(self, stream: str, data: bytes) -> "typing.List[bytes]":
+        data = self._partial[stream] + data
+        end = data.rfind(b"\n") + 1
+        self._partial[stream] = data[end:]
+        return data[:end].splitlines(keepends=True)
+
+    def stdout_data(self, data: bytes):
+        for line in self._split("stdout", data):
+            self.stdout_line(line)
+
+    def stderr_data(self, data: bytes):
+        for line in self._split("stderr", data):
+            self.stderr_line(line)
+
+    def finished(self, returncode: int):
+        # process output that didn't end with a newline
+        if self._partial["stdout"]:
+            self.stdout_line(self._partial["stdout"])
+        if self._partial["stderr"]:
+            self.stderr_line(self._partial["stderr"])
+        self._partial = {"stdout": b"", "stderr": b""}
+
+    def stdout_line(self, line: bytes) -> None:
+        pass
+
+    def stderr_line(self, line: bytes) -> None:
+        pass
+
+
+class _PipeProtocol(object):
+    # Implements the asyncio.Protocol interface (without subclassing it to avoid importing asyncio)
+    def __init__(self, process: "_RunningProcess", callback: "typing.Callable[[bytes], None]"):
+        self.process = process
+        self.callback = callback
+
+    def connection_made(self, transport):
+        pass
+
+    def eof_received(self):
+        pass
+
+    def data_received(self, data: bytes):
+        try:
+            self.callback(data)
+        except BaseException as e:
+            self.process.fail(e)
+
+    def connection_lost(self, exc):
+        self.process.pipe_closed()
+
+
+class _RunningProcess(object):
+    poll_interval = 0.05
+
+    def __init__(self, runner: "ProcessRunner", proc: subprocess.Popen, handler: OutputHandler):
+        self.runner = runner
+        self.proc = proc
+        self.handler = handler
+        self.future = concurrent.futures.Future()
+        self._open_pipes = 0
+        self._error = None  # type: typing.Optional[BaseException]
+
+    def attach(self):
+        loop = self.runner.loop
+        for pipe, callback in ((self.proc.stdout, self.handler.stdout_data),
+                               (self.proc.stderr, self.handler.stderr_data)):
+            if pipe is not None:
+                self._open_pipes += 1
+                task = loop.create_task(loop.connect_read_pipe(lambda cb=callback: _PipeProtocol(self, cb), pipe))
+                task.add_done_callback(self._pipe_connected)
+        if not self._open_pipes:
+            self._poll()
+
+    def _pipe_connected(self, task: "asyncio.Task"):
+        if task.exception() is not None:
+            self.fail(task.exception())
+            self.pipe_closed()
+
+    def fail(self, error: BaseException):
+        if self._error is None:
+            self._error = error
+
+    def pipe_closed(self):
+        self._open_pipes -= 1
+        if self._open_pipes == 0:
+            self._poll()
+
+    def _poll(self):
+        # All output has been read -> wait for the process to exit without blocking the event loop
+        try:
+            returncode = self.proc.poll()
+        except ChildProcessError as e:
+            self.future.set_exception(e)
+            return
+        if returncode is None:
+            self.runner.loop.call_later(self.poll_interval, self._poll)
+            return
+        try:
+            self.handler.finished(returncode)
+        except BaseException as e:
+            self.fail(e)
+        if self._error is not None:
+            self.future.set_exception(self._error)
+        else:
+            self.future.set_result(returncode)
+
+
+class ProcessRunner(object):
+    """
+    Runs an asyncio event loop in a background thread that multiplexes the output of all child processes, so that no
+    additional threads are needed for concurrently running commands.
+    start() returns a concurrent.futures.Future (use asyncio.wrap_future() to await it in a coroutine).
+    """
+    def __init__(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="process-runner", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        import asyncio
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self, proc: subprocess.Popen, handler: OutputHandler=None) -> "concurrent.futures.Future":
+        """
+        Start processing the output of proc (stdout and stderr should be pipes unless they are redirected to a file)
+        :return: a future that will contain the return code of the process once it has exited and all output has
+        been handled (or the exception raised by the output handler)
+        """
+        running = _RunningProcess(self, proc, handler or OutputHandler())
+        self.loop.call_soon_threadsafe(running.attach)
+        return running.future
+
+
+_process_runner = None  # type: typing.Optional[ProcessRunner]
+_process_runner_lock = threading.Lock()
+
+
+def get_process_runner() -> ProcessRunner:
+    global _process_runner
+    with _process_runner_lock:
+        if _process_runner is None:
+            _process_runner = ProcessRunner()
+        return _process_runner
@@ -87,6 +87,8 @@ class BuildCheriVis(Project):
     def checkSystemDependencies(self):
         super().checkSystemDependencies()
         self.cheritrace_subproject.checkSystemDependencies()
+        if self.has_missing_system_dependencies:
+            return  # gnustep-config may be missing
 
         # expectedCheritraceLib = str(self.config.sdkDir / "lib/libcheritrace.a")
         # cheritraceLib = Path(os.getenv("CHERITRACE_LIB") or expectedCheritraceLib)
@@ -28,6 +28,7 @@
 # SUCH DAMAGE.
 #
 from .project import *
+from ..jobserver import get_jobserver
 from ..utils import *
 
 
@@ -40,5 +41,26 @@ class BuildCMake(AutotoolsProject):
 
     def __init__(self, config: CheriConfig):
         super().__init__(config, configureScript="bootstrap")
-        self.configureArgs.append("--parallel=" + str(self.config.makeJobs))
-        # TODO: do we need to use gmake on FreeBSD?
+        self._parallel_arg = "--parallel=" + str(self.config.makeJobs)
+        self.configureArgs.append(self._parallel_arg)
+
+    def configure(self, **kwargs):
+        jobserver = get_jobserver()
+        # The bootstrap script builds with GNU make if it is available (gmake on FreeBSD)
+        make_command = "gmake" if IS_FREEBSD else "make"
+        jobserver_args = self._jobserver_args(jobserver, MakeCommandKind.GnuMake, make_command) if jobserver else None
+        if jobserver_args is None:
+            super().configure(**kwargs)
+            return
+        # Don't pass --parallel so that the bootstrap make uses the shared jobserver from MAKEFLAGS instead
+        configure_args, configure_env = list(self.configureArgs), dict(self.configureEnvironment)
+        self.configureArgs.remove(self._parallel_arg)
+        self.configureEnvironment.update(jobserver_args[1])
+        try:
+            with jobserver.implicit_token():
+                super().configure(pass_fds=jobserver.pass_fds, **kwargs)
+        finally:
+            # configureArgs and configureEnvironment can't be reassigned -> restore their contents
+            self.configureArgs[:] = configure_args
+            self.configureEnvironment.clear()
+            self.configureEnvironment.update(configure_env)
@@ -39,6 +39,7 @@ from .multiarchmixin import MultiArchBaseMixin
 from ..project import *
 from ...config.loader import ComputedDefaultValue
 from ...config.chericonfig import CrossCompileTarget
+from ...outputfilter import LineAction, OutputFilter
 from ...utils import *
 
 
@@ -200,27 +201,19 @@ class BuildFreeBSD(MultiArchBaseMixin, Project):
         else:
             cls.crossbuild = cls.addBoolOption("crossbuild", help="Try to compile FreeBSD on non-FreeBSD machines")
 
-    def _stdoutFilter(self, line: bytes):
-        if line.startswith(b">>> "):  # major status update
-            if self._lastStdoutLineCanBeOverwritten:
-                sys.stdout.buffer.write(Project._clearLineSequence)
-            sys.stdout.buffer.write(line)
-            flushStdio(sys.stdout)
-            self._lastStdoutLineCanBeOverwritten = False
-        elif line.startswith(b"===> "):  # new subdirectory
-            self._lineNotImportantStdoutFilter(line)
-        elif line == b"--------------------------------------------------------------\n":
-            return  # ignore separator around status updates
-        elif line == b"\n":
-            return  # ignore empty lines when filtering
-        elif line.endswith(b"' is up to date.\n"):
-            return  # ignore these messages caused by (unnecessary?) recursive make invocations|
-        elif line.endswith(b"missing (created)\n"):
-            return  # ignore these from installworld
-        elif line.startswith(b"[Creating objdir") or line.startswith(b"[Creating nested objdir"):
-            return  # ignore the WITH_AUTO_OBJ messages
-        else:
-            self._showLineStdoutFilter(line)
+    _stdoutFilter = OutputFilter(LineAction.SHOW, prefixes={
+        b">>> ": LineAction.HEADING,  # major status update
+        b"===> ": LineAction.STATUS,  # new subdirectory
+        # ignore the WITH_AUTO_OBJ messages
+        b"[Creating objdir": LineAction.HIDE,
+        b"[Creating nested objdir": LineAction.HIDE,
+    }, lines={
+        b"--------------------------------------------------------------\n": LineAction.HIDE,  # separator around status
+        b"\n": LineAction.HIDE,  # ignore empty lines when filtering
+    }, suffixes={
+        b"' is up to date.\n": LineAction.HIDE,  # caused by (unnecessary?) recursive make invocations
+        b"missing (created)\n": LineAction.HIDE,  # ignore these from installworld
+    })
 
     def __init__(self, config: CheriConfig, archBuildFlags: dict = None):
         super().__init__(config)
@@ -423,7 +416,7 @@ class BuildFreeBSD(MultiArchBaseMixin, Project):
 
     def runMake(self, makeTarget="", *, options: MakeOptions = None, parallel=True, **kwargs):
         # make behaves differently with -j1 and not j flags -> remove the j flag if j1 is requested
-        if parallel and self.config.makeJobs == 1:
+        if parallel and self.config.makeJobsPerTarget == 1:
             parallel = False
         super().runMake(makeTarget, options=options, cwd=self.sourceDir, parallel=parallel, **kwargs)
 
@@ -481,7 +474,11 @@ class BuildFreeBSD(MultiArchBaseMixin, Project):
 
     @property
     def jflag(self) -> list:
-        return [self.config.makeJFlag] if self.config.makeJobs > 1 else []
+        return [self.config.makeJFlag] if self.config.makeJobsPerTarget > 1 else []
+
+    def estimated_peak_memory_mb(self, phase: str):
+        # buildworld runs lots of clang processes in parallel (and links large libraries/programs)
+        return self.config.makeJobsPerTarget * 768 if phase == "compile" else 0
 
     def compile(self, mfs_root_image: Path=None, sysroot_only=False, **kwargs):
         # The build seems to behave differently when -j1 is passed (it still complains about parallel make failures)
@@ -515,7 +512,7 @@ class BuildFreeBSD(MultiArchBaseMixin, Project):
             bw_flags = args.all_commandline_args + ["buildenv",
                                                     "BUILDENV_SHELL=" + str(self.make_args.command) + " -V " + var]
             if self.crossbuild:
-                bw_flags.append("PATH=" + os.getenv("PATH"))
+                bw_flags.append("PATH=" + getenv("PATH"))
             if not self.sourceDir.exists():
                 assert self.config.pretend, "This should only happen when running in a test environment"
                 return None
@@ -710,7 +707,7 @@ print("NOOP chflags:", sys.argv, file=sys.stderr)
         for t in self.temporary_crossbuild_tools:
             host_tools.append(t)
         # awk is special because it may also be nawk (e.g. on Ubuntu)
-        awk = shutil.which("nawk") or shutil.which("awk") or "awk"
+        awk = which("nawk") or which("awk") or "awk"
         self.createSymlink(awk, self.crossBinDir / "awk", relative=False)
 
         for tool in host_tools:
@@ -744,7 +741,7 @@ print("NOOP chflags:", sys.argv, file=sys.stderr)
         # /bin/sh on Ubuntu doesn't like shift without any arguments, let's use bash as bin/sh instead...
         # This is a problem when running ncurses MKfallback.sh
         shell = "bash"
-        self.createSymlink(Path(shutil.which(shell)), self.crossBinDir / "sh", relative=False)
+        self.createSymlink(Path(which(shell)), self.crossBinDir / "sh", relative=False)
 
         self.make_args.env_vars["AWK"] = self.crossBinDir / "awk"
 
@@ -755,12 +752,12 @@ print("NOOP chflags:", sys.argv, file=sys.stderr)
                              " to scp the required files from another server (see --frebsd-build-server options)")
                 return
             # self.prepareFreeBSDCrossEnv()
-        # remove any environment variables that could interfere with bmake running
-        for k, v in os.environ.copy().items():
-            if k in ("MAKEFLAGS", "MFLAGS", "MAKELEVEL", "MAKE_TERMERR", "MAKE_TERMOUT", "MAKE"):
-                os.unsetenv(k)
-                del os.environ[k]
+        # remove any environment variables that could interfere with bmake running (only for the commands started
+        # by this target, other targets running concurrently keep their environment)
+        with setEnv(**dict.fromkeys(("MAKEFLAGS", "MFLAGS", "MAKELEVEL", "MAKE_TERMERR", "MAKE_TERMOUT", "MAKE"))):
+            self._process_without_make_environment()
 
+    def _process_without_make_environment(self):
         buildenv_target = "buildenv"
         if self._crossCompileTarget == CrossCompileTarget.CHERI and self.config.libcheri_buildenv:
             buildenv_target = "libcheribuildenv"
@@ -1085,7 +1082,7 @@ class BuildCheriBsdSysroot(SimpleProject):
         printCommand(archiveCmd, cwd=BuildCHERIBSD.rootfsDir(self, self.config))
         if not self.config.pretend:
             tar_cwd = str(BuildCHERIBSD.rootfsDir(self, self.config))
-            with subprocess.Popen(archiveCmd, stdout=subprocess.PIPE, cwd=tar_cwd) as tar:
+            with subprocess.Popen(archiveCmd, stdout=subprocess.PIPE, cwd=tar_cwd, env=command_environment()) as tar:
                 runCmd(["tar", "xf", "-"], stdin=tar.stdout, cwd=self.config.sdkSysrootDir)
         if not (self.config.sdkSysrootDir / "lib/libc.so.7").is_file():
             fatalError(self.config.sdkSysrootDir, "is missing the libc library, install seems to have failed!")
@@ -31,7 +31,6 @@
 import os
 import inspect
 import pprint
-import shutil
 from enum import Enum
 from pathlib import Path
 
@@ -590,7 +589,7 @@ class CrossCompileAutotoolsProject(CrossCompileMixin, AutotoolsProject):
     def process(self):
         if not self.compiling_for_host():
             # We run all these commands with $PATH containing $CHERI_SDK/bin to ensure the right tools are used
-            with setEnv(PATH=str(self.config.sdkDir / "bin") + ":" + os.getenv("PATH")):
+            with setEnv(PATH=str(self.config.sdkDir / "bin") + ":" + getenv("PATH")):
                 super().process()
         else:
             # when building the native target we just rely on the host tools in /usr/bin
@@ -29,10 +29,7 @@
 #
 
 from .crosscompileproject import *
-from ...utils import runCmd, statusUpdate, IS_MAC, warningMessage, fatalError
-
-import os
-import shutil
+from ...utils import runCmd, statusUpdate, IS_MAC, warningMessage, fatalError, getenv, which
 
 
 class TemporarilyRemoveProgramsFromSdk(object):
@@ -141,8 +138,8 @@ class BuildGDB(CrossCompileAutotoolsProject):
         if self.make_args.command == "gmake":
             self.configureEnvironment["MAKE"] = "gmake"
 
-        self.hostCC = os.getenv("HOST_CC", str(config.clangPath))
-        self.hostCXX = os.getenv("HOST_CXX", str(config.clangPlusPlusPath))
+        self.hostCC = getenv("HOST_CC", str(config.clangPath))
+        self.hostCXX = getenv("HOST_CXX", str(config.clangPlusPlusPath))
         self.configureEnvironment["CC_FOR_BUILD"] = self.hostCC
         self.configureEnvironment["CXX_FOR_BUILD"] = self.hostCXX
         self.configureEnvironment["CFLAGS_FOR_BUILD"] = "-g"
@@ -165,13 +162,13 @@ class BuildGDB(CrossCompileAutotoolsProject):
     @property
     def CC(self):
         if IS_MAC and self.compiling_for_host():
-            return shutil.which("gcc")  # For some reason it fails when using /usr/bin/cc
+            return which("gcc")  # For some reason it fails when using /usr/bin/cc
         return super().CC
 
     @property
     def CXX(self):
         if IS_MAC and self.compiling_for_host():
-            return shutil.which("g++")  # For some reason it fails when using /usr/bin/c++
+            return which("g++")  # For some reason it fails when using /usr/bin/c++
         return super().CXX
 
     def configure(self, **kwargs):
@@ -34,8 +34,7 @@ from ..build_qemu import BuildQEMU
 from ..llvm import BuildLLVM
 from ..run_qemu import LaunchCheriBSD
 from ...config.loader import ComputedDefaultValue
-from ...utils import OSInfo, statusUpdate, runCmd, warningMessage
-import os
+from ...utils import OSInfo, statusUpdate, runCmd, warningMessage, getenv
 
 installToCXXDir = ComputedDefaultValue(
     function=lambda config, project: BuildCHERIBSD.rootfsDir(project, config) / "opt/c++",
@@ -63,7 +62,7 @@ class BuildLibunwind(CrossCompileCMakeProject):
             self.collect_test_binaries = self.buildDir / "test-output"
             executor = "CollectBinariesExecutor(\\\"{path}\\\", self)".format(path=self.collect_test_binaries)
             self.add_cmake_options(
-                LLVM_LIT_ARGS="--xunit-xml-output " + os.getenv("WORKSPACE", ".") +
+                LLVM_LIT_ARGS="--xunit-xml-output " + getenv("WORKSPACE", ".") +
                               "/lit-test-results.xml --max-time 3600 --timeout 120 -s -vv",
                 LIBUNWIND_TARGET_TRIPLE=self.targetTriple, LIBUNWIND_SYSROOT=self.sdkSysroot)
 
@@ -159,7 +158,7 @@ class BuildLibCXX(CrossCompileCMakeProject):
             LLVM_CONFIG_PATH=self.config.sdkBinDir / "llvm-config",
             LLVM_EXTERNAL_LIT=BuildLLVM.getBuildDir(self, config) / "bin/llvm-lit",
             LIBCXXABI_USE_LLVM_UNWINDER=False,  # we have a fake libunwind in libcxxrt
-            LLVM_LIT_ARGS="--xunit-xml-output " + os.getenv("WORKSPACE", ".") +
+            LLVM_LIT_ARGS="--xunit-xml-output " + getenv("WORKSPACE", ".") +
                           "/lit-test-results.xml --max-time 3600 --timeout 120 -s -vv"
         )
         # select libcxxrt as the runtime library
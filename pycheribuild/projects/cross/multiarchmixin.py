@@ -28,7 +28,7 @@
 # SUCH DAMAGE.
 #
 
-from ...utils import getCompilerInfo, Type_T
+from ...utils import getCompilerInfo, Type_T, which
 from ..project import SimpleProject, Project
 from ...targets import targetManager, MultiArchTargetAlias
 from ...config.chericonfig import CrossCompileTarget, CheriConfig
@@ -78,7 +78,7 @@ class MultiArchBaseMixin(object):
         assert isinstance(self, SimpleProject)
 
     def get_host_triple(self):
-        compiler = getCompilerInfo(self.config.clangPath if self.config.clangPath else shutil.which("cc"))
+        compiler = getCompilerInfo(self.config.clangPath if self.config.clangPath else which("cc"))
         return compiler.default_target
 
     def compiling_for_mips(self):
@@ -284,7 +284,7 @@ class _BuildDiskImageBase(SimpleProject):
         # check that qemu-img exists before starting the potentially long-running makefs command
         qemuImgCommand = self.config.sdkDir / "bin/qemu-img"
         if not qemuImgCommand.is_file():
-            systemQemuImg = shutil.which("qemu-img")
+            systemQemuImg = which("qemu-img")
             if systemQemuImg:
                 print("qemu-img from CHERI SDK not found, falling back to system qemu-img")
                 qemuImgCommand = Path(systemQemuImg)
@@ -351,20 +351,20 @@ class _BuildDiskImageBase(SimpleProject):
 
     def process(self):
         if not IS_FREEBSD and self.crossBuildImage:
-            with setEnv(PATH=str(self.config.outputRoot / "freebsd-cross/bin") + ":" + os.getenv("PATH")):
+            with setEnv(PATH=str(self.config.outputRoot / "freebsd-cross/bin") + ":" + getenv("PATH")):
                 self.__process()
         else:
             self.__process()
 
     def __process(self):
-        self.makefs_cmd = shutil.which("freebsd-makefs")
-        self.install_cmd = shutil.which("freebsd-install")
+        self.makefs_cmd = which("freebsd-makefs")
+        self.install_cmd = which("freebsd-install")
         # On FreeBSD we can use /usr/bin/makefs and /usr/bin/install
         if IS_FREEBSD:
             if not self.install_cmd:
-                self.install_cmd = shutil.which("install")
+                self.install_cmd = which("install")
             if not self.makefs_cmd:
-                self.makefs_cmd = shutil.which("makefs")
+                self.makefs_cmd = which("makefs")
         if not self.makefs_cmd or not self.install_cmd:
             fatalError("Missing freebsd-install or freebsd-makefs command!")
         statusUpdate("Disk image will saved to", self.diskImagePath)
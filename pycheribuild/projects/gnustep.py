@@ -30,7 +30,6 @@
 from .project import *
 from ..utils import *
 
-import shutil
 from pathlib import Path
 
 # http://wiki.gnustep.org/index.php/GNUstep_under_Ubuntu_Linux
@@ -91,7 +90,7 @@ class GnuStepModule(AutotoolsProject):
         self._addRequiredPkgConfig("freetype2", apt="libfreetype6-dev")
 
     def configure(self):
-        if not shutil.which("gnustep-config"):
+        if not which("gnustep-config"):
             self.dependencyError("gnustep-config should have been installed in the last build step!")
             gnustepLibdir = Path("/invalid/path")
         else:
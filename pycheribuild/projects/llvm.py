@@ -28,7 +28,6 @@
 # SUCH DAMAGE.
 #
 from pathlib import Path
-import shutil
 from .project import *
 from ..utils import *
 
@@ -82,7 +81,7 @@ class BuildLLVM(CMakeProject):
             CMAKE_C_COMPILER=self.cCompiler,
             LLVM_TOOL_LLDB_BUILD=False,
             LLVM_TOOL_LLD_BUILD=not self.skip_lld,
-            LLVM_PARALLEL_LINK_JOBS=2 if self.enable_lto else 4,  # anything more causes too much I/O
+            LLVM_PARALLEL_LINK_JOBS=self.parallel_link_jobs,  # anything more causes too much I/O
         )
         if self.skip_static_analyzer:
             # save some build time by skipping the static analyzer
@@ -116,12 +115,22 @@ class BuildLLVM(CMakeProject):
                 version_suffix = self.cCompiler.name[len("clang"):]
             self._addRequiredSystemTool("llvm-ar" + version_suffix)
             self._addRequiredSystemTool("llvm-ranlib" + version_suffix)
-            llvm_ar = shutil.which("llvm-ar" + version_suffix)
-            llvm_ranlib = shutil.which("llvm-ranlib" + version_suffix)
+            llvm_ar = which("llvm-ar" + version_suffix)
+            llvm_ranlib = which("llvm-ranlib" + version_suffix)
             self.add_cmake_options(LLVM_ENABLE_LTO="Thin", CMAKE_AR=llvm_ar, CMAKE_RANLIB=llvm_ranlib)
             if not self.canUseLLd(self.cCompiler):
                 warningMessage("LLD not found for LTO build, it may fail.")
 
+    @property
+    def parallel_link_jobs(self):
+        return 2 if self.enable_lto else 4
+
+    def estimated_peak_memory_mb(self, phase: str):
+        if phase != "compile":
+            return 0
+        # Every link job can use several GB (a lot more with ThinLTO) in addition to the concurrent compile jobs
+        return self.parallel_link_jobs * (8 * 1024 if self.enable_lto else 3 * 1024) + self.config.makeJobsPerTarget * 512
+
     def clang38InstallHint(self):
         if IS_FREEBSD:
             return "Try running `pkg install clang38`"
@@ -27,13 +27,14 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import concurrent.futures
+import contextlib
 import copy
 import io
 import inspect
 import os
 import re
 import shlex
-import shutil
 import subprocess
 import sys
 import threading
@@ -48,7 +49,19 @@ from copy import deepcopy
 from ..config.loader import ConfigLoaderBase, ComputedDefaultValue, ConfigOptionBase
 from ..config.chericonfig import CheriConfig, CrossCompileTarget
 from ..targets import Target, MultiArchTarget, MultiArchTargetAlias, targetManager
+from ..buildlog import BuildLogWriter, index_path as buildlog_index_path
+from ..dashboard import get_dashboard
+from ..buildstate import BuildFingerprint, get_build_checkpoint, get_build_state_database, get_build_timing_database
+from ..buildstate import get_source_revision
 from ..filesystemutils import FileSystemUtils
+from ..jobserver import JobServer, get_jobserver
+from ..memoryadmission import get_memory_admission
+from ..probecache import get_probe_cache
+from ..systemdeps import get_system_dependency_checker
+from ..outputfilter import LineAction, OutputFilter, StatusLineWriter
+from ..processrunner import LineBufferedOutputHandler, get_process_runner
+from ..resourceusage import ResourceUsage, collect_resource_usage
+from ..tracing import trace_future, trace_span
 from ..utils import *
 
 __all__ = ["Project", "CMakeProject", "AutotoolsProject", "TargetAlias", "TargetAliasWithDependencies", # no-combine
@@ -200,11 +213,6 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         cls.__cached_deps = result
         return result
 
-    @classmethod
-    def _cached_dependencies(cls) -> "typing.List[Target]":
-        assert cls.__cached_deps is not None, "_cached_dependencies called before allDependencyNames()"
-        return cls.__cached_deps
-
     @classmethod
     def get_instance(cls: "typing.Type[Type_T]", caller: "typing.Optional[SimpleProject]", config: CheriConfig) -> "Type_T":
         # TODO: assert that target manager has been initialized
@@ -287,6 +295,87 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         self.__requiredSystemTools = {}  # type: typing.Dict[str, typing.Any]
         self.__requiredPkgConfig = {}  # type: typing.Dict[str, typing.Any]
         self._systemDepsChecked = False
+        self._missing_system_dependencies = False
+        self._source_revisions = dict()  # type: typing.Dict[Path, typing.Optional[str]]
+        # Duration of each phase of the build (used for scheduling and --estimate)
+        self.phase_timings = OrderedDict()  # type: typing.Dict[str, float]
+        self.phase_resource_usage = OrderedDict()  # type: typing.Dict[str, ResourceUsage]
+        self.skipped_as_up_to_date = False
+        self.logfiles = []  # type: typing.List[Path]
+        self._resumed_phases = []  # type: typing.List[str]
+
+    def estimated_peak_memory_mb(self, phase: str) -> int:
+        """
+        :return: How much memory (in MiB) the given phase of the build is expected to use at most. Memory intensive
+        projects should override this so that --parallel-targets does not run them at the same time.
+        """
+        return 0
+
+    def _peak_memory_mb(self, phase: str) -> int:
+        declared = self.estimated_peak_memory_mb(phase)
+        if phase != "compile":
+            return declared
+        # the maximum RSS of the last builds is a lower bound for the memory usage of the compile step
+        return max(declared, get_build_timing_database(self.config).peak_memory_mb(self.target))
+
+    def source_revision(self) -> "typing.Optional[str]":
+        """
+        :return: the git revision of the sources (including uncommitted changes) for the build fingerprints. Running
+        git diff is slow for large trees, so this is computed once and again only after the update step.
+        """
+        if self.sourceDir is None:
+            return None
+        if self.sourceDir not in self._source_revisions:
+            self._source_revisions[self.sourceDir] = get_source_revision(self.sourceDir)
+        return self._source_revisions[self.sourceDir]
+
+    def _fingerprint_dependencies(self) -> "typing.List[str]":
+        """:return: the names of the targets whose build state is part of the fingerprint of this target"""
+        return [t.name for t in self.recursive_dependencies(self.config) if issubclass(t.projectClass, Project)]
+
+    def checkpoint_inputs(self) -> str:
+        """:return: a digest of the inputs of this target that is used to check whether --resume can skip it"""
+        dependencies = self._fingerprint_dependencies()
+        fingerprint = BuildFingerprint.for_project(self, dependencies, get_build_state_database(self.config))
+        # The build state database is only updated with --skip-unchanged/--explain-rebuild -> also include the inputs
+        # that the dependencies were completed with, so that rebuilding a dependency in the resumed run invalidates
+        # the completed phases of this target
+        checkpoint = get_build_checkpoint(self.config)
+        fingerprint.components["checkpoint-dependencies"] = dict((dep, checkpoint.completed_inputs(dep))
+                                                                 for dep in dependencies)
+        return fingerprint.inputs_digest
+
+    def _load_resume_checkpoint(self):
+        if self.config.resume:
+            checkpoint = get_build_checkpoint(self.config)
+            self._resumed_phases = checkpoint.completed_phases(self.target, self.checkpoint_inputs())
+
+    def _phase_completed_before_resume(self, name: str) -> bool:
+        if name not in self._resumed_phases:
+            return False
+        statusUpdate("Skipping", name, "step of", self.display_name, "since it completed in the run that is resumed")
+        return True
+
+    @contextlib.contextmanager
+    def _run_phase(self, name: str):
+        admission = get_memory_admission()
+        required_memory = self._peak_memory_mb(name) if admission else 0
+        with contextlib.ExitStack() as stack:
+            if required_memory:
+                stack.enter_context(admission.reserve(required_memory, self.display_name + " " + name))
+            starttime = time.time()
+            dashboard = get_dashboard()
+            if dashboard is not None:
+                dashboard.phase_started(self.target, name)
+            usage = stack.enter_context(collect_resource_usage())
+            stack.enter_context(trace_span(self.target + " " + name, "phase", target=self.target, phase=name))
+            yield
+            self.phase_timings[name] = self.phase_timings.get(name, 0.0) + time.time() - starttime
+            self.phase_resource_usage.setdefault(name, ResourceUsage()).add(usage)
+        if name == "update":
+            self._source_revisions.clear()  # the update changes the source revision
+        if not self.config.pretend:
+            get_build_checkpoint(self.config).phase_completed(self.target, name, self.checkpoint_inputs())
 
     def _addRequiredSystemTool(self, executable: str, installInstructions=None, freebsd: str=None, apt: str=None,
                                zypper: str=None, homebrew: str=None, cheribuild_target: str=None):
@@ -303,6 +392,8 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
                                                                homebrew=homebrew, cheribuild_target=cheribuild_target)
         self.__requiredPkgConfig[package] = install_instructions
 
+    _query_lock = threading.Lock()
+
     def queryYesNo(self, message: str = "", *, defaultResult=False, forceResult=True, yesNoStr: str=None) -> bool:
         if yesNoStr is None:
             yesNoStr = " [Y]/n " if defaultResult else " y/[N] "
@@ -315,31 +406,13 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
             return forceResult
         if not sys.__stdin__.isatty():
             return defaultResult  # can't get any input -> return the default
-        result = input(message + yesNoStr)
+        # Don't mix up the questions of concurrently running targets (e.g. while updating all sources)
+        with self._query_lock:
+            result = input(message + yesNoStr)
         if defaultResult:
             return not result.startswith("n")  # if default is yes accept anything other than strings starting with "n"
         return str(result).lower().startswith("y")  # anything but y will be treated as false
 
-    @staticmethod
-    def _handleStdErr(outfile, stream, fileLock, project: "Project"):
-        for errLine in stream:
-            with fileLock:
-                try:
-                    # noinspection PyProtectedMember
-                    if project._lastStdoutLineCanBeOverwritten:
-                        sys.stdout.buffer.write(b"\n")
-                        flushStdio(sys.stdout)
-                        project._lastStdoutLineCanBeOverwritten = False
-                    sys.stderr.buffer.write(errLine)
-                    flushStdio(sys.stderr)
-                    if not project.config.noLogfile:
-                        outfile.write(errLine)
-                except ValueError:
-                    # Don't print a backtrace on ctrl+C (since that will exit the main thread and close the file)
-                    # ValueError: write to closed file
-                    continue
-
-
     def _lineNotImportantStdoutFilter(self, line: bytes):
         # by default we don't keep any line persistent, just have updating output
         if self._lastStdoutLineCanBeOverwritten:
@@ -356,11 +429,14 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         flushStdio(sys.stdout)
         self._lastStdoutLineCanBeOverwritten = False
 
-    def _stdoutFilter(self, line: bytes):
-        self._lineNotImportantStdoutFilter(line)
+    # Output filters can either be an OutputFilter table (preferred since the output is processed in batches) or a
+    # function that is called for every line. By default we don't keep any line persistent, just have updating output
+    _stdoutFilter = OutputFilter(LineAction.STATUS)
+    # The status line of filtered output is redrawn at most this many times per second
+    _statusLineRedrawsPerSecond = 10
 
     def runWithLogfile(self, args: "typing.Sequence[str]", logfileName: str, *, stdoutFilter=None, cwd: Path = None,
-                       env: dict = None, appendToLogfile=False) -> None:
+                       env: dict = None, appendToLogfile=False, pass_fds: "typing.Sequence[int]"=()) -> None:
         """
         Runs make and logs the output
         config.quiet doesn't display anything, normal only status updates and config.verbose everything
@@ -368,122 +444,130 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         :param args: the command to run (e.g. ["make", "-j32"])
         :param logfileName: the name of the logfile (e.g. "build.log")
         :param cwd the directory to run make in (defaults to self.buildDir)
-        :param stdoutFilter a filter to use for standard output (a function that takes a single bytes argument)
+        :param stdoutFilter a filter to use for standard output (an OutputFilter or a function that takes a single bytes
+        argument)
         :param env the environment to pass to make
+        :param pass_fds file descriptors that should be inherited by the command (e.g. the jobserver pipe)
+        """
+        self.start_with_logfile(args, logfileName, stdoutFilter=stdoutFilter, cwd=cwd, env=env,
+                                appendToLogfile=appendToLogfile, pass_fds=pass_fds).result()
+
+    def start_with_logfile(self, args: "typing.Sequence[str]", logfileName: str, *, stdoutFilter=None,
+                           cwd: Path = None, env: dict = None, appendToLogfile=False,
+                           pass_fds: "typing.Sequence[int]"=()) -> "concurrent.futures.Future":
+        """
+        Like runWithLogfile() but returns immediately. The output is handled by the shared ProcessRunner event loop.
+        :return: a future that completes when the command has exited (and raises SystemExit if the command failed).
+        Use asyncio.wrap_future() to await it in a coroutine.
         """
         printCommand(args, cwd=cwd, env=env)
-        # make sure that env is either None or a os.environ with the updated entries entries
-        if env:
-            newEnv = os.environ.copy()
-            env = {k: str(v) for k, v in env.items()}  # make sure everything is a string
-            newEnv.update(env)
-        else:
-            newEnv = None
+        # popen_handle_noexec() applies env (and the setEnv() overlay of this thread) to a copy of os.environ
+        newEnv = env or None
         assert not logfileName.startswith("/")
         if self.config.noLogfile:
             logfilePath = Path(os.devnull)
         else:
-            logfilePath = self.buildDir / (logfileName + ".log")
+            logfilePath = self.buildDir / (logfileName + (".log.gz" if self.config.compress_logs else ".log"))
             print("Saving build log to", logfilePath)
+            self.logfiles.append(logfilePath)
         if self.config.pretend:
-            return
+            result = concurrent.futures.Future()
+            result.set_result(0)
+            return result
         if self.config.verbose:
             stdoutFilter = None
 
-        if not self.config.noLogfile and logfilePath.is_file() and not appendToLogfile:
-            logfilePath.unlink()  # remove old logfile
+        if not self.config.noLogfile and not appendToLogfile:
+            # remove old logfiles (including ones written with a different --compress-logs setting) and their index
+            for old in (self.buildDir / (logfileName + ".log"), self.buildDir / (logfileName + ".log.gz")):
+                for path in (old, buildlog_index_path(old)):
+                    if path.is_file():
+                        path.unlink()
         args = list(map(str, args))  # make sure all arguments are strings
         cmdStr = " ".join([shlex.quote(s) for s in args])
+        runner = get_process_runner()
 
         if self.config.noLogfile:
-            if stdoutFilter is None:
+            dashboard = get_dashboard()
+            if dashboard is not None and dashboard.tty:
+                # all output must be written via the dashboard, otherwise it will overwrite the status rows
+                proc = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           env=newEnv, pass_fds=pass_fds)
+            elif stdoutFilter is None:
                 # just run the process connected to the current stdout/stdin
-                check_call_handle_noexec(args, cwd=str(cwd), env=newEnv)
+                proc = popen_handle_noexec(args, cwd=str(cwd), env=newEnv, pass_fds=pass_fds)
             else:
-                make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, env=newEnv)
-                self.__runProcessWithFilteredOutput(make, None, stdoutFilter, cmdStr)
-            return
+                proc = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, env=newEnv, pass_fds=pass_fds)
+            return trace_future(runner.start(proc, _CommandOutputHandler(self, None, stdoutFilter, cmdStr)),
+                                os.path.basename(args[0]), "command", argv=args, cwd=str(cwd), target=self.target)
 
         # open file in append mode
-        with logfilePath.open("ab") as logfile:
+        logfile = BuildLogWriter(logfilePath, compress=self.config.compress_logs, append=appendToLogfile)
+        try:
             # print the command and then the logfile
             if appendToLogfile:
                 logfile.write(b"\n\n")
             if cwd:
                 logfile.write(("cd " + shlex.quote(str(cwd)) + " && ").encode("utf-8"))
             logfile.write(cmdStr.encode("utf-8") + b"\n\n")
-            if self.config.quiet:
-                # a lot more efficient than filtering every line
-                check_call_handle_noexec(args, cwd=str(cwd), stdout=logfile, stderr=logfile, env=newEnv)
-                return
-            make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=newEnv)
-            self.__runProcessWithFilteredOutput(make, logfile, stdoutFilter, cmdStr)
-
-    def __runProcessWithFilteredOutput(self, proc: subprocess.Popen, logfile: "typing.Optional[typing.IO]",
-                                       stdoutFilter: "typing.Callable[[bytes], None]", cmdStr: str):
-        logfileLock = threading.Lock()  # we need a mutex so the logfile line buffer doesn't get messed up
-        stderrThread = None
-        if logfile:
-            # use a thread to print stderr output and write it to logfile (not using a thread would block)
-            stderrThread = threading.Thread(target=self._handleStdErr, args=(logfile, proc.stderr, logfileLock, self))
-            stderrThread.start()
-        for line in proc.stdout:
-            with logfileLock:  # make sure we don't interleave stdout and stderr lines
-                if logfile:
-                    logfile.write(line)
-                if stdoutFilter:
-                    stdoutFilter(line)
-                else:
-                    sys.stdout.buffer.write(line)
-                    flushStdio(sys.stdout)
-        retcode = proc.wait()
-        if stderrThread:
-            stderrThread.join()
-        # Not sure if the remaining call is needed
-        remainingErr, remainingOut = proc.communicate()
-        if remainingErr:
-            print("Process had remaining stderr:", remainingErr)
-            sys.stderr.buffer.write(remainingErr)
-            if logfile:
-                logfile.write(remainingOut)
-        if remainingOut:
-            print("Process had remaining stdout:", remainingOut)
-            sys.stdout.buffer.write(remainingOut)
-            if logfile:
-                logfile.write(remainingErr)
-        if stdoutFilter and self._lastStdoutLineCanBeOverwritten:
-            # add the final new line after the filtering
-            sys.stdout.buffer.write(b"\n")
-        if retcode:
-            message = "Command \"%s\" failed with exit code %d.\n" % (cmdStr, retcode)
-            if logfile:
-                message += "See " + logfile.name + " for details."
-            raise SystemExit(message)
+            logfile.flush()
+            if self.config.quiet and not self.config.compress_logs:
+                # a lot more efficient than filtering every line (the index is built once the log is closed)
+                proc = popen_handle_noexec(args, cwd=str(cwd), stdout=logfile.fileno(), stderr=logfile.fileno(),
+                                           env=newEnv, pass_fds=pass_fds)
+            else:
+                proc = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           env=newEnv, pass_fds=pass_fds)
+        except BaseException:
+            logfile.close()
+            raise
+        return trace_future(runner.start(proc, _CommandOutputHandler(self, logfile, stdoutFilter, cmdStr,
+                                                                     quiet=self.config.quiet)),
+                            os.path.basename(args[0]), "command", argv=args, cwd=str(cwd), target=self.target,
+                            logfile=str(logfilePath))
 
     def dependencyError(self, *args, installInstructions: str = None):
         self._systemDepsChecked = True  # make sure this is always set
+        self._missing_system_dependencies = True
+        checker = get_system_dependency_checker()
+        if checker.collecting_missing:
+            # TargetManager.run() reports the missing dependencies of all targets together
+            checker.add_missing(self.target, " ".join(map(str, args)), installInstructions)
+            return
         fatalError("Dependency for", self.target, "missing:", *args, fixitHint=installInstructions)
 
+    @property
+    def has_missing_system_dependencies(self) -> bool:
+        """
+        Whether dependencyError() has been called. While the missing dependencies of all targets are being collected
+        it doesn't abort, so overrides of checkSystemDependencies() must check this before running any of the tools.
+        """
+        return self._missing_system_dependencies
+
+    def system_dependency_probes(self) -> "typing.List[typing.Tuple[str, str]]":
+        """:return: the checks made by checkSystemDependencies() so that they can be started ahead of time"""
+        result = [("program", tool) for tool in self.__requiredSystemTools]
+        result.extend(("pkg-config", package) for package in self.__requiredPkgConfig)
+        return result
+
     def checkSystemDependencies(self) -> None:
         """
         Checks that all the system dependencies (required tool, etc) are available
         :return: Throws an error if dependencies are missing
         """
+        checker = get_system_dependency_checker()
         for (tool, installInstructions) in self.__requiredSystemTools.items():
-            if not shutil.which(tool):
+            if not checker.which(tool):
                 if callable(installInstructions):
                     installInstructions = installInstructions()
                 if not installInstructions:
                     installInstructions = "Try installing `" + tool + "` using your system package manager."
                 self.dependencyError("Required program", tool, "is missing!", installInstructions=installInstructions)
         for (package, instructions) in self.__requiredPkgConfig.items():
-            if not shutil.which("pkg-config"):
+            if not checker.which("pkg-config"):
                 # error should already have printed above
                 break
-            check_cmd = ["pkg-config", "--exists", package]
-            printCommand(check_cmd, printVerboseOnly=True)
-            exit_code = subprocess.call(check_cmd)
-            if exit_code != 0:
+            if not checker.has_pkg_config_package(package):
                 if callable(instructions):
                     instructions = instructions()
                 self.dependencyError("Required library", package, "is missing!", installInstructions=instructions)
@@ -598,7 +682,7 @@ class MakeOptions(object):
             self.__project._addRequiredSystemTool("make")
             return "make"
         elif self.kind == MakeCommandKind.GnuMake:
-            if IS_LINUX and not shutil.which("gmake"):
+            if IS_LINUX and not which("gmake"):
                 statusUpdate("Could not find `gmake` command, assuming `make` is GNU make")
                 self.__project._addRequiredSystemTool("make")
                 return "make"
@@ -687,6 +771,115 @@ class MakeOptions(object):
         return self.kind != MakeCommandKind.CustomMakeTool
 
 
+class _CommandOutputHandler(LineBufferedOutputHandler):
+    """Writes the output of a command started by SimpleProject.start_with_logfile() to the logfile and the terminal"""
+    def __init__(self, project: SimpleProject, logfile: "typing.Optional[BuildLogWriter]",
+                 stdoutFilter: "typing.Union[OutputFilter, typing.Callable[[bytes], None], None]", cmdStr: str,
+                 quiet=False):
+        super().__init__()
+        self.project = project
+        self.logfile = logfile
+        self.stdoutFilter = stdoutFilter
+        self.cmdStr = cmdStr
+        self.quiet = quiet
+        self._writer = None  # type: typing.Optional[StatusLineWriter]
+        self._dashboard = get_dashboard()
+        if self._dashboard is not None:
+            # The dashboard shows the status lines in the row of the target instead of overwriting the last line.
+            # Filter functions can't be used since they write directly to stdout -> use the default filter instead.
+            if stdoutFilter is not None and not isinstance(stdoutFilter, OutputFilter):
+                # noinspection PyProtectedMember
+                self.stdoutFilter = SimpleProject._stdoutFilter
+        elif isinstance(stdoutFilter, OutputFilter) and not quiet:
+            # noinspection PyProtectedMember
+            self._writer = StatusLineWriter(sys.stdout.buffer, Project._clearLineSequence,
+                                            max_redraws_per_second=SimpleProject._statusLineRedrawsPerSecond,
+                                            flush=lambda: flushStdio(sys.stdout))
+
+    def stdout_data(self, data: bytes):
+        if self.quiet:
+            self.logfile.write(data)  # a lot more efficient than filtering every line
+        elif self._dashboard:
+            lines = self._split("stdout", data)
+            if self.logfile:
+                self.logfile.write(b"".join(lines))
+            self._dashboard.command_output(self.project.target, self.stdoutFilter, lines)
+        elif self._writer:
+            self._write_filtered(self._split("stdout", data))
+        elif self.stdoutFilter:
+            super().stdout_data(data)  # legacy filter functions are called for every line
+        else:
+            self.stdout_line(data)
+
+    def _write_filtered(self, lines: "typing.List[bytes]"):
+        if self.logfile:
+            self.logfile.write(b"".join(lines))
+        # noinspection PyProtectedMember
+        self._writer.status_line_visible = self.project._lastStdoutLineCanBeOverwritten
+        self._writer.write_lines(self.stdoutFilter, lines)
+        self.project._lastStdoutLineCanBeOverwritten = self._writer.status_line_visible
+
+    def stdout_line(self, line: bytes):
+        if self._dashboard:
+            if self.logfile:
+                self.logfile.write(line)
+            self._dashboard.command_output(self.project.target, self.stdoutFilter, [line])
+            return
+        if self._writer:
+            self._write_filtered([line])
+            return
+        if self.logfile:
+            self.logfile.write(line)
+        if self.stdoutFilter:
+            self.stdoutFilter(line)
+        else:
+            sys.stdout.buffer.write(line)
+            flushStdio(sys.stdout)
+
+    def _end_status_line(self):
+        if self._writer:
+            self._writer.end_status_line()
+        # noinspection PyProtectedMember
+        elif self.project._lastStdoutLineCanBeOverwritten:
+            sys.stdout.buffer.write(b"\n")
+            flushStdio(sys.stdout)
+        self.project._lastStdoutLineCanBeOverwritten = False
+
+    def stderr_data(self, data: bytes):
+        if self.quiet:
+            self.logfile.write(data)
+        else:
+            super().stderr_data(data)
+
+    def stderr_line(self, line: bytes):
+        if self._dashboard:
+            self._dashboard.command_error(self.project.target, line)
+            if self.logfile:
+                self.logfile.write(line)
+            return
+        self._end_status_line()
+        sys.stderr.buffer.write(line)
+        flushStdio(sys.stderr)
+        if self.logfile:
+            self.logfile.write(line)
+
+    def finished(self, returncode: int):
+        try:
+            super().finished(returncode)
+            if self.stdoutFilter and not self.quiet and not self._dashboard:
+                # add the final new line after the filtering
+                self._end_status_line()
+        finally:
+            if self.logfile:
+                self.logfile.close()
+        if returncode:
+            message = "Command \"%s\" failed with exit code %d.\n" % (self.cmdStr, returncode)
+            if self.logfile:
+                message += "See " + self.logfile.name + " for details (or run `cheribuild.py --show-log-errors " + \
+                           self.project.target + "` to show the first error)."
+            raise SystemExit(message)
+
+
 class Project(SimpleProject):
     repository = ""
     gitRevision = None
@@ -777,15 +970,22 @@ class Project(SimpleProject):
         if IS_MAC:
             return False  # lld does not work on MacOS
         if compiler not in cls.__can_use_lld_map:
-            try:
-                runCmd([compiler, "-fuse-ld=lld", "-xc", "-o", "/dev/null", "-"], runInPretendMode=True,
-                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, raiseInPretendMode=True,
-                       input="int main() { return 0; }\n", printVerboseOnly=True)
+            def probe_lld() -> bool:
+                try:
+                    runCmd([compiler, "-fuse-ld=lld", "-xc", "-o", "/dev/null", "-"], runInPretendMode=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, raiseInPretendMode=True,
+                           input="int main() { return 0; }\n", printVerboseOnly=True)
+                    return True
+                except subprocess.CalledProcessError:
+                    return False
+            # Note: this depends on the ld.lld found in $PATH, not just the compiler binary
+            lld = which("ld.lld")
+            cls.__can_use_lld_map[compiler] = get_probe_cache().get("fuse-ld=lld", compiler, probe_lld,
+                                                                    args=[lld or ""], dependencies=[lld] if lld else [])
+            if cls.__can_use_lld_map[compiler]:
                 statusUpdate(compiler, "supports -fuse-ld=lld, linking should be much faster!")
-                cls.__can_use_lld_map[compiler] = True
-            except subprocess.CalledProcessError:
+            else:
                 statusUpdate(compiler, "does not support -fuse-ld=lld, using slower bfd instead")
-                cls.__can_use_lld_map[compiler] = False
         return cls.__can_use_lld_map[compiler]
 
     @classmethod
@@ -847,6 +1047,10 @@ class Project(SimpleProject):
             self._addRequiredSystemTool("bear", installInstructions="Run `cheribuild.py bear`")
         self._lastStdoutLineCanBeOverwritten = False
         self.make_args = MakeOptions(self.make_kind, self)
+        # The sources may be updated by the SourceUpdateStage thread pool before process() is called
+        self._update_lock = threading.Lock()
+        self._update_result = None  # type: typing.Union[None, bool, BaseException]
+        self.updated_in_background = False  # update commands were not run by the thread that builds the target
         self._preventAssign = True
 
     _no_overwrite_allowed = ("configureArgs", "configureEnvironment", "make_args")
@@ -868,8 +1072,8 @@ class Project(SimpleProject):
     def _ensureGitRepoIsCloned(self, *, srcDir: Path, remoteUrl, initialBranch=None, skipSubmodules=False):
         # git-worktree creates a .git file instead of a .git directory so we can't use .is_dir()
         if not (srcDir / ".git").exists():
-            print(srcDir, "is not a git repository. Clone it from' " + remoteUrl + "'?", end="")
-            if not self.queryYesNo(defaultResult=False):
+            if not self.queryYesNo(str(srcDir) + " is not a git repository. Clone it from '" + remoteUrl + "'?",
+                                   defaultResult=False):
                 fatalError("Sources for", str(srcDir), " missing!")
             cloneCmd = ["git", "clone"]
             if not skipSubmodules:
@@ -887,7 +1091,7 @@ class Project(SimpleProject):
 
         pullCmd = ["git", "pull"]
         has_autostash = False
-        git_version = get_program_version(Path(shutil.which("git"))) if shutil.which("git") else (0, 0, 0)
+        git_version = get_program_version(Path(which("git"))) if which("git") else (0, 0, 0)
         # Use the autostash flag for Git >= 2.14 (https://stackoverflow.com/a/30209750/894271)
         if git_version >= (2, 14):
             has_autostash = True
@@ -922,7 +1126,9 @@ class Project(SimpleProject):
 
     def runMake(self, makeTarget="", *, make_command: str = None, options: MakeOptions=None, logfileName: str = None,
                 cwd: Path = None, appendToLogfile=False, compilationDbName="compile_commands.json",
-                parallel: bool=True, stdoutFilter: "typing.Callable[[bytes], None]" = _default_stdout_filter) -> None:
+                parallel: bool=True,
+                stdoutFilter: "typing.Union[OutputFilter, typing.Callable[[bytes], None]]" = _default_stdout_filter
+                ) -> None:
         if not make_command:
             make_command = self.make_args.command
         if not options:
@@ -938,13 +1144,28 @@ class Project(SimpleProject):
             allArgs = options.all_commandline_args
             if not logfileName:
                 logfileName = Path(make_command).name
+        env = options.env_vars
+        jobserver = get_jobserver()
+        job_slots = 0  # the number of jobserver slots that are held while the command is running
+        pass_fds = ()
         if parallel and options.can_pass_jflag:
-            allArgs.append(self.config.makeJFlag)
+            jobserver_args = self._jobserver_args(jobserver, options.kind, make_command) if jobserver else None
+            if jobserver_args is None:
+                allArgs.append(self.config.makeJFlag)
+                # Tools that can't use the jobserver (e.g. ninja) still have to stay within the shared budget
+                # -> hold all the job slots of the -j flag until they exit
+                job_slots = self.config.makeJobsPerTarget
+            else:
+                allArgs.extend(jobserver_args[0])
+                env = env.copy()
+                env.update(jobserver_args[1])
+                job_slots = 1  # the implicit job slot of the make process
+                pass_fds = jobserver.pass_fds
 
         allArgs = [make_command] + allArgs
         # TODO: use compdb instead for GNU make projects?
         if self.config.create_compilation_db and self.compileDBRequiresBear:
-            allArgs = [shutil.which("bear"), "--cdb", self.buildDir / compilationDbName,
+            allArgs = [which("bear"), "--cdb", self.buildDir / compilationDbName,
                        "--append"] + allArgs
         if not self.config.makeWithoutNice:
             allArgs = ["nice"] + allArgs
@@ -964,14 +1185,47 @@ class Project(SimpleProject):
             if make_command == "ninja":
                 # ninja needs the maximum number of failed jobs as an argument
                 allArgs.append("50")
-        env = options.env_vars
-        self.runWithLogfile(allArgs, logfileName=logfileName, stdoutFilter=stdoutFilter, cwd=cwd, env=env,
-                            appendToLogfile=appendToLogfile)
+        with collect_resource_usage() as usage:
+            if jobserver is not None and job_slots and not self.config.pretend:
+                with jobserver.reserve(job_slots):
+                    self.runWithLogfile(allArgs, logfileName=logfileName, stdoutFilter=stdoutFilter, cwd=cwd,
+                                        env=env, appendToLogfile=appendToLogfile, pass_fds=pass_fds)
+            else:
+                self.runWithLogfile(allArgs, logfileName=logfileName, stdoutFilter=stdoutFilter, cwd=cwd, env=env,
+                                    appendToLogfile=appendToLogfile)
         # if we create a compilation db, copy it to the source dir:
         if self.config.copy_compilation_db_to_source_dir and (self.buildDir / compilationDbName).exists():
             self.installFile(self.buildDir / compilationDbName, self.sourceDir / compilationDbName, force=True)
         # add a newline at the end in case it ended with a filtered line (no final newline)
-        print("Running", make_command, makeTarget, "took", time.time() - starttime, "seconds")
+        duration = time.time() - starttime
+        print("Running", make_command, makeTarget, "took", duration, "seconds")
+        if usage.processes:
+            print("  ", usage.summary(duration))
+
+    @staticmethod
+    def _jobserver_args(jobserver: JobServer, kind: MakeCommandKind, make_command: str
+                        ) -> "typing.Optional[typing.Tuple[typing.List[str], typing.Dict[str, str]]]":
+        """
+        :return: the additional command line flags and environment variables needed to make the command use the
+        jobserver or None if the tool does not support it (in that case it should be passed a -j flag instead)
+        """
+        if kind == MakeCommandKind.DefaultMake:
+            kind = MakeCommandKind.BsdMake if IS_FREEBSD else MakeCommandKind.GnuMake
+        if kind == MakeCommandKind.BsdMake:
+            return jobserver.bsd_make_args(), {}
+        # ninja (since 1.13) only accepts a named FIFO jobserver on POSIX and ignores inherited pipe fds so it has
+        # to be passed a -j flag instead (runMake() holds the corresponding number of job slots)
+        if kind != MakeCommandKind.GnuMake:
+            return None
+        tool = which(make_command)
+        if not tool:
+            return None
+        try:
+            version = get_program_version(Path(tool), regex=b"GNU Make (\\d+)\\.(\\d+)\\.?(\\d+)?")
+            return [], {"MAKEFLAGS": jobserver.gnu_makeflags(legacy_fds_flag=version < (4, 2))}
+        except (ValueError, TypeError, subprocess.CalledProcessError) as e:
+            warningMessage("Could not determine whether", make_command, "supports the jobserver:", e)
+        return None
 
     def update(self):
         if not self.repository:
@@ -1002,7 +1256,7 @@ class Project(SimpleProject):
         """
         return True
 
-    def configure(self, cwd: Path = None, configure_path: Path=None):
+    def configure(self, cwd: Path = None, configure_path: Path=None, pass_fds: "typing.Sequence[int]"=()):
         if cwd is None:
             cwd = self.buildDir
         if not self.needsConfigure() and not self.config.configureOnly and not self.config.forceConfigure:
@@ -1014,7 +1268,7 @@ class Project(SimpleProject):
             _configure_path = configure_path
         if _configure_path:
             self.runWithLogfile([_configure_path] + self.configureArgs,
-                                logfileName="configure", cwd=cwd, env=self.configureEnvironment)
+                                logfileName="configure", cwd=cwd, env=self.configureEnvironment, pass_fds=pass_fds)
 
     def compile(self, cwd: Path = None):
         if cwd is None:
@@ -1089,6 +1343,55 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
     def display_name(self):
         return self.projectName
 
+    def _check_build_state(self) -> "typing.Tuple[typing.Optional[BuildFingerprint], bool]":
+        """
+        :return: The current fingerprint of this target (if --skip-unchanged or --explain-rebuild was passed) and
+        whether the target can be skipped because it is up-to-date
+        """
+        if not self.config.skip_unchanged and not self.config.explain_rebuild:
+            return None, False
+        state = get_build_state_database(self.config)
+        fingerprint = BuildFingerprint.for_project(self, self._fingerprint_dependencies(), state)
+        reasons = state.check(self.target, fingerprint)
+        if not self.config.skipInstall:
+            install_dir = self.real_install_root_dir
+            if not state.was_installed(self.target):
+                reasons.append("the last build was run with --skip-install")
+            elif install_dir is not None and not Path(str(install_dir)).exists():
+                reasons.append("install directory " + str(install_dir) + " does not exist")
+        if self.config.clean:
+            reasons.insert(0, "--clean was passed")
+        elif self.config.forceConfigure:
+            reasons.insert(0, "--reconfigure was passed")
+        if not reasons:
+            if not self.config.skip_unchanged:
+                statusUpdate(self.display_name, "is up-to-date, rebuilding since --skip-unchanged was not passed")
+            return fingerprint, self.config.skip_unchanged
+        if self.config.explain_rebuild:
+            statusUpdate("Rebuilding", self.display_name, "because", "; ".join(reasons))
+        return fingerprint, False
+
+    def update_sources(self, in_background=False):
+        """
+        Run the update step (unless --skip-update was passed or it completed in the resumed run). This is called
+        concurrently for all targets by the SourceUpdateStage so it only runs once and repeats the first error.
+        """
+        with self._update_lock:
+            if isinstance(self._update_result, BaseException):
+                raise self._update_result
+            if self._update_result:
+                return
+            self.updated_in_background = in_background
+            try:
+                self._load_resume_checkpoint()
+                if not self.config.skipUpdate and not self._phase_completed_before_resume("update"):
+                    with self._run_phase("update"):
+                        self.update()
+                self._update_result = True
+            except BaseException as e:
+                self._update_result = e
+                raise
+
     def process(self):
         if self.generate_cmakelists:
             self._do_generate_cmakelists()
@@ -1098,28 +1401,45 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                 installDir = str(self.destdir) + str(self.installPrefix)
             print(self.projectName, "directories: source=%s, build=%s, install=%s" %
                   (self.sourceDir, self.buildDir, installDir))
-        if not self.config.skipUpdate:
-            self.update()
+        self.update_sources()
+        # The sources may have been updated before the dependencies were built -> check the completed phases again
+        self._load_resume_checkpoint()
         if not self._systemDepsChecked:
             self.checkSystemDependencies()
         assert self._systemDepsChecked, "self._systemDepsChecked must be set by now!"
+        fingerprint, up_to_date = self._check_build_state()
+        if up_to_date:
+            statusUpdate("Skipping", self.display_name, "since it is up-to-date")
+            self.skipped_as_up_to_date = True
+            return
 
         # run the rm -rf <build dir> in the background
-        cleaningTask = self.clean() if self.config.clean else ThreadJoiner(None)
+        # When resuming after the configure step the build directory must not be removed
+        resuming_build = any(p in self._resumed_phases for p in ("configure", "compile", "install"))
+        cleaningTask = self.clean() if self.config.clean and not resuming_build else ThreadJoiner(None)
         assert isinstance(cleaningTask, ThreadJoiner), ""
         with cleaningTask:
             if not self.buildDir.is_dir():
                 self.makedirs(self.buildDir)
-            if not self.config.skipConfigure or self.config.configureOnly:
+            if (not self.config.skipConfigure or self.config.configureOnly) and \
+                    not self._phase_completed_before_resume("configure"):
                 statusUpdate("Configuring", self.display_name, "... ")
-                self.configure()
+                with self._run_phase("configure"):
+                    self.configure()
             if self.config.configureOnly:
                 return
-            statusUpdate("Building", self.display_name, "... ")
-            self.compile()
-            if not self.config.skipInstall:
+            if not self._phase_completed_before_resume("compile"):
+                statusUpdate("Building", self.display_name, "... ")
+                with self._run_phase("compile"):
+                    self.compile()
+            if not self.config.skipInstall and not self._phase_completed_before_resume("install"):
                 statusUpdate("Installing", self.display_name, "... ")
-                self.install()
+                with self._run_phase("install"):
+                    self.install()
+        # All phases have completed (either now or before --resume) -> the build outputs match the fingerprint
+        if fingerprint is not None and not self.config.pretend:
+            get_build_state_database(self.config).record(self.target, fingerprint,
+                                                         installed=not self.config.skipInstall)
 
 
 class CMakeProject(Project):
@@ -1149,7 +1469,7 @@ class CMakeProject(Project):
 
     def __init__(self, config, generator=Generator.Ninja):
         super().__init__(config)
-        self.configureCommand = os.getenv("CMAKE_COMMAND", "cmake")
+        self.configureCommand = getenv("CMAKE_COMMAND", "cmake")
         self._addRequiredSystemTool("cmake", homebrew="cmake", zypper="cmake", apt="cmake", freebsd="cmake")
         self.generator = generator
         self.configureArgs.append(str(self.sourceDir))  # TODO: use undocumented -H and -B options?
@@ -1176,11 +1496,8 @@ class CMakeProject(Project):
     def set_minimum_cmake_version(self, major, minor):
         self.__minimum_cmake_version = (major, minor)
 
-    def _cmakeInstallStdoutFilter(self, line: bytes):
-        # don't show the up-to date install lines
-        if line.startswith(b"-- Up-to-date:"):
-            return
-        self._showLineStdoutFilter(line)
+    # don't show the up-to date install lines
+    _cmakeInstallStdoutFilter = OutputFilter(LineAction.SHOW, prefixes={b"-- Up-to-date:": LineAction.HIDE})
 
     def needsConfigure(self) -> bool:
         if self.config.pretend and (self.config.forceConfigure or self.config.clean):
@@ -1221,11 +1538,11 @@ class CMakeProject(Project):
 
     def checkSystemDependencies(self):
         if not Path(self.configureCommand).is_absolute():
-            abspath = shutil.which(self.configureCommand)
+            abspath = which(self.configureCommand)
             if abspath:
                 self.configureCommand = abspath
         super().checkSystemDependencies()
-        if self.__minimum_cmake_version:
+        if self.__minimum_cmake_version and not self.has_missing_system_dependencies:
             # try to find cmake 3.4 or newer
             versionComponents = self._get_cmake_version()
             # noinspection PyTypeChecker
@@ -1239,12 +1556,8 @@ class CMakeProject(Project):
 
     @staticmethod
     def findPackage(name: str) -> bool:
-        try:
-            cmd = "cmake --find-package -DCOMPILER_ID=Clang -DLANGUAGE=CXX -DMODE=EXIST -DQUIET=TRUE".split()
-            cmd.append("-DNAME=" + name)
-            return runCmd(cmd).returncode == 0
-        except subprocess.CalledProcessError:
-            return False
+        # memoised for the whole run
+        return get_system_dependency_checker().has_cmake_package(name)
 
 
 class AutotoolsProject(Project):
@@ -29,7 +29,7 @@
 #
 import os
 from .project import *
-from ..utils import runCmd, setEnv, coloured, AnsiColour
+from ..utils import runCmd, setEnv, getenv, coloured, AnsiColour
 from subprocess import CalledProcessError
 import shlex
 
@@ -111,7 +111,7 @@ make -C cheri cheri128""")
         ottdir = BuildOtt.getSourceDir(self, self.config)
         linksemdir = BuildLinksem.getSourceDir(self, self.config)
         with setEnv(LEMLIB= lemdir / "library",
-                    PATH="{}:{}:".format(ottdir / "bin", lemdir / "bin") + os.environ["PATH"],
+                    PATH="{}:{}:".format(ottdir / "bin", lemdir / "bin") + getenv("PATH"),
                     OCAMLPATH="{}:{}".format(lemdir / "ocaml-lib/local", linksemdir / "src/local")
                     ):
             super().process()
@@ -151,7 +151,7 @@ make -C src USE_OCAMLBUILD=false local-install
         ottdir = BuildOtt.getSourceDir(self, self.config)
         # linksemdir = BuildLinkSem.getSourceDir(self, self.config)
         with setEnv(LEMLIB= lemdir / "library",
-                    PATH="{}:{}:".format(ottdir / "bin", lemdir / "bin") + os.environ["PATH"],
+                    PATH="{}:{}:".format(ottdir / "bin", lemdir / "bin") + getenv("PATH"),
                     OCAMLPATH=lemdir / "ocaml-lib/local"):
             super().process()
 
@@ -29,7 +29,7 @@
 #
 
 from .project import *
-from ..utils import runCmd, setEnv, coloured, AnsiColour, IS_MAC
+from ..utils import runCmd, setEnv, getenv, coloured, AnsiColour, IS_MAC
 import os
 
 SMB_OUT_OF_SOURCE_BUILD_WORKS = False
@@ -97,8 +97,8 @@ class BuildSamba(Project):
 
     def process(self):
         if SMB_OUT_OF_SOURCE_BUILD_WORKS and IS_MAC:
-            with setEnv(PATH="/usr/local/opt/krb5/bin:/usr/local/opt/krb5/sbin:" + os.getenv("PATH", ""),
-                        PKG_CONFIG_PATH="/usr/local/opt/krb5/lib/pkgconfig:" + os.getenv("PKG_CONFIG_PATH", "")):
+            with setEnv(PATH="/usr/local/opt/krb5/bin:/usr/local/opt/krb5/sbin:" + getenv("PATH", ""),
+                        PKG_CONFIG_PATH="/usr/local/opt/krb5/lib/pkgconfig:" + getenv("PKG_CONFIG_PATH", "")):
                 super().process()
         else:
             super().process()
@@ -30,7 +30,6 @@
 import os
 import subprocess
 import datetime
-import shutil
 
 from .cross.cheribsd import BuildCHERIBSD
 from .project import *
@@ -93,7 +92,7 @@ class BuildFreestandingSdk(SimpleProject):
             for tool in set(toolsToSymlink):
                 self.createBuildtoolTargetSymlinks(sdkBinDir / tool)
             # For some reason CheriBSD does not build a cross ar, let's symlink the system one to the SDK bindir
-            runCmd("ln", "-fsn", shutil.which("ar"), sdkBinDir / "ar",
+            runCmd("ln", "-fsn", which("ar"), sdkBinDir / "ar",
                    cwd=self.config.sdkDir / "bin", printVerboseOnly=True)
             self.createBuildtoolTargetSymlinks(sdkBinDir / "ar")
             # install ld as ld.bfd and add a symlink
@@ -168,9 +167,9 @@ class StartCheriSDKShell(SimpleProject):
     target = "sdk-shell"
 
     def process(self):
-        newManPath = str(self.config.sdkDir / "share/man") + ":" + os.getenv("MANPATH", "") + ":"
+        newManPath = str(self.config.sdkDir / "share/man") + ":" + getenv("MANPATH", "") + ":"
         newPath = str(self.config.sdkDir / "bin") + ":" + str(self.config.dollarPathWithOtherTools)
-        shell = os.getenv("SHELL", "/bin/sh")
+        shell = getenv("SHELL", "/bin/sh")
         with setEnv(MANPATH=newManPath, PATH=newPath):
             statusUpdate("Starting CHERI SDK shell... ", end="")
             try:
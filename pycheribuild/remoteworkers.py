@@ -0,0 +1,226 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import json
+import os
+import queue
+import shlex
+import sys
+import tempfile
+import threading
+from pathlib import Path, PurePosixPath
+
+from .config.chericonfig import CheriConfig, MyJsonEncoder
+from .targets import Target, TargetScheduler
+from .utils import typing, runCmd, setEnv, statusUpdate, warningMessage
+
+
+class RemoteWorker(object):
+    """
+    A host that targets can be built on. The worker spec is HOST[:DIRECTORY]; all files are stored in DIRECTORY
+    (relative to the home directory unless absolute). A worker named "localhost" runs the commands directly
+    (without ssh) which is useful for testing.
+    """
+    def __init__(self, spec: str, default_dir: str):
+        host, _, directory = spec.partition(":")
+        self.host = host
+        self.is_local = host == "localhost"
+        directory = directory or default_dir
+        if self.is_local:
+            directory = os.path.join(os.path.expanduser("~"), os.path.expanduser(directory))
+        self.root = PurePosixPath(directory)
+        self._prepared = False
+        self.lock = threading.Lock()
+
+    def path(self, *parts) -> str:
+        return str(self.root.joinpath(*parts))
+
+    def _rsync_location(self, path: str) -> str:
+        return path if self.is_local else self.host + ":" + path
+
+    def run(self, *args, **kwargs):
+        if self.is_local:
+            return runCmd(*args, **kwargs)
+        # ssh concatenates the arguments and passes them to the remote shell -> quote them
+        return runCmd(["ssh", self.host, "--", " ".join(shlex.quote(str(a)) for a in args)], **kwargs)
+
+    def push(self, local: Path, remote: str, delete=False):
+        self.run("mkdir", "-p", str(PurePosixPath(remote).parent))
+        suffix = "" if local.is_file() else "/"  # copy the contents of directories
+        runCmd(["rsync", "-a"] + (["--delete"] if delete else []) +
+               [str(local) + suffix, self._rsync_location(remote) + suffix])
+
+    def pull(self, remote: str, local: Path):
+        os.makedirs(str(local), exist_ok=True)
+        # Don't pass --delete: other targets may have installed files into the same directory (e.g. the SDK)
+        runCmd("rsync", "-a", self._rsync_location(remote) + "/", str(local) + "/")
+
+    def __repr__(self):
+        return "<RemoteWorker " + self.host + ":" + str(self.root) + ">"
+
+
+class WorkerPool(object):
+    """
+    Dispatches whole targets to a pool of worker hosts: The sources of the target and the SDK/sysroot are copied to the
+    worker, the target is built there using a copy of cheribuild and the install directory is copied back.
+    """
+    # These options must not be forwarded since they would result in the worker building the wrong thing
+    _local_only_options = ("source-root", "build-root", "output-root", "remote-worker", "remote-worker-dir",
+                           "parallel-targets", "make-jobs", "jobserver", "memory-budget", "get-config-option",
+                           "action", "include-dependencies", "skip-update", "force")
+
+    def __init__(self, config: CheriConfig, specs: "typing.List[str]"):
+        self.config = config
+        self.workers = [RemoteWorker(spec, config.remote_worker_dir) for spec in specs]
+        self._idle = queue.Queue()
+        for w in self.workers:
+            self._idle.put(w)
+        self._options = self.forwarded_options()
+
+    def forwarded_options(self) -> "typing.Dict[str, typing.Any]":
+        """:return: all options that were set in the config file or on the command line"""
+        result = dict()
+        loader = self.config.loader
+        for name, option in loader.options.items():
+            if name in self._local_only_options:
+                continue
+            # noinspection PyProtectedMember
+            if option._loadOptionImpl(self.config, option.fullOptionName) is None:
+                continue  # default value -> the worker can compute it
+            # noinspection PyProtectedMember
+            result[name] = option.__get__(self.config, option._owningClass if option._owningClass else self.config)
+        result["include-dependencies"] = False
+        result["skip-update"] = True  # The sources have already been updated and copied to the worker
+        result["force"] = True
+        return result
+
+    def worker_config(self, worker: RemoteWorker) -> "typing.Dict[str, typing.Any]":
+        """
+        :return: the forwarded options with paths remapped to the worker's directory. The paths must include
+        worker.root since relative paths would be resolved against the working directory of the command on the worker.
+        """
+        result = dict()
+        for name, value in self._options.items():
+            if isinstance(value, Path):
+                value = self.remote_path(worker.root, value) or value
+            result[name] = value
+        return result
+
+    def remote_path(self, root: PurePosixPath, local: Path) -> "typing.Optional[str]":
+        roots = ((self.config.sourceRoot, "source"), (self.config.buildRoot, "build"), (self.config.outputRoot, "output"))
+        # The build and output root are inside the source root by default -> check the most specific one first
+        for local_root, name in sorted(roots, key=lambda r: len(r[0].parts), reverse=True):
+            try:
+                return str(root / name / local.relative_to(local_root))
+            except ValueError:
+                continue
+        return None
+
+    def can_run_remotely(self, target: Target, project) -> bool:
+        # Pseudo targets (e.g. the sdk aliases) are cheap and always build their dependencies -> run them locally
+        if target.projectClass.dependenciesMustBeBuilt or target.projectClass.isAlias:
+            return False
+        if getattr(project, "sourceDir", None) is None or getattr(project, "installDir", None) is None:
+            return False
+        # Only the source, build and output root are forwarded so the results could not be copied back
+        if self.remote_path(PurePosixPath(), project.installDir) is None:
+            warningMessage("Building", target.name, "locally since its install directory", project.installDir,
+                           "is not inside the source, build or output root")
+            return False
+        return True
+
+    def _prepare(self, worker: RemoteWorker):
+        with worker.lock:
+            if worker._prepared:
+                return
+            statusUpdate("Setting up build worker", worker.host)
+            worker.run("mkdir", "-p", worker.path("source"), worker.path("build"), worker.path("output"))
+            cheribuild_dir = Path(__file__).resolve().parent.parent
+            if (cheribuild_dir / "pycheribuild").is_dir():
+                worker.push(cheribuild_dir / "pycheribuild", worker.path("pycheribuild"), delete=True)
+                worker.push(cheribuild_dir / "cheribuild.py", worker.path("cheribuild.py"))
+            else:
+                # running the single-file version created by combine-files.py
+                worker.push(Path(sys.argv[0]).resolve(), worker.path("cheribuild.py"))
+            with tempfile.NamedTemporaryFile("w", prefix="cheribuild-worker-", suffix=".json") as f:
+                json.dump(self.worker_config(worker), f, cls=MyJsonEncoder, sort_keys=True, indent=4)
+                f.flush()
+                worker.push(Path(f.name), worker.path("cheribuild.json"))
+            worker._prepared = True
+
+    def _inputs(self, target: Target) -> "typing.List[Path]":
+        project = target.get_or_create_project(None, self.config)
+        # the SDK (which includes the sysroot) and all other install directories of the dependencies:
+        candidates = [self.config.sdkDir]
+        for dep in target.get_dependencies(self.config):
+            dep_project = dep.get_or_create_project(None, self.config)
+            if getattr(dep_project, "installDir", None) is not None:
+                candidates.append(dep_project.installDir)
+        outputs = []  # type: typing.List[Path]
+        for path in sorted(set(candidates), key=lambda p: len(p.parts)):
+            if not path.exists() or self.remote_path(PurePosixPath(), path) is None:
+                continue
+            # don't copy directories that are already included in another one
+            if not any(path == p or p in path.parents for p in outputs):
+                outputs.append(path)
+        return [project.sourceDir] + outputs
+
+    def execute(self, target: Target):
+        worker = self._idle.get()
+        try:
+            self._prepare(worker)
+            project = target.get_or_create_project(None, self.config)
+            # The worker doesn't update the sources -> make sure the local copy is up-to-date before copying it
+            with setEnv(**Target.build_environment(self.config)):
+                project.update_sources()
+            statusUpdate("Building", target.name, "on", worker.host)
+            for i, path in enumerate(self._inputs(target)):
+                worker.push(path, self.remote_path(worker.root, path), delete=(i == 0))
+            worker.run("python3", worker.path("cheribuild.py"), "--config-file", worker.path("cheribuild.json"),
+                       "--source-root", worker.path("source"), "--build-root", worker.path("build"),
+                       "--output-root", worker.path("output"), target.name)
+            remote_install_dir = self.remote_path(worker.root, project.installDir)
+            assert remote_install_dir is not None, "can_run_remotely() should have returned False"
+            worker.pull(remote_install_dir, project.installDir)
+        finally:
+            self._idle.put(worker)
+
+
+class RemoteTargetScheduler(TargetScheduler):
+    """Like TargetScheduler but builds targets on the remote workers (pseudo targets are run locally)"""
+    def __init__(self, targets: "typing.List[Target]", config: CheriConfig, pool: WorkerPool, timings=None):
+        super().__init__(targets, config, len(pool.workers), timings)
+        self.pool = pool
+
+    def _execute(self, target: Target):
+        project = target.get_or_create_project(None, self.config)
+        if self.pool.can_run_remotely(target, project):
+            self.pool.execute(target)
+        else:
+            target.execute(self.config)
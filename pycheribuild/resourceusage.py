@@ -0,0 +1,178 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import os
+import subprocess
+import sys
+import threading
+
+# Note: This module is imported by utils.py so it must not import anything from pycheribuild.
+try:
+    import typing
+except ImportError:
+    typing = {}
+
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS and in KiB elsewhere
+
+
+class ResourceUsage(object):
+    """The accumulated resource usage (as reported by wait4()) of a set of processes"""
+    def __init__(self):
+        self.processes = 0
+        self.user = 0.0  # CPU time in user mode (seconds)
+        self.sys = 0.0  # CPU time in kernel mode (seconds)
+        self.maxrss_kb = 0  # largest resident set size of any of the processes
+        self.inblock = 0  # block input operations
+        self.oublock = 0  # block output operations
+        self.nvcsw = 0  # voluntary context switches (usually waiting for I/O)
+        self.nivcsw = 0  # involuntary context switches (preempted, i.e. more runnable jobs than CPUs)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rusage(cls, rusage) -> "ResourceUsage":
+        result = cls()
+        result.processes = 1
+        result.user = rusage.ru_utime
+        result.sys = rusage.ru_stime
+        result.maxrss_kb = rusage.ru_maxrss * _MAXRSS_UNIT // 1024
+        result.inblock = rusage.ru_inblock
+        result.oublock = rusage.ru_oublock
+        result.nvcsw = rusage.ru_nvcsw
+        result.nivcsw = rusage.ru_nivcsw
+        return result
+
+    def add(self, other: "ResourceUsage"):
+        # can be called from the ProcessRunner thread and the thread that started the process
+        with self._lock:
+            self.processes += other.processes
+            self.user += other.user
+            self.sys += other.sys
+            self.maxrss_kb = max(self.maxrss_kb, other.maxrss_kb)
+            self.inblock += other.inblock
+            self.oublock += other.oublock
+            self.nvcsw += other.nvcsw
+            self.nivcsw += other.nivcsw
+
+    def as_dict(self) -> dict:
+        return dict(processes=self.processes, user=round(self.user, 3), sys=round(self.sys, 3),
+                    maxrss_kb=self.maxrss_kb, inblock=self.inblock, oublock=self.oublock, nvcsw=self.nvcsw,
+                    nivcsw=self.nivcsw)
+
+    def summary(self, wall_time: float=None) -> str:
+        result = "user {:.1f}s, sys {:.1f}s".format(self.user, self.sys)
+        if wall_time:
+            # e.g. 1.0 for a serial build or close to the number of jobs if the build is CPU-bound
+            result += ", {:.1f} CPUs busy".format((self.user + self.sys) / wall_time)
+        result += ", max RSS {} MiB, {} blocks read, {} blocks written, {} voluntary/{} involuntary context " \
+                  "switches".format(self.maxrss_kb // 1024, self.inblock, self.oublock, self.nvcsw, self.nivcsw)
+        return result
+
+
+_collectors = threading.local()
+
+
+def _collector_stack() -> "typing.List[ResourceUsage]":
+    if not hasattr(_collectors, "stack"):
+        _collectors.stack = []
+    return _collectors.stack
+
+
+@contextlib.contextmanager
+def collect_resource_usage():
+    """
+    Accumulate the resource usage of all processes started by the current thread (using ResourceUsagePopen) until
+    the end of the with block. Collectors can be nested (e.g. for a target and each of its build phases).
+    """
+    usage = ResourceUsage()
+    stack = _collector_stack()
+    stack.append(usage)
+    try:
+        yield usage
+    finally:
+        stack.remove(usage)
+
+
+def _exit_code(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+# Reaping the child with wait4() relies on the (private) Popen._try_wait() and Popen._waitpid_lock that are used by
+# the POSIX implementation of wait() and communicate() since python 3.3. If they don't exist ResourceUsagePopen behaves
+# like subprocess.Popen and no resource usage is recorded.
+_can_use_wait4 = hasattr(os, "wait4") and hasattr(subprocess.Popen, "_try_wait")
+
+
+class ResourceUsagePopen(subprocess.Popen):
+    """
+    A subprocess.Popen that reaps the child using wait4() so that its resource usage can be recorded in all the
+    collect_resource_usage() blocks that were active in the thread that started the process.
+    """
+    def __init__(self, *args, **kwargs):
+        self.resource_usage = None  # type: typing.Optional[ResourceUsage]
+        # capture the collectors now since the process can be reaped by a different thread (e.g. the ProcessRunner)
+        self._usage_collectors = list(_collector_stack())
+        self._use_wait4 = False
+        super().__init__(*args, **kwargs)
+        self._use_wait4 = _can_use_wait4 and hasattr(self, "_waitpid_lock")
+
+    # All callers of _try_wait() must hold self._waitpid_lock.
+    def _try_wait(self, wait_flags):
+        if not self._use_wait4:
+            return super()._try_wait(wait_flags)
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError as e:
+            # subprocess.Popen reports exit code 0 here (since the status is lost if the child was reaped by someone
+            # else), but that would turn a failed command into a successful one
+            raise ChildProcessError(e.errno, "Exit status of process " + str(self.pid) + " was lost: " +
+                                    e.strerror) from e
+        if pid == self.pid:
+            self.resource_usage = ResourceUsage.from_rusage(rusage)
+            for collector in self._usage_collectors:
+                collector.add(self.resource_usage)
+        return pid, sts
+
+    def poll(self):
+        if not self._use_wait4:
+            return super().poll()
+        # Popen.poll() calls waitpid() directly -> reimplement it using _try_wait() (with the same locking)
+        if self.returncode is None:
+            if not self._waitpid_lock.acquire(False):
+                return None  # another thread is currently waiting for the process
+            try:
+                if self.returncode is None:
+                    pid, sts = self._try_wait(os.WNOHANG)
+                    if pid == self.pid:
+                        self.returncode = _exit_code(sts)
+            finally:
+                self._waitpid_lock.release()
+        return self.returncode
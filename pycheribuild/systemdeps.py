@@ -0,0 +1,149 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import concurrent.futures
+import contextlib
+import os
+import shutil
+import subprocess
+import threading
+from collections import OrderedDict
+
+from .colour import AnsiColour, coloured
+from .utils import typing, fatalError, printCommand, getenv, command_environment
+
+
+class SystemDependencyChecker(object):
+    """
+    Checks for the system dependencies (programs, pkg-config packages and CMake packages) of all chosen targets.
+
+    All probes are deduplicated and memoised for the whole run. TargetManager.run() submits the probes of all targets
+    using prefetch() so that they run concurrently, and the results are then looked up by the (serial)
+    checkSystemDependencies() calls. Missing dependencies are collected and reported together at the end.
+    """
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._executor = None  # type: typing.Optional[concurrent.futures.ThreadPoolExecutor]
+        self._results = dict()  # type: typing.Dict[tuple, concurrent.futures.Future]
+        self._lock = threading.Lock()
+        self._collecting = 0
+        # (message, install instructions) -> targets
+        self.missing = OrderedDict()  # type: typing.Dict[typing.Tuple[str, str], typing.List[str]]
+
+    def _probe(self, key: tuple, function, *args) -> "concurrent.futures.Future":
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+                result = self._results[key] = self._executor.submit(function, *args)
+            return result
+
+    # The environment is read by the calling thread (e.g. the PATH set by Target.checkSystemDeps()) and passed
+    # explicitly since the setEnv() overlays are not visible on the worker threads.
+    def _program_future(self, program: str):
+        path = getenv("PATH", os.defpath)
+        return self._probe(("program", program, path), shutil.which, program, os.X_OK, path)
+
+    @staticmethod
+    def _run_check(cmd: "typing.List[str]", env: dict) -> bool:
+        printCommand(cmd, printVerboseOnly=True)
+        try:
+            return subprocess.call(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+        except OSError:
+            return False
+
+    def _pkg_config_future(self, package: str):
+        env = command_environment(dict())
+        key = ("pkg-config", package, env.get("PATH"), env.get("PKG_CONFIG_PATH"), env.get("PKG_CONFIG_LIBDIR"))
+        return self._probe(key, self._run_check, ["pkg-config", "--exists", package], env)
+
+    def _cmake_package_future(self, package: str):
+        env = command_environment(dict())
+        cmd = "cmake --find-package -DCOMPILER_ID=Clang -DLANGUAGE=CXX -DMODE=EXIST -DQUIET=TRUE".split()
+        return self._probe(("cmake-package", package, env.get("PATH")), self._run_check, cmd + ["-DNAME=" + package],
+                           env)
+
+    def prefetch(self, probes: "typing.Iterable[typing.Tuple[str, str]]"):
+        """Start the probes (("program"|"pkg-config"|"cmake-package", name) tuples) in the background"""
+        functions = {"program": self._program_future, "pkg-config": self._pkg_config_future,
+                     "cmake-package": self._cmake_package_future}
+        for kind, name in probes:
+            functions[kind](name)
+
+    def which(self, program: str) -> "typing.Optional[str]":
+        return self._program_future(program).result()
+
+    def has_pkg_config_package(self, package: str) -> bool:
+        return self._pkg_config_future(package).result()
+
+    def has_cmake_package(self, package: str) -> bool:
+        return self._cmake_package_future(package).result()
+
+    # Reporting:
+    @property
+    def collecting_missing(self) -> bool:
+        return self._collecting > 0
+
+    def add_missing(self, target: str, message: str, install_instructions: "typing.Optional[str]"):
+        with self._lock:
+            self.missing.setdefault((message, install_instructions or ""), []).append(target)
+
+    @contextlib.contextmanager
+    def collect_missing(self):
+        """Collect all missing dependencies reported in the with block and then report them together"""
+        with self._lock:
+            self._collecting += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._collecting -= 1
+        if self.missing:
+            self.report_missing()
+
+    def report_missing(self):
+        lines = []
+        for (message, instructions), targets in self.missing.items():
+            lines.append(coloured(AnsiColour.red, "  " + message + " (required by " + ", ".join(targets) + ")"))
+            if instructions:
+                lines.append(coloured(AnsiColour.blue, "    Possible solution:", instructions))
+        count = len(self.missing)
+        self.missing = OrderedDict()
+        fatalError(count, "system dependencies are missing:\n" + "\n".join(lines))
+
+
+_checker = None  # type: typing.Optional[SystemDependencyChecker]
+
+
+def get_system_dependency_checker() -> SystemDependencyChecker:
+    global _checker
+    if _checker is None:
+        _checker = SystemDependencyChecker()
+    return _checker
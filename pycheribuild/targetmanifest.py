@@ -0,0 +1,262 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import importlib
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+from .config.loader import ConfigLoaderBase
+from .targets import TargetManager, targetManager
+from .utils import typing
+
+# Command line flags that need all targets and their options (e.g. to print the full help or configuration)
+_FLAGS_NEEDING_ALL_TARGETS = ("-h", "--help", "--help-all", "--help-hidden", "--dump-configuration", "--what-rebuilds",
+                              "__run_everything__")
+# The default value of $COMP_WORDBREAKS in bash
+_DEFAULT_COMP_WORDBREAKS = " \t\n\"'><=;|&(:"
+
+
+def _default_manifest_path() -> Path:
+    cache_home = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return Path(cache_home, "cheribuild", "target-manifest.json")
+
+
+def project_module_fingerprint(package_dir: Path) -> "typing.List[list]":
+    """:return: the name, size and mtime of every module that can define targets or command line options"""
+    result = []
+    for directory in (package_dir / "projects", package_dir / "projects" / "cross", package_dir / "config"):
+        if not directory.is_dir():
+            continue
+        for entry in sorted(os.scandir(str(directory)), key=lambda e: e.name):
+            if entry.name.endswith(".py") and entry.is_file():
+                st = entry.stat()
+                result.append([str(Path(entry.path).relative_to(str(package_dir))), st.st_size, st.st_mtime_ns])
+    return result
+
+
+class TargetManifest(object):
+    """
+    Maps the name of every target and every target-specific config option to the module that defines it.
+
+    Importing all project modules and registering the options of every target takes most of the startup time, so
+    __main__ uses this manifest to import only the modules that are referenced on the command line. The remaining
+    targets are imported on demand by TargetManager (e.g. when resolving dependencies). The manifest is written
+    after every invocation that had to import all modules and is discarded as soon as any project module changes.
+
+    It also contains an index of all command line options (and their choices) that is used to answer shell
+    completion requests without building the argument parser (see complete_from_target_manifest()).
+    """
+    def __init__(self, targets: "typing.Dict[str, str]", options: "typing.Dict[str, str]",
+                 fingerprint: "typing.List[list]",
+                 completion_options: "typing.Dict[str, typing.Optional[typing.List[str]]]"=None):
+        self.targets = targets  # target name -> module name
+        self.options = options  # full option name -> module name
+        self.fingerprint = fingerprint
+        # option string -> choices ([] for any value) or None if the option doesn't take a value
+        self.completion_options = completion_options
+
+    @classmethod
+    def from_loaded(cls, target_manager: TargetManager, loader: ConfigLoaderBase, fingerprint: "typing.List[list]"):
+        targets = dict((t.name, t.projectClass.__module__) for t in target_manager.loaded_targets)
+        options = dict()
+        for name, option in loader.options.items():
+            # noinspection PyProtectedMember
+            owner = option._owningClass
+            if owner is not None:
+                options[name] = owner.__module__
+        completion_options = dict()
+        # noinspection PyProtectedMember
+        for action in loader._parser._actions:
+            for option_string in action.option_strings:
+                if option_string in loader.completion_excludes:
+                    continue
+                if action.nargs == 0:
+                    completion_options[option_string] = None
+                else:
+                    completion_options[option_string] = [str(c) for c in action.choices or []]
+        return cls(targets, options, fingerprint, completion_options)
+
+    @classmethod
+    def load(cls, path: Path, fingerprint: "typing.List[list]") -> "typing.Optional[TargetManifest]":
+        """:return: the manifest stored in path or None if it is missing or stale"""
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("python") != list(sys.version_info[:2]) or data.get("fingerprint") != fingerprint:
+            return None
+        return cls(data["targets"], data["options"], fingerprint, data.get("completion_options"))
+
+    def save(self, path: Path):
+        data = {"python": list(sys.version_info[:2]), "fingerprint": self.fingerprint, "targets": self.targets,
+                "options": self.options, "completion_options": self.completion_options}
+        try:
+            os.makedirs(str(path.parent), exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=str(path.parent), prefix=path.name + ".")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(data, f, sort_keys=True)
+                os.replace(tmpname, str(path))
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+        except OSError:
+            pass  # e.g. read-only home directory -> all modules will be imported next time
+
+    def modules_for_arguments(self, args: "typing.List[str]") -> "typing.Optional[typing.Set[str]]":
+        """
+        :return: the modules that define the targets and options named in args or None if all modules are needed
+        """
+        result = set()
+        for arg in args:
+            if arg.partition("=")[0] in _FLAGS_NEEDING_ALL_TARGETS:
+                return None
+            # Either a target name, an option (--foo/bar=value, --foo/no-bar) or an option name passed as a value
+            # (--get-config-option foo/bar). Checking all of them can only result in importing too many modules.
+            name = arg[2:].partition("=")[0] if arg.startswith("--") else arg
+            slash = name.rfind("/")
+            negated = name[:slash + 1] + name[slash + 4:] if name[slash + 1:].startswith("no-") else None
+            for candidate in (name, negated):
+                if candidate in self.targets:
+                    result.add(self.targets[candidate])
+                if candidate in self.options:
+                    result.add(self.options[candidate])
+        return result
+
+    def complete(self, words: "typing.List[str]", prefix: str) -> "typing.List[str]":
+        """
+        :param words: the words before the one that is being completed (including the program name)
+        :param prefix: the partial word that should be completed
+        :return: the matching targets, options or option values
+        """
+        options = self.completion_options
+        if prefix.startswith("--") and "=" in prefix:
+            name, _, value = prefix.partition("=")
+            return [name + "=" + c for c in options.get(name) or [] if c.startswith(value)]
+        if len(words) > 1 and options.get(words[-1]) is not None:
+            # An empty list lets the shell fall back to its default completion (e.g. file names)
+            return [c for c in options[words[-1]] if c.startswith(prefix)]
+        if prefix.startswith("-"):
+            return sorted(o for o in options if o.startswith(prefix))
+        return sorted(t for t in self.targets if t.startswith(prefix) and t != "__run_everything__")
+
+
+def complete_command_line(manifest: TargetManifest, comp_line: str, comp_point: int,
+                          wordbreaks: str=_DEFAULT_COMP_WORDBREAKS, append_space: bool=True) -> "typing.List[str]":
+    """
+    Compute the completions for a COMP_LINE in the same way as argcomplete. Targets and options never contain
+    whitespace or quotes, so splitting on whitespace is sufficient here.
+    """
+    line = comp_line[:comp_point]
+    words = line.split()
+    prefix = "" if not words or line[-1].isspace() else words.pop()
+    prefix = prefix.lstrip("\"'")
+    completions = manifest.complete(words, prefix)
+    # bash treats e.g. "--llvm/build-type=" as a separate word, so only return the part after the last wordbreak
+    last_wordbreak = max(prefix.rfind(c) for c in wordbreaks) if wordbreaks else -1
+    if last_wordbreak >= 0:
+        completions = [c[last_wordbreak + 1:] for c in completions]
+    if append_space and len(completions) == 1 and completions[0] and completions[0][-1] not in "=/:":
+        completions[0] += " "
+    return completions
+
+
+def complete_from_target_manifest(package: str) -> bool:
+    """
+    Answer a shell completion request (the argcomplete protocol) from the manifest without importing any project
+    modules or building the argument parser.
+    :return: False if there is no up-to-date manifest and the request has to be handled by argcomplete
+    """
+    path = get_target_manifest_path()
+    if path is None:
+        return False
+    package_dir = Path(importlib.import_module(package).__file__).parent
+    manifest = TargetManifest.load(path, project_module_fingerprint(package_dir))
+    if manifest is None or manifest.completion_options is None:
+        return False
+    comp_line = os.environ.get("COMP_LINE", "")
+    completions = complete_command_line(manifest, comp_line, int(os.environ.get("COMP_POINT", len(comp_line))),
+                                        os.environ.get("_ARGCOMPLETE_COMP_WORDBREAKS", _DEFAULT_COMP_WORDBREAKS),
+                                        append_space=os.environ.get("_ARGCOMPLETE_SUPPRESS_SPACE") != "1")
+    output = os.environ.get("_ARGCOMPLETE_IFS", "\013").join(completions)
+    if "_ARGCOMPLETE_STDOUT_FILENAME" in os.environ:
+        with open(os.environ["_ARGCOMPLETE_STDOUT_FILENAME"], "w") as f:
+            f.write(output)
+    else:
+        # argcomplete's shell hooks read the completions from file descriptor 8
+        with os.fdopen(8, "w") as f:
+            f.write(output)
+    return True
+
+
+def get_target_manifest_path() -> "typing.Optional[Path]":
+    path = os.getenv("CHERIBUILD_TARGET_MANIFEST")
+    if path is None:
+        return _default_manifest_path()
+    return Path(path) if path else None
+
+
+# The manifest that should be written once all options have been registered
+_pending_manifest = None  # type: typing.Optional[typing.Tuple[Path, typing.List[list]]]
+
+
+def import_project_modules(package: str, args: "typing.List[str]") -> None:
+    """
+    Import the project modules that define the targets and options in args if there is an up-to-date manifest,
+    otherwise import all of them and write a new manifest in save_target_manifest().
+    """
+    global _pending_manifest
+    path = get_target_manifest_path()
+    package_dir = Path(importlib.import_module(package).__file__).parent
+    fingerprint = project_module_fingerprint(package_dir)
+    manifest = TargetManifest.load(path, fingerprint) if path else None
+    modules = manifest.modules_for_arguments(args) if manifest else None
+    if modules is None or "_ARGCOMPLETE" in os.environ:
+        for subpackage in (package + ".projects", package + ".projects.cross"):
+            for name in importlib.import_module(subpackage).moduleNames:
+                importlib.import_module(subpackage + "." + name)
+        if path and not manifest:
+            _pending_manifest = (path, fingerprint)
+        return
+    for module in sorted(modules):
+        importlib.import_module(module)
+    targetManager.set_lazy_targets(manifest.targets)
+    ConfigLoaderBase.lazy_option_names = frozenset(manifest.options)
+
+
+def save_target_manifest(loader: ConfigLoaderBase) -> None:
+    global _pending_manifest
+    if _pending_manifest is not None:
+        path, fingerprint = _pending_manifest
+        _pending_manifest = None
+        TargetManifest.from_loaded(targetManager, loader, fingerprint).save(path)
@@ -27,12 +27,26 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import concurrent.futures
+import datetime
 import functools
+import heapq
+import importlib
+import inspect
 import sys
 import time
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from pathlib import Path
 from .config.chericonfig import CheriConfig, CrossCompileTarget
+from .config.loader import ConfigOptionBase
+from .dashboard import get_dashboard, show_dashboard
+from .buildstate import BuildTimingDatabase, get_build_checkpoint, get_build_timing_database
+from .jobserver import start_jobserver
+from .memoryadmission import start_memory_admission
+from .systemdeps import get_system_dependency_checker
+from .telemetry import TargetTelemetry, get_telemetry_log
+from .tracing import trace_span
 from .utils import *
 
 
@@ -66,6 +80,11 @@ class Target(object):
             # make sure all system dependencies exist first
             project.checkSystemDependencies()
 
+    def system_dependency_probes(self, config: CheriConfig) -> "typing.List[typing.Tuple[str, str]]":
+        if self._completed:
+            return []
+        return self.get_or_create_project(None, config).system_dependency_probes()
+
     def create_project(self, config: CheriConfig) -> "SimpleProject":
         assert not self._creating_project
         if self.instantiating_targets_should_warn:
@@ -85,12 +104,35 @@ class Target(object):
         starttime = time.time()
         assert self.__project is not None, "Should have been initialized in checkSystemDeps()"
         project = self.__project
-        new_env = {"PATH": project.config.dollarPathWithOtherTools}
-        if project.config.clang_colour_diags:
-            new_env["CLANG_FORCE_COLOR_DIAGNOSTICS"] = "always"
-        with setEnv(**new_env):
-            project.process()
-        statusUpdate("Built target '" + self.name + "' in", time.time() - starttime, "seconds")
+        if config.resume and get_build_checkpoint(config).is_target_completed(self.name, project.checkpoint_inputs()):
+            statusUpdate("Skipping target", self.name, "since it completed in the run that is resumed")
+            self._completed = True
+            return
+        telemetry = TargetTelemetry(self.name)
+        status = "failed"
+        record = None
+        try:
+            with setEnv(**self.build_environment(project.config)), telemetry.collect(), \
+                    trace_span(self.name, "target", target=self.name):
+                project.process()
+            status = "skipped" if project.skipped_as_up_to_date else "success"
+        finally:
+            # The resource usage of the update commands is only collected by telemetry.collect() if they were run by
+            # this thread and not by the SourceUpdateStage
+            if getattr(project, "updated_in_background", False) and "update" in project.phase_resource_usage:
+                telemetry.usage.add(project.phase_resource_usage["update"])
+            if not config.pretend:
+                record = telemetry.finish(status, project.phase_timings, project.logfiles,
+                                          project.phase_resource_usage)
+                get_telemetry_log(config).append(record)
+        duration = time.time() - starttime
+        statusUpdate("Built target '" + self.name + "' in", duration, "seconds")
+        if telemetry.usage.processes:
+            print("  ", telemetry.usage.summary(duration))
+        if record is not None and not config.configureOnly and not project.skipped_as_up_to_date:
+            get_build_timing_database(config).record(self.name, duration, project.phase_timings, record["maxrss_kb"])
+        if not config.pretend:
+            get_build_checkpoint(config).target_completed(self.name, project.checkpoint_inputs())
         self._completed = True
 
     def run_tests(self, config: "CheriConfig"):
@@ -101,14 +143,18 @@ class Target(object):
         # instantiate the project and run it
         starttime = time.time()
         project = self.get_or_create_project(None, config)
-        new_env = {"PATH": project.config.dollarPathWithOtherTools}
-        if project.config.clang_colour_diags:
-            new_env["CLANG_FORCE_COLOR_DIAGNOSTICS"] = "always"
-        with setEnv(**new_env):
+        with setEnv(**self.build_environment(project.config)), trace_span(self.name, "tests", target=self.name):
             project.run_tests()
         statusUpdate("Ran tests for target '" + self.name + "' in", time.time() - starttime, "seconds")
         self._tests_have_run = True
 
+    @staticmethod
+    def build_environment(config: CheriConfig) -> dict:
+        new_env = {"PATH": config.dollarPathWithOtherTools}
+        if config.clang_colour_diags:
+            new_env["CLANG_FORCE_COLOR_DIAGNOSTICS"] = "always"
+        return new_env
+
     def reset(self):
         # For unit tests to get a fresh instance
         self._completed = False
@@ -116,36 +162,17 @@ class Target(object):
         self.__project = None
         self._creating_project = False
 
-    def __lt__(self, other: "Target"):
-        # print(self, "__lt__", other)
-        # if this target is one of the dependencies order it before
-        otherDeps = other.projectClass._cached_dependencies()
-        # print("other deps:", otherDeps)
-        if self in otherDeps:
-            # print(self, "is in", other, "deps -> is less")
-            return True
-        # and if it is the other way around we are not less
-        if other in self.projectClass._cached_dependencies():
-            # print(other, "is in", self, "deps -> is greater")
-            return False
-        if other.name.startswith("run") and not self.name.startswith("run"):
-            return True  # run must be executed last
-        elif self.name.startswith("run"):
-            return False
-        if other.name.startswith("disk-image") and not self.name.startswith("disk-image"):
-            return True  # disk-image should be done just before run
-        elif self.name.startswith("disk-image"):
-            return False
-        # print(self, "is not in", other, "deps -> is not less")
-        # otherwise just keep everything in order
-        return False
-        # This was previously done
-        # ownDeps = self.projectClass.allDependencyNames()
-        # if len(ownDeps) < len(otherDeps):
-        #     return True
-        # if len(ownDeps) > len(otherDeps):
-        #     return False
-        # return self.name < other.name  # not a dep and number of deps is the same -> compare name
+    @property
+    def sort_rank(self) -> int:
+        """
+        Targets with a higher rank are ordered after all targets with a lower rank unless they are a dependency of them:
+        The disk image should be created just before the run targets and the run targets must be executed last.
+        """
+        if self.name.startswith("run"):
+            return 2
+        if self.name.startswith("disk-image"):
+            return 1
+        return 0
 
     def __repr__(self):
         return "<Target " + self.name + ">"
@@ -208,13 +235,171 @@ class MultiArchTargetAlias(Target):
     def checkSystemDeps(self, config: CheriConfig):
         return self.get_real_target(None, config).checkSystemDeps(config)
 
+    def system_dependency_probes(self, config: CheriConfig):
+        return self.get_real_target(None, config).system_dependency_probes(config)
+
     def __repr__(self):
         return "<Cross target alias " + self.name + ">"
 
 
+class TargetScheduler(object):
+    """
+    Executes a list of targets (already sorted in dependency order) using up to max_jobs threads. A target is started
+    as soon as all of its dependencies that are part of the list have completed.
+
+    If more targets are ready than there are free jobs the one with the longest remaining path (using the durations
+    recorded in previous builds) is started first, so that e.g. llvm and cheribsd are not delayed by cheap leaf targets.
+    """
+    def __init__(self, targets: "typing.List[Target]", config: CheriConfig, max_jobs: int,
+                 timings: "typing.Optional[BuildTimingDatabase]"=None):
+        assert max_jobs >= 1
+        self.config = config
+        self.max_jobs = max_jobs
+        self.targets = targets
+        self.timings = timings
+        chosen = set(targets)
+        # only edges between the chosen targets are relevant for scheduling
+        self._pending_deps = OrderedDict()  # type: typing.Dict[Target, typing.Set[Target]]
+        self._dependents = dict((t, []) for t in targets)  # type: typing.Dict[Target, typing.List[Target]]
+        for t in targets:
+            deps = set(d for d in t.get_dependencies(config) if d in chosen and d is not t)
+            self._pending_deps[t] = deps
+            for d in deps:
+                self._dependents[d].append(t)
+        self.estimates = self._estimate_durations(timings)
+        # The priority of a target is the length of the longest path from the start of the target to the end
+        self.priority = dict()  # type: typing.Dict[Target, float]
+        for t in reversed(targets):
+            self.priority[t] = self.estimates[t] + max((self.priority[d] for d in self._dependents[t]), default=0.0)
+        self._order = dict((t, i) for i, t in enumerate(targets))
+
+    def _estimate_durations(self, timings: "typing.Optional[BuildTimingDatabase]") -> "typing.Dict[Target, float]":
+        recorded = dict()
+        if timings is not None:
+            recorded = dict((t, timings.estimate(t.name)) for t in self.targets)
+            recorded = dict((t, v) for t, v in recorded.items() if v is not None)
+        # Targets that have never been built are assumed to take the median time of all known targets
+        known = sorted(recorded.values())
+        default = known[len(known) // 2] if known else 1.0
+        return dict((t, recorded.get(t, default)) for t in self.targets)
+
+    def _push_ready(self, ready: list, target: Target):
+        heapq.heappush(ready, (-self.priority[target], self._order[target], target))
+
+    def _initial_ready_heap(self) -> list:
+        ready = []
+        for t, deps in self._pending_deps.items():
+            if not deps:
+                self._push_ready(ready, t)
+        return ready
+
+    def _execute(self, target: Target):
+        dashboard = get_dashboard()
+        if dashboard is None:
+            target.execute(self.config)
+            return
+        dashboard.target_started(target.name, self.timings.estimate(target.name) if self.timings else None)
+        success = False
+        try:
+            target.execute(self.config)
+            success = True
+        finally:
+            dashboard.target_finished(target.name, success)
+
+    def run(self):
+        pending_deps = dict((t, set(deps)) for t, deps in self._pending_deps.items())
+        ready = self._initial_ready_heap()
+        running = dict()  # type: typing.Dict[concurrent.futures.Future, Target]
+        failure = None  # type: typing.Optional[BaseException]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_jobs) as executor:
+            while running or (ready and failure is None):
+                # Don't start any new targets once one of them has failed
+                while ready and failure is None and len(running) < self.max_jobs:
+                    target = heapq.heappop(ready)[2]
+                    running[executor.submit(self._execute, target)] = target
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    target = running.pop(future)
+                    if future.exception() is not None:
+                        if failure is None:
+                            failure = future.exception()
+                            if running:
+                                statusUpdate("Target", target.name, "failed, waiting for",
+                                             " ".join(t.name for t in running.values()), "to complete")
+                        continue
+                    for dependent in self._dependents[target]:
+                        pending_deps[dependent].discard(target)
+                        if not pending_deps[dependent]:
+                            self._push_ready(ready, dependent)
+        if failure is not None:
+            raise failure
+        not_run = [t.name for t, deps in pending_deps.items() if deps]
+        assert not not_run, "Targets with unsatisfiable dependencies: " + ", ".join(not_run)
+
+    def simulate(self) -> "typing.List[typing.Tuple[Target, float, float]]":
+        """
+        Simulate run() using the estimated durations
+        :return: the (target, start time, end time) of every target in the order that they would be started
+        """
+        pending_deps = dict((t, set(deps)) for t, deps in self._pending_deps.items())
+        ready = self._initial_ready_heap()
+        running = []  # type: typing.List[typing.Tuple[float, int, Target]]
+        result = []
+        now = 0.0
+        while ready or running:
+            while ready and len(running) < self.max_jobs:
+                target = heapq.heappop(ready)[2]
+                result.append((target, now, now + self.estimates[target]))
+                heapq.heappush(running, (now + self.estimates[target], self._order[target], target))
+            now, _, target = heapq.heappop(running)
+            for dependent in self._dependents[target]:
+                pending_deps[dependent].discard(target)
+                if not pending_deps[dependent]:
+                    self._push_ready(ready, dependent)
+        return result
+
+
+class SourceUpdateStage(object):
+    """
+    Updates the sources of all chosen targets in a thread pool (in build order) while the targets are being built so
+    that the git I/O overlaps with the compilation. Building a target waits for its own update (see
+    Project.update_sources()) and updates it immediately if the thread pool has not started it yet.
+    """
+    def __init__(self, targets: "typing.List[Target]", config: CheriConfig, max_jobs: int):
+        self.config = config
+        self.projects = []
+        for t in targets:
+            project = t.get_or_create_project(None, config)
+            if hasattr(project, "update_sources"):
+                self.projects.append(project)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs)
+        self._futures = []  # type: typing.List[concurrent.futures.Future]
+
+    @staticmethod
+    def _update_sources(project: "SimpleProject"):
+        # The environment overlay is per-thread -> use the same build environment as Target.execute()
+        with setEnv(**Target.build_environment(project.config)):
+            project.update_sources(in_background=True)
+
+    def __enter__(self):
+        for project in self.projects:
+            self._futures.append(self._executor.submit(self._update_sources, project))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Don't start updating any other repositories if the build has failed
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+
+
 class TargetManager(object):
     def __init__(self):
         self._allTargets = {}
+        self._options_registered = set()  # type: typing.Set[str]
+        self._registering_options = False
+        # target name -> module for the targets that can be imported on demand (see TargetManifest)
+        self._lazy_targets = dict()  # type: typing.Dict[str, str]
 
     def addTarget(self, target: Target) -> None:
         self._allTargets[target.name] = target
@@ -223,19 +408,46 @@ class TargetManager(object):
         # this cannot be done in the Project metaclass as otherwise we get
         # RuntimeError: super(): empty __class__ cell
         # https://stackoverflow.com/questions/13126727/how-is-super-in-python-3-implemented/28605694#28605694
-        for tgt in self._allTargets.values():
-            tgt.projectClass.setupConfigOptions()
+        self._registering_options = True
+        for tgt in list(self._allTargets.values()):
+            if tgt.name not in self._options_registered:
+                self._options_registered.add(tgt.name)
+                tgt.projectClass.setupConfigOptions()
+
+    def set_lazy_targets(self, targets: "typing.Dict[str, str]"):
+        """Allow importing the modules of the targets that have not been loaded yet when they are needed"""
+        self._lazy_targets = dict((name, module) for name, module in targets.items() if name not in self._allTargets)
+
+    def _import_target(self, name: str) -> None:
+        importlib.import_module(self._lazy_targets[name])
+        for loaded in [n for n in self._lazy_targets if n in self._allTargets]:
+            del self._lazy_targets[loaded]
+        if self._registering_options:
+            # Options of targets loaded after parsing the command line only use the JSON or default values, but that
+            # is fine since __main__ imports all the modules that define options passed on the command line.
+            self.registerCommandLineOptions()
+
+    def load_all_targets(self) -> None:
+        while self._lazy_targets:
+            self._import_target(next(iter(self._lazy_targets)))
 
     @property
     def targetNames(self):
-        return self._allTargets.keys()
+        return list(self._allTargets.keys()) + list(self._lazy_targets.keys())
+
+    @property
+    def loaded_targets(self) -> "typing.Iterable[Target]":
+        return self._allTargets.values()
 
     @property
     def targets(self) -> "typing.Iterable[Target]":
+        self.load_all_targets()
         return self._allTargets.values()
 
     def get_target_raw(self, name: str):
         # return the actual target without resolving MultiArchTargetAlias
+        if name not in self._allTargets and name in self._lazy_targets:
+            self._import_target(name)
         return self._allTargets[name]
 
     def get_target(self, name: str, arch: "typing.Optional[CrossCompileTarget]", config: CheriConfig) -> Target:
@@ -250,33 +462,46 @@ class TargetManager(object):
         # print(" ->", target)
         return target
 
-    def topologicalSort(self, targets: "typing.List[Target]") -> "typing.Iterable[typing.List[Target]]":
-        # based on http://rosettacode.org/wiki/Topological_sort#Python
-        data = dict((t.name, set(t.get_dependencies(None))) for t in targets)
-
-        # add all the targets that aren't included yet
-        allDependencyNames = [t.projectClass.allDependencyNames() for t in targets]
-        possiblyMissingDependencies = functools.reduce(set.union, allDependencyNames, set())
-        for dep in possiblyMissingDependencies:
-            if dep not in data:
-                data[dep] = self._allTargets[dep].dependencies
-
-        # do the actual sorting
-        while True:
-            ordered = set(item for item, dep in data.items() if not dep)
-            if not ordered:
-                break
-            yield list(sorted(ordered))
-            data = {item: (dep - ordered) for item, dep in data.items()
-                    if item not in ordered}
-        assert not data, "A cyclic dependency exists amongst %r" % data
-
     @staticmethod
-    def sort_in_dependency_order(targets: "typing.List[Target]") -> "typing.List[Target]":
-        # pythons sorted() is guaranteed to be stable:
-        sorted_targets = list(sorted(targets))
-        # remove duplicates (insert into an orderdict to keep order
-        return list(OrderedDict((x, True) for x in sorted_targets).keys())
+    def topologicalSort(targets: "typing.List[Target]", config: CheriConfig) -> "typing.List[Target]":
+        """
+        Sort targets in dependency order using Kahn's algorithm (with a heap of the targets that are ready).
+        Of the targets whose dependencies have all been ordered the one that was passed first is picked, so the
+        original order is kept unless a dependency requires a change. Duplicates are removed.
+        """
+        # remove duplicates (insert into an ordered dict to keep order)
+        index = OrderedDict()  # type: typing.Dict[Target, int]
+        for t in targets:
+            index.setdefault(t, len(index))
+        dependents = dict((t, []) for t in index)  # type: typing.Dict[Target, typing.List[Target]]
+        remaining_deps = dict()  # type: typing.Dict[Target, int]
+        for t in index:
+            # recursive_dependencies() is the transitive closure so we also get the right order if only some of the
+            # targets in a dependency chain are included
+            deps = [d for d in t.get_dependencies(config) if d in index and d is not t]
+            remaining_deps[t] = len(deps)
+            for d in deps:
+                dependents[d].append(t)
+        # a dependency of a run target that is itself a dependency of a normal target must not be moved to the
+        # end -> every target inherits the rank of its dependencies
+        rank = dict((t, t.sort_rank) for t in index)  # type: typing.Dict[Target, int]
+        ready = [(rank[t], i, t) for t, i in index.items() if remaining_deps[t] == 0]
+        heapq.heapify(ready)
+        result = []  # type: typing.List[Target]
+        while ready:
+            t_rank, _, t = heapq.heappop(ready)
+            result.append(t)
+            for dependent in dependents[t]:
+                rank[dependent] = max(rank[dependent], t_rank)
+                remaining_deps[dependent] -= 1
+                if remaining_deps[dependent] == 0:
+                    heapq.heappush(ready, (rank[dependent], index[dependent], dependent))
+        cyclic = [t.name for t, count in remaining_deps.items() if count]
+        assert not cyclic, "A cyclic dependency exists amongst %r" % cyclic
+        return result
+
+    def sort_in_dependency_order(self, targets: "typing.List[Target]", config: CheriConfig) -> "typing.List[Target]":
+        return self.topologicalSort(targets, config)
 
     def get_all_targets(self, explicit_targets: "typing.List[Target]", config: CheriConfig) -> "typing.List[Target]":
         add_dependencies = config.includeDependencies
@@ -303,25 +528,141 @@ class TargetManager(object):
                     continue
                 chosen_targets.append(dep_target)
 
-        sort = self.sort_in_dependency_order(chosen_targets)
-        return sort
+        return self.sort_in_dependency_order(chosen_targets, config)
 
     def run(self, config: CheriConfig):
         chosenTargets = self.get_all_chosen_targets(config)
 
-        for target in chosenTargets:
-            target.checkSystemDeps(config)
+        self.check_system_dependencies(chosenTargets, config)
         # all dependencies exist -> run the targets
-        for target in chosenTargets:
-            if config.print_targets_only:
+        if not config.pretend and not config.print_targets_only:
+            get_build_checkpoint(config).start_run([t.name for t in chosenTargets], config.resume)
+        if config.use_jobserver and not config.pretend:
+            start_jobserver(config.makeJobs)
+        if config.print_targets_only:
+            for target in chosenTargets:
                 statusUpdate("Will build target", coloured(AnsiColour.yellow, target.name))
                 print("    Dependencies for", target.name, "are", target.projectClass.allDependencyNames(config))
+            return
+        if config.skipUpdate or config.update_jobs <= 1:
+            self._run_targets(chosenTargets, config)
+        else:
+            with SourceUpdateStage(chosenTargets, config, config.update_jobs):
+                self._run_targets(chosenTargets, config)
+
+    @staticmethod
+    def check_system_dependencies(chosenTargets: "typing.List[Target]", config: CheriConfig):
+        checker = get_system_dependency_checker()
+        # Start the probes of all targets concurrently, checkSystemDeps() will then use the memoised results
+        with setEnv(PATH=config.dollarPathWithOtherTools):
+            checker.prefetch(OrderedDict.fromkeys(p for t in chosenTargets for p in t.system_dependency_probes(config)))
+        with checker.collect_missing():
+            for target in chosenTargets:
+                target.checkSystemDeps(config)
+
+    @staticmethod
+    def _run_targets(chosenTargets: "typing.List[Target]", config: CheriConfig):
+        if config.remote_workers:
+            from .remoteworkers import RemoteTargetScheduler, WorkerPool
+            pool = WorkerPool(config, config.remote_workers)
+            RemoteTargetScheduler(chosenTargets, config, pool, get_build_timing_database(config)).run()
+        elif config.parallel_targets > 1:
+            start_memory_admission(config.memory_budget)
+            # Target.execute() sets the build environment for the commands started by its worker thread
+            scheduler = TargetScheduler(chosenTargets, config, config.parallel_targets,
+                                        get_build_timing_database(config))
+            if config.verbose or config.pretend:
+                scheduler.run()  # show the output of all commands unmodified
             else:
+                with show_dashboard():
+                    scheduler.run()
+        else:
+            for target in chosenTargets:
                 target.execute(config)
 
+    def estimate(self, config: CheriConfig):
+        chosenTargets = self.get_all_chosen_targets(config)
+        timings = get_build_timing_database(config)
+        jobs = max(1, config.parallel_targets)
+        scheduler = TargetScheduler(chosenTargets, config, jobs, timings)
+        total = 0.0
+        for target, start, end in scheduler.simulate():
+            total = max(total, end)
+            phases = ", ".join("{} {:.0f}s".format(k, v) for k, v in timings.phase_estimates(target.name).items())
+            known = timings.estimate(target.name) is not None
+            print("  {:>6.0f}s  {:<30} {:>6.0f}s  {}".format(start, target.name, end - start,
+                                                             phases if known else "(never built, guessed)"))
+        statusUpdate("Estimated wall-clock time for", len(chosenTargets), "targets with --parallel-targets=" +
+                     str(jobs) + ":", datetime.timedelta(seconds=round(total)))
+
+    @staticmethod
+    def _project_directory(target: Target, name: str, config: CheriConfig) -> "typing.Optional[Path]":
+        # Some directories are computed from other projects (e.g. qtbase is inside the qt5 source directory)
+        should_warn = Target.instantiating_targets_should_warn
+        Target.instantiating_targets_should_warn = False
+        try:
+            directory = inspect.getattr_static(target.projectClass, name, None)
+            if isinstance(directory, ConfigOptionBase):
+                directory = directory.loadOption(config, target.projectClass, target.projectClass)
+        finally:
+            Target.instantiating_targets_should_warn = should_warn
+        return Path(str(directory)).absolute() if directory is not None else None
+
+    def source_directories(self, config: CheriConfig) -> "typing.Dict[Target, Path]":
+        """:return: the source directory of every target (without instantiating the projects)"""
+        result = dict()
+        for t in self.targets:
+            if isinstance(t, MultiArchTargetAlias):
+                continue  # the derived targets have the same source directory
+            source_dir = self._project_directory(t, "sourceDir", config)
+            if source_dir is not None:
+                result[t] = source_dir
+        return result
+
+    def build_directories(self, target_name: str, config: CheriConfig) -> "typing.List[Path]":
+        """:return: the build directories of target_name (all architectures for multi-arch targets)"""
+        target = self.get_target_raw(target_name)
+        targets = target.derived_targets if isinstance(target, MultiArchTargetAlias) else [target]
+        return [d for d in (self._project_directory(t, "buildDir", config) for t in targets) if d is not None]
+
+    def what_rebuilds(self, target_or_path: str, config: CheriConfig) -> "typing.List[Target]":
+        """
+        :return: the targets that need to be rebuilt (in dependency order) when the sources of target_or_path change.
+        If target_or_path is not the name of a target it is mapped to the target(s) with the closest source directory.
+        """
+        self.load_all_targets()
+        if target_or_path in self._allTargets:
+            changed = [self._allTargets[target_or_path]]
+        else:
+            path = Path(target_or_path).absolute()
+            candidates = [(t, d) for t, d in self.source_directories(config).items() if d == path or d in path.parents]
+            if not candidates:
+                fatalError(target_or_path, "is neither a target nor inside the source directory of any target")
+                return []
+            closest = max(len(d.parts) for t, d in candidates)
+            changed = [t for t, d in candidates if len(d.parts) == closest]
+        # e.g. libcxxrt means all of libcxxrt-native, libcxxrt-cheri and libcxxrt-mips
+        for t in list(changed):
+            if isinstance(t, MultiArchTargetAlias):
+                changed.extend(t.derived_targets)
+        dependents = dict()  # type: typing.Dict[Target, typing.List[Target]]
+        for t in self._allTargets.values():
+            for dep in t.projectClass.direct_dependencies(config):
+                dependents.setdefault(dep, []).append(t)
+        affected = OrderedDict((t, None) for t in changed)
+        worklist = deque(changed)
+        while worklist:
+            for dependent in dependents.get(worklist.popleft(), []):
+                if dependent not in affected:
+                    affected[dependent] = None
+                    worklist.append(dependent)
+        # Aliases (e.g. "all" or "sdk") don't build anything themselves
+        result = [t for t in affected if not t.projectClass.isAlias and not isinstance(t, MultiArchTargetAlias)]
+        return self.sort_in_dependency_order(result, config)
+
     def get_all_chosen_targets(self, config) -> "typing.Iterable[Target]":
         # check that all target dependencies are correct:
-        for t in self._allTargets.values():
+        for t in list(self._allTargets.values()):
             for dep in t.get_dependencies(config):
                 if dep.name not in self._allTargets:
                     sys.exit("Invalid dependency " + dep.name + " for " + t.projectClass.__name__)
@@ -333,7 +674,7 @@ class TargetManager(object):
         # assert self._allTargets["sdk"] > self._allTargets["sdk-sysroot"]
         explicitlyChosenTargets = []  # type: typing.List[Target]
         for targetName in config.targets:
-            if targetName not in self._allTargets:
+            if targetName not in self._allTargets and targetName not in self._lazy_targets:
                 sys.exit(coloured(AnsiColour.red, "Target", targetName, "does not exist. Valid choices are",
                                   ",".join(self.targetNames)))
             explicitlyChosenTargets.append(self.get_target(targetName, None, config))
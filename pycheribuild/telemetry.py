@@ -0,0 +1,225 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import datetime
+import fcntl
+import json
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from .resourceusage import ResourceUsage, collect_resource_usage
+from .utils import typing, statusUpdate, warningMessage
+
+# All records written by one cheribuild invocation share the same run id
+_run_id = time.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid())
+
+
+class TargetTelemetry(object):
+    """Collects the resource usage of a single target (wall time is measured by the caller)"""
+    def __init__(self, target: str):
+        self.target = target
+        self._start = time.time()
+        self.usage = ResourceUsage()
+
+    @contextlib.contextmanager
+    def collect(self):
+        """Record the resource usage of all commands that are run by the current thread inside the with block"""
+        with collect_resource_usage() as usage:
+            try:
+                yield
+            finally:
+                self.usage.add(usage)
+
+    def finish(self, status: str, phases: "typing.Dict[str, float]", logfiles: "typing.Iterable[Path]",
+               phase_usage: "typing.Dict[str, ResourceUsage]"=None) -> dict:
+        log_bytes = 0
+        for path in set(logfiles):
+            try:
+                log_bytes += path.stat().st_size
+            except OSError:
+                pass
+        usage = self.usage.as_dict()
+        return OrderedDict([
+            ("run", _run_id),
+            ("target", self.target),
+            ("time", datetime.datetime.now().isoformat()),
+            ("status", status),
+            ("wall", round(time.time() - self._start, 3)),
+            ("phases", dict((k, round(v, 3)) for k, v in phases.items())),
+            ("user", usage.pop("user")),
+            ("sys", usage.pop("sys")),
+            ("maxrss_kb", usage.pop("maxrss_kb")),
+            ("log_bytes", log_bytes),
+            ("rusage", usage),  # block I/O, context switches and number of processes
+            ("phase_rusage", dict((k, v.as_dict()) for k, v in (phase_usage or {}).items())),
+        ])
+
+
+class TelemetryLog(object):
+    """
+    A JSON lines file with one record for every target that was executed. Once it grows larger than max_bytes the
+    oldest records are dropped so that only the newest half is kept.
+    """
+    MAX_BYTES = 8 * 1024 * 1024
+
+    def __init__(self, path: Path, max_bytes: int=MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def append(self, record: dict):
+        line = (json.dumps(record, sort_keys=False) + "\n").encode("utf-8")
+        os.makedirs(str(self.path.parent), exist_ok=True)
+        fd = os.open(str(self.path), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, line)
+            if os.fstat(fd).st_size > self.max_bytes:
+                self._trim(fd)
+        finally:
+            os.close(fd)
+
+    def _trim(self, fd: int):
+        # Trim in place (while holding the lock) instead of replacing the file since concurrent cheribuild
+        # invocations might already have opened it
+        os.lseek(fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 1024 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        lines = b"".join(chunks).splitlines(keepends=True)
+        kept = []
+        size = 0
+        for line in reversed(lines):
+            size += len(line)
+            if size > self.max_bytes // 2:
+                break
+            kept.append(line)
+        os.ftruncate(fd, 0)
+        # O_APPEND -> this writes at the (new) end of the file
+        os.write(fd, b"".join(reversed(kept)))
+
+    def records(self) -> "typing.List[dict]":
+        result = []
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                for lineno, line in enumerate(f, 1):
+                    try:
+                        result.append(json.loads(line))
+                    except ValueError:
+                        warningMessage("Ignoring corrupt line", lineno, "in", self.path)
+        except FileNotFoundError:
+            pass
+        return result
+
+    def last_runs(self, count: int) -> "typing.List[dict]":
+        """:return: all records from the last count runs"""
+        records = self.records()
+        runs = OrderedDict()  # type: typing.Dict[str, None]
+        for r in records:
+            runs[r.get("run")] = None
+        selected = set(list(runs.keys())[-count:])
+        return [r for r in records if r.get("run") in selected]
+
+
+def get_telemetry_log(config: "CheriConfig") -> TelemetryLog:
+    return TelemetryLog(config.buildRoot / ".cheribuild-telemetry.jsonl")
+
+
+def _median(values: "typing.List[float]") -> float:
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def _fmt_time(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=round(seconds)))
+
+
+def build_report(records: "typing.List[dict]", top: int=10, regression_factor: float=1.25) -> "typing.List[str]":
+    """
+    Summarise the telemetry records: slowest targets, targets whose last build was significantly slower than the
+    previous median, how often targets were skipped as up-to-date and how often they failed.
+    """
+    by_target = OrderedDict()  # type: typing.Dict[str, typing.List[dict]]
+    for r in records:
+        by_target.setdefault(r["target"], []).append(r)
+    runs = len(set(r.get("run") for r in records))
+    lines = ["Build report for the last {} runs ({} target executions)".format(runs, len(records))]
+    if not records:
+        return lines
+
+    built = dict((t, [r for r in rs if r.get("status") == "success"]) for t, rs in by_target.items())
+    slowest = sorted(((t, _median([r["wall"] for r in rs]), rs) for t, rs in built.items() if rs),
+                     key=lambda x: x[1], reverse=True)[:top]
+    lines.append("")
+    lines.append("Slowest targets (median wall time of successful builds):")
+    for target, median, rs in slowest:
+        cpu = _median([r.get("user", 0) + r.get("sys", 0) for r in rs])
+        lines.append("  {:<30} {:>9}  cpu {:>9}  max RSS {:>6} MiB  ({} builds)".format(
+            target, _fmt_time(median), _fmt_time(cpu), max(r.get("maxrss_kb", 0) for r in rs) // 1024, len(rs)))
+
+    lines.append("")
+    lines.append("Regressions (last build more than {:.0f}% slower than the previous median):".format(
+        (regression_factor - 1) * 100))
+    regressions = 0
+    for target, rs in built.items():
+        if len(rs) < 2:
+            continue
+        previous = _median([r["wall"] for r in rs[:-1]])
+        last = rs[-1]["wall"]
+        # ignore noise in short builds
+        if last > previous * regression_factor and last - previous > 30:
+            regressions += 1
+            lines.append("  {:<30} {:>9} -> {:>9}".format(target, _fmt_time(previous), _fmt_time(last)))
+    if not regressions:
+        lines.append("  none")
+
+    lines.append("")
+    skipped = sum(1 for r in records if r.get("status") == "skipped")
+    lines.append("Up-to-date cache hit rate: {}/{} ({:.0f}%)".format(skipped, len(records),
+                                                                    100.0 * skipped / len(records)))
+    for target, rs in by_target.items():
+        hits = sum(1 for r in rs if r.get("status") == "skipped")
+        failed = sum(1 for r in rs if r.get("status") == "failed")
+        if hits or failed:
+            lines.append("  {:<30} {:>3}/{:<3} skipped  {:>3} failed".format(target, hits, len(rs), failed))
+    return lines
+
+
+def print_build_report(config: "CheriConfig"):
+    log = get_telemetry_log(config)
+    if not log.path.exists():
+        statusUpdate("No telemetry has been recorded yet in", log.path)
+        return
+    print("\n".join(build_report(log.last_runs(config.build_report_runs))))
@@ -0,0 +1,150 @@
+#
+# Copyright (c) 2018 Alex Richardson
+# All rights reserved.
+#
+# This software was developed by SRI International and the University of
+# Cambridge Computer Laboratory under DARPA/AFRL contract FA8750-10-C-0237
+# ("CTSRD"), as part of the DARPA CRASH research programme.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# Note: This module is imported by utils.py so it must not import anything from pycheribuild.
+
+# All timestamps are relative to the start of the process so that spans that started before tracing was enabled
+# (e.g. loading the configuration that contains --trace-file) can still be added.
+_process_start = time.monotonic()
+
+
+class TraceRecorder(object):
+    """
+    Records spans in the Chrome Trace Event Format so that a cheribuild run can be inspected with chrome://tracing
+    or https://ui.perfetto.dev.
+
+    Spans are complete ("X") events on the track of the thread that started them, the threads are numbered in the
+    order in which they recorded their first event.
+    """
+    def __init__(self, clock=time.monotonic, start: float=None):
+        self._clock = clock
+        self._start = _process_start if start is None else start
+        self._lock = threading.Lock()
+        self._events = []  # type: typing.List[dict]
+        self._threads = dict()  # type: typing.Dict[int, typing.Tuple[int, str]]
+        self.pid = os.getpid()
+
+    def now(self) -> float:
+        return self._clock()
+
+    def _microseconds(self, timestamp: float) -> float:
+        return round((timestamp - self._start) * 1000000, 1)
+
+    def _thread_id(self, thread: threading.Thread) -> int:
+        # must be called with the lock held
+        if thread.ident not in self._threads:
+            self._threads[thread.ident] = (len(self._threads) + 1, thread.name)
+        return self._threads[thread.ident][0]
+
+    def complete(self, name: str, category: str, start: float, end: float=None, args: dict=None,
+                 thread: threading.Thread=None):
+        """
+        Add a span that started at start (a value returned by now()) and ended at end (default: now)
+        :param thread: the thread that the span belongs to (default: the current thread)
+        """
+        if end is None:
+            end = self.now()
+        event = {"name": name, "cat": category, "ph": "X", "ts": self._microseconds(start),
+                 "dur": round((end - start) * 1000000, 1), "pid": self.pid}
+        if args:
+            event["args"] = args
+        with self._lock:
+            event["tid"] = self._thread_id(thread or threading.current_thread())
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.complete(name, category, start, args=args)
+
+    def events(self) -> "typing.List[dict]":
+        with self._lock:
+            metadata = [{"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": "cheribuild"}}]
+            for tid, name in self._threads.values():
+                metadata.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}})
+            return metadata + sorted(self._events, key=lambda e: e["ts"])
+
+    def write(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events(), "displayTimeUnit": "ms"}, f)
+
+
+_tracer = None  # type: typing.Optional[TraceRecorder]
+_trace_file = None  # type: typing.Optional[Path]
+
+
+def start_tracing(path: Path) -> TraceRecorder:
+    global _tracer, _trace_file
+    if _tracer is None:
+        _tracer = TraceRecorder()
+        _trace_file = path
+    return _tracer
+
+
+def get_tracer() -> "typing.Optional[TraceRecorder]":
+    return _tracer
+
+
+def finish_tracing() -> "typing.Optional[Path]":
+    """Write the trace file passed to start_tracing() (if tracing was enabled)"""
+    global _tracer
+    if _tracer is None:
+        return None
+    tracer, _tracer = _tracer, None
+    tracer.write(_trace_file)
+    return _trace_file
+
+
+def trace_future(future: "concurrent.futures.Future", name: str, category: str, **args) -> "concurrent.futures.Future":
+    """Record a span from now until the future completes (on the track of the current thread)"""
+    if _tracer is not None:
+        tracer, start, thread = _tracer, _tracer.now(), threading.current_thread()
+        future.add_done_callback(lambda f: tracer.complete(name, category, start, args=args, thread=thread))
+    return future
+
+
+@contextlib.contextmanager
+def trace_span(name: str, category: str, **args):
+    """Record the with block as a span if tracing is enabled"""
+    if _tracer is None:
+        yield
+    else:
+        with _tracer.span(name, category, **args):
+            yield
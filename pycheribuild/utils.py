@@ -39,6 +39,9 @@ import tempfile
 import threading
 import traceback
 from .colour import coloured, AnsiColour, statusUpdate, warningMessage
+from .probecache import get_probe_cache
+from .resourceusage import ResourceUsagePopen
+from .tracing import trace_span
 from collections import namedtuple
 from pathlib import Path
 
@@ -56,6 +59,7 @@ else:
 # reduce the number of import statements per project  # no-combine
 __all__ = ["typing", "IS_LINUX", "IS_FREEBSD", "IS_MAC", "printCommand", "includeLocalFile", "CompilerInfo",  # no-combine
            "runCmd", "statusUpdate", "fatalError", "coloured", "AnsiColour", "setCheriConfig", "setEnv",  # no-combine
+           "getenv", "which", "command_environment",  # no-combine
            "warningMessage", "Type_T", "typing", "popen_handle_noexec", "extract_version", "get_program_version", # no-combine
            "check_call_handle_noexec", "ThreadJoiner", "getCompilerInfo", "latestClangTool", "SafeDict", # no-combine
            "defaultNumberOfMakeJobs", "commandline_to_str", "OSInfo", "is_jenkins_build", "get_global_config"]  # no-combine
@@ -107,7 +111,7 @@ def get_global_config() -> "CheriConfig":
 def __filterEnv(env: dict) -> dict:
     result = dict()
     for k, v in env.items():
-        if k not in os.environ or os.environ[k] != v:
+        if getenv(k) != v:
             result[k] = v
     return result
 
@@ -143,7 +147,7 @@ def getInterpreter(cmdline: "typing.Sequence[str]") -> "typing.Optional[typing.L
     executable = Path(cmdline[0])
     print(executable, os.access(str(executable), os.X_OK), cmdline)
     if not executable.exists():
-        executable = Path(shutil.which(str(executable)))
+        executable = Path(which(str(executable)))
     statusUpdate(executable, "is not executable, looking for shebang:", end=" ")
     with executable.open("r", encoding="utf-8") as f:
         first_line = f.readline()
@@ -167,6 +171,7 @@ def _make_called_process_error(retcode, args, *, stdout=None, stderr=None, cwd=N
 
 
 def check_call_handle_noexec(cmdline: "typing.List[str]", **kwargs):
+    kwargs["env"] = command_environment(kwargs.get("env"))
     try:
         return subprocess.check_call(cmdline, **kwargs)
     except PermissionError as e:
@@ -178,13 +183,14 @@ def check_call_handle_noexec(cmdline: "typing.List[str]", **kwargs):
         raise _make_called_process_error(e.errno, cmdline, cwd=kwargs.get("cwd", None), stderr=str(e).encode("utf-8"))
 
 
-def popen_handle_noexec(cmdline: "typing.List[str]", **kwargs) -> subprocess.Popen:
+def popen_handle_noexec(cmdline: "typing.List[str]", **kwargs) -> ResourceUsagePopen:
+    kwargs["env"] = command_environment(kwargs.get("env"))
     try:
-        return subprocess.Popen(cmdline, **kwargs)
+        return ResourceUsagePopen(cmdline, **kwargs)
     except PermissionError as e:
         interpreter = getInterpreter(cmdline)
         if interpreter:
-            return subprocess.Popen(interpreter + cmdline, **kwargs)
+            return ResourceUsagePopen(interpreter + cmdline, **kwargs)
         raise _make_called_process_error(e.errno, cmdline, cwd=kwargs.get("cwd", None), stderr=str(e).encode("utf-8"))
     except FileNotFoundError as e:
         raise _make_called_process_error(e.errno, cmdline, cwd=kwargs.get("cwd", None), stderr=str(e).encode("utf-8"))
@@ -224,9 +230,8 @@ def runCmd(*args, captureOutput=False, captureError=False, input: "typing.Union[
     elif _cheriConfig and _cheriConfig.quiet and "stdout" not in kwargs:
         kwargs["stdout"] = subprocess.DEVNULL
 
-    if "env" in kwargs:
-        kwargs["env"] = dict((k, str(v)) for k, v in kwargs["env"].items())
-    with popen_handle_noexec(cmdline, **kwargs) as process:
+    with trace_span(os.path.basename(cmdline[0]), "command", argv=cmdline, cwd=kwargs["cwd"]), \
+            popen_handle_noexec(cmdline, **kwargs) as process:
         try:
             stdout, stderr = process.communicate(input, timeout=timeout)
         except subprocess.TimeoutExpired:
@@ -264,50 +269,63 @@ class CompilerInfo(object):
     def get_resource_dir(self):
         assert self.compiler == "clang"
         if not self._resource_dir:
-            # pretend to compile an existing source file and capture the -resource-dir output
-            cc1_cmd = runCmd(self.path, "-###", "-xc", "-c", "/usr/include/unistd.h",
-                             captureError=True, printVerboseOnly=True, runInPretendMode=True)
-            resource_dir_pat = re.compile(b'"-cc1".+"-resource-dir" "([^"]+)"')
-            self._resource_dir = Path(resource_dir_pat.search(cc1_cmd.stderr).group(1).decode("utf-8"))
+            self._resource_dir = Path(get_probe_cache().get("clang-resource-dir", self.path, self._probe_resource_dir))
         return self._resource_dir
 
+    def _probe_resource_dir(self) -> str:
+        # pretend to compile an existing source file and capture the -resource-dir output
+        cc1_cmd = runCmd(self.path, "-###", "-xc", "-c", "/usr/include/unistd.h",
+                         captureError=True, printVerboseOnly=True, runInPretendMode=True)
+        resource_dir_pat = re.compile(b'"-cc1".+"-resource-dir" "([^"]+)"')
+        return resource_dir_pat.search(cc1_cmd.stderr).group(1).decode("utf-8")
+
 _cached_compiler_infos = dict()  # type: typing.Dict[Path, CompilerInfo]
 
 
+def _probe_compiler_info(compiler: "typing.Union[str, Path]") -> dict:
+    clangVersionPattern = re.compile(b"clang version (\\d+)\\.(\\d+)\\.?(\\d+)?")
+    gccVersionPattern = re.compile(b"gcc version (\\d+)\\.(\\d+)\\.?(\\d+)?")
+    appleLlvmVersionPattern = re.compile(b"Apple LLVM version (\\d+)\\.(\\d+)\\.?(\\d+)?")
+    targetPattern = re.compile(b"Target: (.+)")
+    # clang prints this output to stderr
+    try:
+        versionCmd = runCmd(compiler, "-v", captureError=True, printVerboseOnly=True, runInPretendMode=True)
+    except subprocess.CalledProcessError as e:
+        stderr = e.stderr if e.stderr else b"FAILED: " + str(e).encode("utf-8")
+        versionCmd = CompletedProcess(e.cmd, e.returncode, e.output, stderr)
+
+    clangVersion = clangVersionPattern.search(versionCmd.stderr)
+    appleLlvmVersion = appleLlvmVersionPattern.search(versionCmd.stderr)
+    gccVersion = gccVersionPattern.search(versionCmd.stderr)
+    target = targetPattern.search(versionCmd.stderr)
+    # if _cheriConfig and _cheriConfig.pretend:
+    kind = "unknown compiler"
+    version = (0, 0, 0)
+    targetString = target.group(1).decode("utf-8") if target else ""
+    if gccVersion:
+        kind = "gcc"
+        version = tuple(map(int, gccVersion.groups()))
+    elif clangVersion:
+        kind = "clang"
+        version = tuple(map(int, clangVersion.groups()))
+    elif appleLlvmVersion:
+        kind = "apple-clang"
+        # TODO: parse #define __VERSION__ "4.2.1 Compatible Apple LLVM 8.1.0 (clang-802.0.42)"
+        version = tuple(map(int, appleLlvmVersion.groups()))
+    else:
+        warningMessage("Could not detect compiler info for", compiler, "- output was", versionCmd.stderr)
+    return {"compiler": kind, "version": version, "target": targetString}
+
+
 def getCompilerInfo(compiler: "typing.Union[str, Path]") -> CompilerInfo:
     assert compiler is not None
     if compiler not in _cached_compiler_infos:
-        clangVersionPattern = re.compile(b"clang version (\\d+)\\.(\\d+)\\.?(\\d+)?")
-        gccVersionPattern = re.compile(b"gcc version (\\d+)\\.(\\d+)\\.?(\\d+)?")
-        appleLlvmVersionPattern = re.compile(b"Apple LLVM version (\\d+)\\.(\\d+)\\.?(\\d+)?")
-        targetPattern = re.compile(b"Target: (.+)")
-        # clang prints this output to stderr
-        try:
-            versionCmd = runCmd(compiler, "-v", captureError=True, printVerboseOnly=True, runInPretendMode=True)
-        except subprocess.CalledProcessError as e:
-            stderr = e.stderr if e.stderr else b"FAILED: " + str(e).encode("utf-8")
-            versionCmd = CompletedProcess(e.cmd, e.returncode, e.output, stderr)
-
-        clangVersion = clangVersionPattern.search(versionCmd.stderr)
-        appleLlvmVersion = appleLlvmVersionPattern.search(versionCmd.stderr)
-        gccVersion = gccVersionPattern.search(versionCmd.stderr)
-        target = targetPattern.search(versionCmd.stderr)
-        # if _cheriConfig and _cheriConfig.pretend:
-        kind = "unknown compiler"
-        version = (0, 0, 0)
-        targetString = target.group(1).decode("utf-8") if target else ""
-        if gccVersion:
-            kind = "gcc"
-            version = tuple(map(int, gccVersion.groups()))
-        elif clangVersion:
-            kind = "clang"
-            version = tuple(map(int, clangVersion.groups()))
-        elif appleLlvmVersion:
-            kind = "apple-clang"
-            # TODO: parse #define __VERSION__ "4.2.1 Compatible Apple LLVM 8.1.0 (clang-802.0.42)"
-            version = tuple(map(int, appleLlvmVersion.groups()))
-        else:
-            warningMessage("Could not detect compiler info for", compiler, "- output was", versionCmd.stderr)
+        # The result of `cc -v` is cached on disk (until the compiler binary changes) unless it failed
+        info = get_probe_cache().get("compiler-info", compiler, lambda: _probe_compiler_info(compiler),
+                                     cacheable=lambda result: result["compiler"] != "unknown compiler")
+        kind = info["compiler"]
+        version = tuple(info["version"])
+        targetString = info["target"]
         if _cheriConfig and _cheriConfig.verbose:
             print(compiler, "is", kind, "version", version, "with default target", targetString)
         _cached_compiler_infos[compiler] = CompilerInfo(compiler, kind, version, targetString)
@@ -322,9 +340,14 @@ def get_program_version(program: Path, command_args: tuple=None, componentKind:"
         program_name = program.name.encode("utf-8")
     if command_args is None:
         command_args = ["--version"]
-    prog = runCmd([program] + list(command_args), stderr=subprocess.STDOUT, captureOutput=True, runInPretendMode=True)
-    return extract_version(prog.stdout, componentKind, regex, program_name)
-    pass
+
+    def run_program() -> str:
+        prog = runCmd([program] + list(command_args), stderr=subprocess.STDOUT, captureOutput=True,
+                      runInPretendMode=True)
+        return prog.stdout.decode("latin-1")  # lossless conversion to a JSON-serializable str
+    # Only the output is cached on disk (so that changes to the regex don't require clearing the cache)
+    output = get_probe_cache().get("version-output", program, run_program, args=command_args)
+    return extract_version(output.encode("latin-1"), componentKind, regex, program_name)
 
 
 # extract the version component from program output such as "git version 2.7.4"
@@ -338,7 +361,8 @@ def extract_version(output: bytes, componentKind: "typing.Type"=int, regex: "typ
     if not match:
         print(output)
         raise ValueError("Expected to match regex " + str(regex))
-    return tuple(map(componentKind, match.groups()))
+    # optional components that are missing from the output (e.g. "GNU Make 4.3") are treated as zero
+    return tuple(map(componentKind, match.groups(default=b"0")))
 
 
 def latestClangTool(basename: str):
@@ -354,15 +378,15 @@ def latestClangTool(basename: str):
         else:
             suffix1 = ("%d%d" % version)
             suffix2 = ("-%d.%d" % version)
-        guess = shutil.which(basename + suffix1)
+        guess = which(basename + suffix1)
         if guess:
             found_versioned_clang = (guess, version)
             break
-        guess = shutil.which(basename + suffix2)
+        guess = which(basename + suffix2)
         if guess:
             found_versioned_clang = (guess, version)
             break
-    guess = shutil.which(basename)
+    guess = which(basename)
     if guess:
         if found_versioned_clang[0] is None:
             return guess
@@ -481,10 +505,10 @@ class OSInfo(object):
             if zypper:
                 install_name = zypper
             else:
-                if not is_lib and shutil.which("command-not-found"):
+                if not is_lib and which("command-not-found"):
                     # for programs we can use the command-not-found tool to get detailed install instructions
                     def command_not_found():
-                        hint = subprocess.getoutput(shutil.which("command-not-found") + " " + name)
+                        hint = subprocess.getoutput(which("command-not-found") + " " + name)
                         print(hint)
                         if hint and not name + ": command not found" in hint:
                             msg_start = hint.find("The program")
@@ -514,30 +538,101 @@ class OSInfo(object):
         return cls.isSuse()
 
 
+class EnvironmentOverlay(object):
+    """
+    Environment variables that are set (or removed if the value is None) for the commands started by one thread.
+
+    setEnv() pushes a new overlay for the current thread instead of modifying os.environ so that targets running
+    concurrently in different threads can use a different environment. The spawn helpers (popen_handle_noexec() and
+    check_call_handle_noexec()) compute the environment of every command from os.environ and the active overlay.
+    """
+    def __init__(self, changes: "typing.Dict[str, typing.Optional[str]]", parent: "EnvironmentOverlay"=None):
+        self.parent = parent
+        self.variables = dict(parent.variables) if parent else dict()
+        self.variables.update(changes)
+
+    def get(self, name: str, default=None) -> "typing.Optional[str]":
+        if name in self.variables:
+            value = self.variables[name]
+            return default if value is None else value
+        return os.environ.get(name, default)
+
+    def environment(self, env: dict=None) -> "typing.Dict[str, str]":
+        """:return: a copy of os.environ with this overlay and then env applied"""
+        result = dict(os.environ)
+        for changes in (self.variables, env or dict()):
+            for k, v in changes.items():
+                if v is None:
+                    result.pop(k, None)
+                else:
+                    result[k] = str(v)
+        return result
+
+
+_environment_overlays = threading.local()
+
+
+def current_environment_overlay() -> "typing.Optional[EnvironmentOverlay]":
+    return getattr(_environment_overlays, "current", None)
+
+
+def getenv(name: str, default=None) -> "typing.Optional[str]":
+    """Like os.getenv() but also returns the variables set by setEnv() in the current thread"""
+    overlay = current_environment_overlay()
+    if overlay is None:
+        return os.environ.get(name, default)
+    return overlay.get(name, default)
+
+
+def which(program: str) -> "typing.Optional[str]":
+    """Like shutil.which() but searches the $PATH set by setEnv() in the current thread"""
+    return shutil.which(program, path=getenv("PATH", os.defpath))
+
+
+def command_environment(env: dict=None) -> "typing.Optional[typing.Dict[str, str]]":
+    """
+    :param env: additional variables for this command (None values remove the variable)
+    :return: the environment for a new child process or None if it can inherit os.environ unchanged
+    """
+    overlay = current_environment_overlay()
+    if overlay is None:
+        if env is None:
+            return None
+        overlay = EnvironmentOverlay(dict())
+    return overlay.environment(env)
+
+
 @contextlib.contextmanager
 def setEnv(*, printVerboseOnly=True, **environ):
     """
-    Temporarily set the process environment variables.
+    Set environment variables for the commands started by the current thread (None removes a variable).
+    os.environ is not modified, use getenv() and which() to query the current values.
 
     >>> with setEnv(PLUGINS_DIR=u'test/plugins'):
-    ...   "PLUGINS_DIR" in os.environ
-    True
+    ...   getenv("PLUGINS_DIR"), "PLUGINS_DIR" in os.environ
+    ('test/plugins', False)
 
-    >>> "PLUGINS_DIR" in os.environ
-    False
+    >>> getenv("PLUGINS_DIR") is None
+    True
 
     """
-    old_environ = dict(os.environ)
     # make sure all environment variables are converted to string
-    str_environ = dict((str(k),str(v)) for k,v in environ.items())
+    str_environ = dict((str(k), None if v is None else str(v)) for k, v in environ.items())
+    parent = current_environment_overlay()
+    if all(getenv(k) == v for k, v in str_environ.items()):
+        # Nothing to change -> avoid a copy of the parent overlay
+        yield
+        return
     for k, v in str_environ.items():
-        printCommand("export", k + "=" + v, printVerboseOnly=printVerboseOnly)
-    os.environ.update(str_environ)
+        if v is None:
+            printCommand("unset", k, printVerboseOnly=printVerboseOnly)
+        else:
+            printCommand("export", k + "=" + v, printVerboseOnly=printVerboseOnly)
+    _environment_overlays.current = EnvironmentOverlay(str_environ, parent)
     try:
         yield
     finally:
-        os.environ.clear()
-        os.environ.update(old_environ)
+        _environment_overlays.current = parent
 
 
 class ThreadJoiner(object):
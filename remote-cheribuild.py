@@ -28,6 +28,7 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import hashlib
 import os
 import subprocess
 import sys
@@ -40,12 +41,19 @@ host = sys.argv[1]
 cheribuildArgs = sys.argv[2:]
 cheribuildArgs = list(map(shlex.quote, cheribuildArgs))
 
-with tempfile.NamedTemporaryFile(prefix="cheribuild-", suffix=".py") as tmp:
+with tempfile.TemporaryDirectory(prefix="cheribuild-") as tmpdir:
     combineScript = scriptDir / "combine-files.py"
     assert combineScript.is_file()
-    subprocess.check_call([sys.executable, str(combineScript)], stdout=tmp)
+    bundle = Path(tmpdir, "cheribuild.pyz")
+    subprocess.check_call([sys.executable, str(combineScript), "--zipapp", str(bundle)])
+    with bundle.open("rb") as f:
+        bundleHash = hashlib.sha256(f.read()).hexdigest()[:16]
+    # The bundle is reproducible -> keep it on the remote host and only copy it again if cheribuild changed.
+    # Paths are relative to the home directory since the remote shell is not used to expand $HOME with SFTP scp.
+    remoteDir = ".cache/cheribuild"
+    remoteFile = remoteDir + "/cheribuild-" + bundleHash + ".pyz"
     print("About to run cheribuild on host '" + host + "' with the following arguments:", cheribuildArgs)
-    print("Note: file that will be run is located at", tmp.name)
+    print("Note: file that will be run is located at", host + ":~/" + remoteFile)
     tty_option = ["-tt"] if sys.__stdin__.isatty() else []
     if "-f" not in sys.argv:
         input("Press enter to continue...")
@@ -59,7 +67,13 @@ with tempfile.NamedTemporaryFile(prefix="cheribuild-", suffix=".py") as tmp:
 # so the only solution seems to be scp script to host and run it there
 scp "$script" "${host}:~/.remote-py3-script.py" > /dev/null && ssh -tt "$host" python3 '$HOME/.remote-py3-script.py' "$@"
     """
-    remoteFile = "$HOME/.remote-py3-script.py"
-    subprocess.check_call(["scp", tmp.name, host + ":" + remoteFile])
-    # call execvp so that we get "^CExiting due to Ctrl+C" instead of a CalledProcessError
-    os.execvp("ssh", ["ssh"] + tty_option + [host, "--", "python3", remoteFile] + cheribuildArgs)
+    if subprocess.call(["ssh", host, "--", "test", "-f", remoteFile]) != 0:
+        # copy to a temporary file first so that concurrent invocations never run a partially copied bundle
+        partialFile = remoteFile + ".partial-" + str(os.getpid())
+        subprocess.check_call(["ssh", host, "--", "mkdir", "-p", remoteDir])
+        subprocess.check_call(["scp", str(bundle), host + ":" + partialFile])
+        subprocess.check_call(["ssh", host, "--", "mv", "-f", partialFile, remoteFile])
+    else:
+        print("Using cached cheribuild bundle", remoteFile, "on", host)
+# call execvp so that we get "^CExiting due to Ctrl+C" instead of a CalledProcessError
+os.execvp("ssh", ["ssh"] + tty_option + [host, "--", "python3", remoteFile] + cheribuildArgs)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# Measures the cost of reading config options in hot paths such as runCmd(), printCommand() and setEnv()
+# Run with `python3 test-scripts/benchmark_config_access.py`
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+sys.path.append(str(Path(__file__).parent.parent / "tests"))
+
+from setup_mock_chericonfig import setup_mock_chericonfig
+
+
+config = None
+
+
+def main():
+    global config
+    with tempfile.TemporaryDirectory() as tmp:
+        config = setup_mock_chericonfig(Path(tmp))
+        statements = {
+            "config.verbose": "config.verbose",
+            "config.pretend": "config.pretend",
+            "config.trace_file (None)": "config.trace_file",
+            "config.use_jobserver (computed)": "config.use_jobserver",
+            "config.makeJFlag (property)": "config.makeJFlag",
+        }
+        number = 1000000
+        for name, stmt in statements.items():
+            best = min(timeit.repeat(stmt, setup="from __main__ import config", number=number, repeat=5))
+            print("{:<35} {:8.1f} ns".format(name, best / number * 1e9))
+
+
+if __name__ == "__main__":
+    main()
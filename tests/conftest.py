@@ -0,0 +1,8 @@
+import os
+
+
+def pytest_configure(config):
+    # Don't write flattened config cache entries to the real ~/.cache/cheribuild while running the tests (this has
+    # to happen before test_argument_parsing.py creates its config loader at import time).
+    # test_config_cache.py uses its own temporary cache directories.
+    os.environ["CHERIBUILD_CONFIG_CACHE"] = ""
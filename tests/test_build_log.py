@@ -0,0 +1,84 @@
+import gzip
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.buildlog import BuildLogIndex, BuildLogWriter, find_log_indexes
+
+
+def _write_log(path: Path, compress: bool):
+    writer = BuildLogWriter(path, compress=compress)
+    writer.member_size = 64  # force lots of gzip members
+    writer.write(b"make buildworld\n\n>>> World build started\n")
+    for i in range(40):
+        writer.write(b"cc -c file" + str(i).encode() + b".c\n")
+    # output is not necessarily split at line boundaries
+    writer.write(b"file40.c:1:2: warning: unused\nfile41.c:3:4: err")
+    writer.write(b"or: expected ';'\n*** Error code 1\n>>> World build completed\nlast line without newline")
+    writer.close()
+    return writer
+
+
+def _check_index(path: Path, compress: bool):
+    _write_log(path, compress)
+    index = BuildLogIndex.load(path)
+    assert index is not None and index.compressed == compress
+    assert [e["kind"] for e in index.entries] == ["phase", "warning", "error", "error", "phase"]
+    assert index.counts == {"phase": 2, "warning": 1, "error": 2}
+    error = index.first_error
+    assert error["text"] == "file41.c:3:4: error: expected ';'"
+    assert error["line"] == 45
+    assert index.lines == 47  # number of newlines
+    contents = gzip.open(str(path)).read() if compress else path.read_bytes()
+    assert contents.splitlines()[error["line"] - 1].decode() == error["text"]
+    assert index.read(error["offset"], len(error["text"])).decode() == error["text"]
+    context = index.context(error, lines_before=1, lines_after=1)
+    assert context == ["file40.c:1:2: warning: unused", error["text"], "*** Error code 1"]
+    if compress:
+        assert len(index.members) >= 10
+
+
+def test_plain_log():
+    with tempfile.TemporaryDirectory() as tmp:
+        _check_index(Path(tmp, "build.log"), compress=False)
+
+
+def test_compressed_log():
+    with tempfile.TemporaryDirectory() as tmp:
+        _check_index(Path(tmp, "build.log.gz"), compress=True)
+
+
+def test_append_and_stale_index():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp, "install.log.gz")
+        _write_log(path, compress=True)
+        with BuildLogWriter(path, compress=True, append=True) as writer:
+            writer.write(b"\ninstall: error: failed\n")
+        index = BuildLogIndex.load(path)
+        assert index.entries[-1]["line"] == 49
+        assert index.read(index.entries[-1]["offset"], 22) == b"install: error: failed"
+        assert find_log_indexes(Path(tmp))[0].logfile == path
+        # modifying the log invalidates the index
+        with path.open("ab") as f:
+            f.write(gzip.compress(b"foo\n"))
+        assert BuildLogIndex.load(path) is None
+
+
+def test_output_written_by_child_process():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp, "build.log")
+        writer = BuildLogWriter(path, compress=False)
+        writer.write(b"make all\n\n")
+        fd = writer.fileno()
+        subprocess.check_call([sys.executable, "-c", "import sys; sys.stdout.write('cc -c foo.c\\nfoo.c:1:2: err');"
+                               "sys.stdout.flush(); sys.stderr.write('or: expected x\\n*** Error code 1\\n')"],
+                              stdout=fd, stderr=fd)
+        writer.close()
+        index = BuildLogIndex.load(path)
+        assert [e["text"] for e in index.entries] == ["foo.c:1:2: error: expected x", "*** Error code 1"]
+        assert index.first_error["line"] == 4
+        assert index.read(index.first_error["offset"], 8) == b"foo.c:1:"
+        assert index.size == path.stat().st_size
@@ -0,0 +1,202 @@
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild import buildstate, utils
+from pycheribuild.buildstate import BuildCheckpoint, BuildFingerprint, BuildStateDatabase, PersistentJsonFile
+from pycheribuild.config.loader import ComputedDefaultValue, ConfigLoaderBase
+from pycheribuild.projects.project import Project, SimpleProject
+from pycheribuild.targets import Target
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+def _fingerprint(revision="abc", options=None, deps=None):
+    return BuildFingerprint({"source-revision": revision, "options": options or {"foo/bar": "1"},
+                             "toolchain": ["clang"], "dependencies": deps or {}})
+
+
+def test_persistent_json_file():
+    with tempfile.TemporaryDirectory() as td:
+        f = PersistentJsonFile(Path(td, "state.json"))
+        assert f.load() == {}
+        with f.locked() as data:
+            data["x"] = 1
+        assert f.load() == {"x": 1}
+        assert PersistentJsonFile(Path(td, "state.json")).load() == {"x": 1}
+
+
+def test_build_state_check():
+    with tempfile.TemporaryDirectory() as td:
+        db = BuildStateDatabase(Path(td, "state.json"))
+        assert db.check("foo", _fingerprint()) == ["target has not been built successfully before"]
+        db.record("foo", _fingerprint())
+        assert db.check("foo", _fingerprint()) == []
+        # state must be persisted
+        db = BuildStateDatabase(Path(td, "state.json"))
+        assert db.check("foo", _fingerprint()) == []
+        assert db.check("foo", _fingerprint(revision="def")) == ["source revision changed from abc to def"]
+        assert db.check("foo", _fingerprint(options={"foo/bar": "2"})) == ["option foo/bar changed from 1 to 2"]
+        # unknown source revision -> never up-to-date
+        assert db.check("foo", _fingerprint(revision=None)) == ["source directory is not a git repository"]
+        # dependencies
+        assert db.check("foo", _fingerprint(deps={"bar": None})) == ["dependency bar has no recorded build state"]
+        db.record("bar", _fingerprint())
+        db.record("foo", _fingerprint(deps={"bar": db.digest("bar")}))
+        assert db.check("foo", _fingerprint(deps={"bar": db.digest("bar")})) == []
+        db.forget("foo")
+        assert db.digest("foo") is None
+
+
+def test_checkpoint_resume():
+    with tempfile.TemporaryDirectory() as td:
+        path = Path(td, "checkpoint.json")
+        checkpoint = BuildCheckpoint(path)
+        checkpoint.start_run(["llvm", "qtbase"], resume=False)
+        checkpoint.phase_completed("llvm", "update", "inputs1")
+        checkpoint.phase_completed("llvm", "compile", "inputs1")
+        checkpoint.target_completed("llvm", "inputs1")
+        checkpoint.phase_completed("qtbase", "configure", "qt1")
+        checkpoint.phase_completed("qtbase", "compile", "qt1")
+        # the qtbase install failed -> resume
+        checkpoint = BuildCheckpoint(path)
+        checkpoint.start_run(["llvm", "qtbase"], resume=True)
+        assert checkpoint.is_target_completed("llvm", "inputs1")
+        assert not checkpoint.is_target_completed("llvm", "inputs2")  # changed inputs -> rebuild
+        assert not checkpoint.is_target_completed("qtbase", "qt1")
+        assert checkpoint.completed_phases("qtbase", "qt1") == ["configure", "compile"]
+        assert checkpoint.completed_phases("qtbase", "qt2") == []
+        # changed inputs reset the completed phases
+        checkpoint.phase_completed("qtbase", "configure", "qt2")
+        assert checkpoint.completed_phases("qtbase", "qt2") == ["configure"]
+        # A new run without --resume starts from scratch
+        checkpoint.start_run(["llvm", "qtbase"], resume=False)
+        assert not checkpoint.is_target_completed("llvm", "inputs1")
+        assert checkpoint.completed_phases("qtbase", "qt2") == []
+
+
+class _GitProject(SimpleProject):
+    doNotAddToTargets = True
+    target = "git-project"
+    projectName = "git-project"
+
+
+def test_source_revision_is_only_computed_after_update(monkeypatch):
+    # setup_mock_chericonfig() changes global state -> restore it afterwards so that it doesn't affect other tests
+    monkeypatch.setattr(utils, "_cheriConfig", utils._cheriConfig)
+    monkeypatch.setattr(ConfigLoaderBase, "_cheriConfig", ConfigLoaderBase._cheriConfig)
+    monkeypatch.setattr(SimpleProject, "_configLoader", SimpleProject._configLoader)
+    monkeypatch.setattr(Target, "instantiating_targets_should_warn", Target.instantiating_targets_should_warn)
+    with tempfile.TemporaryDirectory() as td:
+        config = setup_mock_chericonfig(Path(td))
+        monkeypatch.setattr(config, "pretend", False)
+        source = Path(td, "git-project")
+        source.mkdir()
+        subprocess.check_call(["git", "init", "-q", str(source)])
+        subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "-q",
+                               "--allow-empty", "-m", "initial"], cwd=str(source))
+        _GitProject.setupConfigOptions()
+        project = _GitProject(config)
+        project.sourceDir = source
+        git_commands = []
+        run_cmd = buildstate.runCmd
+        monkeypatch.setattr(buildstate, "runCmd", lambda *args, **kwargs: (git_commands.append(args),
+                                                                           run_cmd(*args, **kwargs))[1])
+        inputs = project.checkpoint_inputs()
+        assert len(git_commands) == 2  # rev-parse + diff
+        for phase in ("configure", "compile", "install"):
+            with project._run_phase(phase):
+                pass
+        assert project.checkpoint_inputs() == inputs
+        assert len(git_commands) == 2
+        # the update step changes the sources -> compute the revision again
+        with project._run_phase("update"):
+            (source / "new-file").write_text("x")
+            subprocess.check_call(["git", "add", "new-file"], cwd=str(source))
+        assert len(git_commands) == 4
+        assert project.checkpoint_inputs() != inputs
+
+
+class _FakeBuildProject(Project):
+    doNotAddToTargets = True
+    target = "fake-build-project"
+    projectName = "fake-build-project"
+    defaultInstallDir = ComputedDefaultValue(function=lambda config, project: config.outputRoot / "fake-install",
+                                             asString="$OUTPUT_ROOT/fake-install")
+
+    def __init__(self, config, phases):
+        super().__init__(config)
+        self.phases = phases
+
+    def configure(self, **kwargs):
+        self.phases.append("configure")
+
+    def compile(self, **kwargs):
+        self.phases.append("compile")
+
+    def install(self, **kwargs):
+        self.phases.append("install")
+        self.makedirs(self.installDir)
+
+
+def test_up_to_date_check_with_skip_install(monkeypatch):
+    # setup_mock_chericonfig() changes global state -> restore it afterwards so that it doesn't affect other tests
+    monkeypatch.setattr(utils, "_cheriConfig", utils._cheriConfig)
+    monkeypatch.setattr(ConfigLoaderBase, "_cheriConfig", ConfigLoaderBase._cheriConfig)
+    monkeypatch.setattr(SimpleProject, "_configLoader", SimpleProject._configLoader)
+    monkeypatch.setattr(Target, "instantiating_targets_should_warn", Target.instantiating_targets_should_warn)
+    with tempfile.TemporaryDirectory() as td:
+        config = setup_mock_chericonfig(Path(td))
+        for name, value in (("pretend", False), ("clean", False), ("skip_unchanged", True), ("skipInstall", True)):
+            monkeypatch.setattr(config, name, value)
+        source = Path(td, "fake-source")
+        source.mkdir()
+        subprocess.check_call(["git", "init", "-q", str(source)])
+        subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "-q",
+                               "--allow-empty", "-m", "initial"], cwd=str(source))
+        _FakeBuildProject.setupConfigOptions()
+
+        def build():
+            phases = []
+            project = _FakeBuildProject(config, phases)
+            project.sourceDir = source
+            project.buildDir = Path(td, "fake-build")
+            project.process()
+            return phases
+
+        # --skip-install builds are recorded but are not up-to-date for a build with install
+        assert build() == ["compile"]
+        assert build() == []
+        monkeypatch.setattr(config, "skipInstall", False)
+        assert build() == ["compile", "install"]
+        assert build() == []
+        # the installed files must still exist
+        (config.outputRoot / "fake-install").rmdir()
+        assert build() == ["compile", "install"]
+
+
+def test_checkpoint_inputs_include_dependencies(monkeypatch):
+    monkeypatch.setattr(utils, "_cheriConfig", utils._cheriConfig)
+    monkeypatch.setattr(ConfigLoaderBase, "_cheriConfig", ConfigLoaderBase._cheriConfig)
+    monkeypatch.setattr(SimpleProject, "_configLoader", SimpleProject._configLoader)
+    monkeypatch.setattr(Target, "instantiating_targets_should_warn", Target.instantiating_targets_should_warn)
+    with tempfile.TemporaryDirectory() as td:
+        config = setup_mock_chericonfig(Path(td))
+        _GitProject.setupConfigOptions()
+        project = _GitProject(config)
+        project.sourceDir = None
+        monkeypatch.setattr(project, "_fingerprint_dependencies", lambda: ["llvm"])
+        checkpoint = buildstate.get_build_checkpoint(config)
+        checkpoint.start_run(["llvm", "git-project"], resume=False)
+        checkpoint.target_completed("llvm", "llvm1")
+        inputs = project.checkpoint_inputs()
+        assert project.checkpoint_inputs() == inputs
+        # llvm was rebuilt in the resumed run -> the completed phases must not be reused
+        checkpoint.target_completed("llvm", "llvm2")
+        assert project.checkpoint_inputs() != inputs
+        # the same applies if its --skip-unchanged build state changed
+        inputs = project.checkpoint_inputs()
+        buildstate.get_build_state_database(config).record("llvm", _fingerprint())
+        assert project.checkpoint_inputs() != inputs
@@ -0,0 +1,34 @@
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.config.loader import FlattenedConfigCache, flatten_json_config
+
+
+def test_flatten_json_config():
+    config = {"#include": "base.json", "source-root": "/cheri", "llvm/build-type": "Debug",
+              "llvm": {"build-type": "Release", "cmake-options": ["-DFOO=1"]},
+              "qt5": {"build": {"nested": True}}}
+    assert flatten_json_config(config) == {"source-root": "/cheri", "llvm/build-type": "Debug",
+                                           "llvm/cmake-options": ["-DFOO=1"], "qt5/build/nested": True}
+
+
+def test_cache_is_invalidated_by_included_files():
+    with tempfile.TemporaryDirectory() as tmp:
+        config = Path(tmp, "config.json")
+        base = Path(tmp, "base.json")
+        config.write_text('{"#include": "base.json"}')
+        base.write_text('{"source-root": "/a"}')
+        cache = FlattenedConfigCache(Path(tmp, "cache"))
+        assert cache.get(config) is None
+        files = [(str(config), cache.file_digest(config)), (str(base), cache.file_digest(base))]
+        cache.put(config, files, {"source-root": "/a"})
+        assert cache.get(config) == {"source-root": "/a"}
+        base.write_text('{"source-root": "/b"}')
+        assert cache.get(config) is None
+        # files that failed to parse are never cached
+        cache.put(config, [(str(config), None)], {})
+        assert cache.get(config) is None
+        assert FlattenedConfigCache(None).get(config) is None
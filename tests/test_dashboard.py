@@ -0,0 +1,96 @@
+import io
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.dashboard import BuildDashboard, TargetProgress
+from pycheribuild.outputfilter import LineAction, OutputFilter
+
+_filter = OutputFilter(LineAction.STATUS, prefixes={b">>> ": LineAction.HEADING, b"warning:": LineAction.SHOW})
+
+
+class _FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def _dashboard(tty: bool):
+    clock = _FakeClock()
+    stdout = io.BytesIO()
+    stderr = io.BytesIO()
+    return BuildDashboard(stdout, stderr, tty, clock=clock, width=lambda: 80), clock, stdout, stderr
+
+
+def test_progress_row():
+    clock = _FakeClock()
+    target = TargetProgress("llvm", None, clock)
+    target.set_phase("compile")
+    clock.now += 60
+    target.parse_progress(b"[250/1000] Building CXX object foo.o\n")
+    assert target.progress_str() == "250/1000 25%"
+    assert target.eta() == 180  # extrapolated from the progress
+    row = target.row()
+    assert row.startswith("llvm ") and "compile" in row and "1m00s" in row and "ETA 3m00s" in row
+    target.estimate = 30.0
+    assert "overdue" in target.row()
+    target.parse_progress(b"[ 42%] Building C object bar.o\n")
+    assert target.progress_str() == "42%"
+
+
+def test_tty_dashboard():
+    dashboard, clock, stdout, stderr = _dashboard(tty=True)
+    dashboard.target_started("cheribsd", estimate=3600.0)
+    dashboard.target_started("qemu", estimate=None)
+    # one row per target (the first row is erased and redrawn when the second target starts)
+    assert stdout.getvalue().split(b"\x1b[J")[-1].count(b"\n") == 2
+    dashboard.phase_started("cheribsd", "compile")
+    stdout.truncate(0)
+    stdout.seek(0)
+    clock.now += 10
+    dashboard.command_output("cheribsd", _filter, [b">>> stage 2.1\n", b"===> lib/libc\n", b"warning: foo\n"])
+    output = stdout.getvalue()
+    # the rows are erased, the important lines are printed with a prefix and then the rows are redrawn
+    assert output.startswith(b"\r\x1b[2A\x1b[J[cheribsd] >>> stage 2.1\n[cheribsd] warning: foo\n")
+    rows = output.split(b"warning: foo\n")[1].decode().splitlines()
+    assert len(rows) == 2 and rows[0].startswith("cheribsd") and rows[0].endswith(">>> stage 2.1 ===> lib/libc")
+    assert "ETA 59m50s" in rows[0]
+    # status lines only update the row (and redraws are rate limited)
+    stdout.truncate(0)
+    stdout.seek(0)
+    dashboard.command_output("cheribsd", _filter, [b"===> lib/libz\n"])
+    assert stdout.getvalue() == b""
+    assert dashboard.targets["cheribsd"].status == "===> lib/libz"
+    # incomplete lines written to stdout are delayed until the line is complete
+    dashboard.write_stdout(b"Building ")
+    assert stdout.getvalue() == b""
+    dashboard.write_stdout(b"target\n")
+    assert stdout.getvalue().startswith(b"\r\x1b[2A\x1b[JBuilding target\n")
+    dashboard.command_error("qemu", b"error: bar\n")
+    assert stderr.getvalue() == b"[qemu] error: bar\n"
+    dashboard.target_finished("cheribsd", success=True)
+    dashboard.target_finished("qemu", success=True)
+    dashboard.close()
+    assert stdout.getvalue().endswith(b"\r\x1b[1A\x1b[J")
+
+
+def test_plain_fallback():
+    dashboard, clock, stdout, stderr = _dashboard(tty=False)
+    dashboard.target_started("llvm", estimate=120.0)
+    dashboard.phase_started("llvm", "compile")
+    dashboard.command_output("llvm", _filter, [b"[1/10] cc a.c\n"])
+    clock.now += 61
+    dashboard.command_output("llvm", _filter, [b"[5/10] cc b.c\n", b"warning: x\n"])
+    dashboard.command_output("llvm", _filter, [b"[6/10] cc c.c\n"])
+    dashboard.target_finished("llvm", success=False)
+    assert stdout.getvalue().decode().splitlines() == [
+        "[llvm] started (usually takes 2m00s)",
+        "[llvm] running compile",
+        "[llvm] warning: x",
+        "[llvm] compile 6/10 60%",
+        "[llvm] failed after 1m01s",
+    ]
+    assert b"\x1b" not in stdout.getvalue()
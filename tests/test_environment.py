@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.utils import setEnv, getenv, command_environment, popen_handle_noexec, which
+
+
+def _child_env(name: str, **kwargs) -> str:
+    cmd = [sys.executable, "-c", "import os, sys; sys.stdout.write(os.environ.get(sys.argv[1], '<unset>'))", name]
+    with popen_handle_noexec(cmd, stdout=subprocess.PIPE, **kwargs) as proc:
+        return proc.communicate()[0].decode("utf-8")
+
+
+def test_overlay_does_not_modify_os_environ():
+    before = dict(os.environ)
+    assert command_environment() is None
+    with setEnv(CHERIBUILD_TEST_VAR="outer", PATH="/nonexistent:" + os.environ["PATH"]):
+        assert "CHERIBUILD_TEST_VAR" not in os.environ
+        assert getenv("CHERIBUILD_TEST_VAR") == "outer"
+        assert _child_env("CHERIBUILD_TEST_VAR") == "outer"
+        with setEnv(CHERIBUILD_TEST_VAR="inner"):
+            assert _child_env("CHERIBUILD_TEST_VAR") == "inner"
+            # variables passed to the command override the overlay
+            assert _child_env("CHERIBUILD_TEST_VAR", env={"CHERIBUILD_TEST_VAR": "explicit"}) == "explicit"
+        assert getenv("CHERIBUILD_TEST_VAR") == "outer"
+    assert getenv("CHERIBUILD_TEST_VAR") is None
+    assert dict(os.environ) == before
+
+
+def test_overlay_can_unset_variables():
+    os.environ["CHERIBUILD_TEST_MAKEFLAGS"] = "-j4"
+    try:
+        with setEnv(CHERIBUILD_TEST_MAKEFLAGS=None):
+            assert getenv("CHERIBUILD_TEST_MAKEFLAGS") is None
+            assert _child_env("CHERIBUILD_TEST_MAKEFLAGS") == "<unset>"
+            assert _child_env("CHERIBUILD_TEST_MAKEFLAGS", env={"CHERIBUILD_TEST_MAKEFLAGS": "-j2"}) == "-j2"
+        assert _child_env("CHERIBUILD_TEST_MAKEFLAGS") == "-j4"
+    finally:
+        del os.environ["CHERIBUILD_TEST_MAKEFLAGS"]
+
+
+def test_overlays_are_per_thread():
+    started = threading.Event()
+    finish = threading.Event()
+    seen = []
+
+    def other_thread():
+        with setEnv(CHERIBUILD_TEST_VAR="thread"):
+            started.set()
+            finish.wait(5)
+            seen.append(_child_env("CHERIBUILD_TEST_VAR"))
+
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    try:
+        assert started.wait(5)
+        with setEnv(CHERIBUILD_TEST_VAR="main"):
+            finish.set()
+            assert _child_env("CHERIBUILD_TEST_VAR") == "main"
+    finally:
+        finish.set()
+        thread.join()
+    assert seen == ["thread"]
+    assert getenv("CHERIBUILD_TEST_VAR") is None
+
+
+def test_tools_are_found_on_the_overlay_path():
+    # e.g. tools in otherToolsDir/bin that are added to $PATH by Target.build_environment()
+    with tempfile.TemporaryDirectory() as td:
+        tool = Path(td, "cheribuild-test-tool")
+        tool.write_text("#!/bin/sh\n")
+        tool.chmod(0o755)
+        assert which(tool.name) is None
+        with setEnv(PATH=td + ":" + os.environ["PATH"]):
+            assert which(tool.name) == str(tool)
@@ -0,0 +1,160 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild import utils
+from pycheribuild.config.loader import ConfigLoaderBase
+from pycheribuild.jobserver import JobServer
+from pycheribuild.projects import cmake, project as project_module
+from pycheribuild.projects.project import MakeCommandKind, MakeOptions, Project, SimpleProject
+from pycheribuild.targets import Target
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+def _available_tokens(jobserver: JobServer) -> int:
+    os.set_blocking(jobserver.read_fd, False)
+    try:
+        tokens = os.read(jobserver.read_fd, 1024)
+    except BlockingIOError:
+        tokens = b""
+    finally:
+        os.set_blocking(jobserver.read_fd, True)
+    os.write(jobserver.write_fd, tokens)
+    return len(tokens)
+
+
+def test_jobserver_tokens():
+    jobserver = JobServer(4)
+    assert _available_tokens(jobserver) == 4
+    with jobserver.implicit_token():
+        assert _available_tokens(jobserver) == 3
+    assert _available_tokens(jobserver) == 4
+    # The implicit token must also be returned if the command fails
+    with pytest.raises(RuntimeError):
+        with jobserver.implicit_token():
+            raise RuntimeError("command failed")
+    assert _available_tokens(jobserver) == 4
+    with jobserver.reserve(3):
+        assert _available_tokens(jobserver) == 1
+    assert _available_tokens(jobserver) == 4
+    assert jobserver.pass_fds == (jobserver.read_fd, jobserver.write_fd)
+    assert jobserver.gnu_makeflags() == " -j4 --jobserver-auth={},{}".format(*jobserver.pass_fds)
+    assert jobserver.gnu_makeflags(legacy_fds_flag=True) == " -j4 --jobserver-fds={},{}".format(*jobserver.pass_fds)
+    assert jobserver.bsd_make_args() == ["-j", "4", "-J", "{},{}".format(*jobserver.pass_fds)]
+
+
+def _jobserver_args_for_output(monkeypatch, kind, command, version_output: bytes):
+    monkeypatch.setattr(project_module, "which", lambda cmd: "/usr/bin/" + cmd)
+    monkeypatch.setattr(project_module, "get_program_version",
+                        lambda program, regex=None: utils.extract_version(version_output, regex=regex))
+    return Project._jobserver_args(JobServer(4), kind, command)
+
+
+@pytest.mark.parametrize("version_output,legacy_flag", [
+    (b"GNU Make 4.3\nBuilt for x86_64-pc-linux-gnu\n", False),
+    (b"GNU Make 4.2.1\nBuilt for x86_64-pc-linux-gnu\n", False),
+    (b"GNU Make 4.1\nBuilt for x86_64-pc-linux-gnu\n", True),
+    (b"GNU Make 3.81\nCopyright (C) 2006  Free Software Foundation, Inc.\n", True),
+])
+def test_gnu_make_jobserver_args(monkeypatch, version_output, legacy_flag):
+    args, env = _jobserver_args_for_output(monkeypatch, MakeCommandKind.GnuMake, "make", version_output)
+    assert args == []
+    assert ("--jobserver-fds=" in env["MAKEFLAGS"]) == legacy_flag
+    assert ("--jobserver-auth=" in env["MAKEFLAGS"]) != legacy_flag
+
+
+def test_jobserver_args_unknown_version(monkeypatch):
+    assert _jobserver_args_for_output(monkeypatch, MakeCommandKind.GnuMake, "make", b"make: unknown") is None
+
+
+@pytest.mark.parametrize("version_output", [b"1.10.1\n", b"1.13.0\n"])
+def test_ninja_gets_jflag(monkeypatch, version_output):
+    # ninja doesn't use the inherited jobserver pipe -> it has to be passed a -j flag instead
+    assert _jobserver_args_for_output(monkeypatch, MakeCommandKind.Ninja, "ninja", version_output) is None
+
+
+def test_bsd_make_jobserver_args(monkeypatch):
+    args, env = _jobserver_args_for_output(monkeypatch, MakeCommandKind.BsdMake, "bmake", b"")
+    assert args[:3] == ["-j", "4", "-J"]
+    assert env == {}
+
+
+class _BootstrapCMake(cmake.BuildCMake):
+    doNotAddToTargets = True
+    target = "bootstrap-cmake"
+    projectName = "bootstrap-cmake"
+
+
+def _configure_commands(monkeypatch, config, jobserver):
+    monkeypatch.setattr(cmake, "get_jobserver", lambda: jobserver)
+    monkeypatch.setattr(_BootstrapCMake, "_jobserver_args",
+                        staticmethod(lambda js, kind, command: ([], {"MAKEFLAGS": js.gnu_makeflags()})))
+    project = _BootstrapCMake(config)
+    commands = []
+    monkeypatch.setattr(project, "needsConfigure", lambda: True)
+    # configure() restores configureArgs and configureEnvironment afterwards -> record copies
+    monkeypatch.setattr(project, "runWithLogfile",
+                        lambda args, **kwargs: commands.append((list(args), dict(kwargs, env=dict(kwargs["env"])))))
+    project.configure()
+    assert len(commands) == 1
+    assert project.configureArgs.count("--parallel=" + str(config.makeJobs)) == 1
+    return commands[0]
+
+
+def test_cmake_bootstrap_uses_jobserver(monkeypatch):
+    # setup_mock_chericonfig() changes global state -> restore it afterwards so that it doesn't affect other tests
+    monkeypatch.setattr(utils, "_cheriConfig", utils._cheriConfig)
+    monkeypatch.setattr(ConfigLoaderBase, "_cheriConfig", ConfigLoaderBase._cheriConfig)
+    monkeypatch.setattr(SimpleProject, "_configLoader", SimpleProject._configLoader)
+    monkeypatch.setattr(Target, "instantiating_targets_should_warn", Target.instantiating_targets_should_warn)
+    with tempfile.TemporaryDirectory() as td:
+        config = setup_mock_chericonfig(Path(td))
+        _BootstrapCMake.setupConfigOptions()
+        args, kwargs = _configure_commands(monkeypatch, config, None)
+        assert "--parallel=" + str(config.makeJobs) in args
+        assert "MAKEFLAGS" not in kwargs["env"]
+
+        jobserver = JobServer(4)
+        args, kwargs = _configure_commands(monkeypatch, config, jobserver)
+        assert not any(str(arg).startswith("--parallel") for arg in args)
+        assert kwargs["env"]["MAKEFLAGS"] == jobserver.gnu_makeflags()
+        assert kwargs["pass_fds"] == jobserver.pass_fds
+        assert _available_tokens(jobserver) == 4
+
+
+class _NinjaProject(Project):
+    doNotAddToTargets = True
+    target = "ninja-project"
+    projectName = "ninja-project"
+    defaultInstallDir = Project._installToSDK
+
+
+def test_ninja_holds_job_slots(monkeypatch):
+    monkeypatch.setattr(utils, "_cheriConfig", utils._cheriConfig)
+    monkeypatch.setattr(ConfigLoaderBase, "_cheriConfig", ConfigLoaderBase._cheriConfig)
+    monkeypatch.setattr(SimpleProject, "_configLoader", SimpleProject._configLoader)
+    monkeypatch.setattr(Target, "instantiating_targets_should_warn", Target.instantiating_targets_should_warn)
+    with tempfile.TemporaryDirectory() as td:
+        config = setup_mock_chericonfig(Path(td))
+        monkeypatch.setattr(config, "pretend", False)
+        monkeypatch.setattr(config, "makeJobs", 3)
+        jobserver = JobServer(4)
+        monkeypatch.setattr(project_module, "get_jobserver", lambda: jobserver)
+        _NinjaProject.setupConfigOptions()
+        project = _NinjaProject(config)
+        commands = []
+        monkeypatch.setattr(project, "runWithLogfile", lambda args, **kwargs: commands.append(
+            (args, kwargs, _available_tokens(jobserver))))
+        project.runMake("all", make_command="ninja", options=MakeOptions(MakeCommandKind.Ninja, project),
+                        cwd=Path(td))
+        args, kwargs, available = commands[0]
+        # ninja can't use the jobserver pipe -> it is passed -j3 and holds 3 of the 4 job slots while running
+        assert "-j3" in args
+        assert "MAKEFLAGS" not in kwargs["env"]
+        assert available == 1
+        assert _available_tokens(jobserver) == 4
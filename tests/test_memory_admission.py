@@ -0,0 +1,66 @@
+import sys
+import threading
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.memoryadmission import MemoryAdmissionController, read_meminfo
+
+
+def test_read_meminfo():
+    meminfo = read_meminfo()
+    if meminfo is not None:
+        assert meminfo["MemTotal"] > 0
+
+
+class _ObservedController(MemoryAdmissionController):
+    """Signals when a phase has to wait so that the tests don't depend on thread timings"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = threading.Event()
+
+    def _can_admit(self, amount_mb: int) -> bool:
+        result = super()._can_admit(amount_mb)
+        if not result:
+            self.waiting.set()
+        return result
+
+
+def test_memory_admission():
+    available = [10000]
+    controller = _ObservedController(8000, available_memory=lambda: available[0])
+    controller.poll_interval = 0.01
+    events = []
+
+    def phase(name, amount):
+        with controller.reserve(amount, name):
+            events.append(("start", name))
+            events.append(("end", name))
+
+    # Two 5000 MiB phases exceed the budget and must not run concurrently
+    with controller.reserve(5000, "llvm"):
+        t = threading.Thread(target=phase, args=("cheribsd", 5000))
+        t.start()
+        assert controller.waiting.wait(10)
+        # but a small phase still fits
+        phase("small", 1000)
+        assert events == [("start", "small"), ("end", "small")]
+    t.join()
+    assert events[-2:] == [("start", "cheribsd"), ("end", "cheribsd")]
+    assert controller.reserved_mb == 0
+
+    # A phase that exceeds the budget can run if nothing else is running
+    with controller.reserve(20000, "huge"):
+        pass
+    # Wait until /proc/meminfo reports enough memory:
+    events.clear()
+    controller.waiting.clear()
+    available[0] = 500
+    with controller.reserve(100, "first"):
+        t = threading.Thread(target=phase, args=("second", 1000))
+        t.start()
+        assert controller.waiting.wait(10)
+        assert events == []
+        available[0] = 2000
+        t.join()
+    assert events == [("start", "second"), ("end", "second")]
@@ -0,0 +1,68 @@
+import io
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.outputfilter import LineAction, OutputFilter, StatusLineWriter
+
+_filter = OutputFilter(LineAction.SHOW, prefixes={b">>> ": LineAction.HEADING, b"===> ": LineAction.STATUS,
+                                                  b"===> skip": LineAction.HIDE},
+                       lines={b"\n": LineAction.HIDE}, suffixes={b" is up to date.\n": LineAction.HIDE})
+
+
+class _FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _writer(clock=None):
+    stream = io.BytesIO()
+    return stream, StatusLineWriter(stream, b"<CLEAR>", max_redraws_per_second=10, clock=clock or _FakeClock())
+
+
+def test_classify():
+    assert _filter.classify(b">>> World build started\n") is LineAction.HEADING
+    assert _filter.classify(b"===> lib/libc (all)\n") is LineAction.STATUS
+    # the longest prefix wins
+    assert _filter.classify(b"===> skipped\n") is LineAction.HIDE
+    assert _filter.classify(b"\n") is LineAction.HIDE
+    assert _filter.classify(b"`foo' is up to date.\n") is LineAction.HIDE
+    assert _filter.classify(b"warning: foo\n") is LineAction.SHOW
+    extended = _filter.extend(default=LineAction.STATUS, prefixes={b"warning:": LineAction.SHOW})
+    assert extended.classify(b"warning: foo\n") is LineAction.SHOW
+    assert extended.classify(b"cc -c foo.c\n") is LineAction.STATUS
+    assert _filter.classify(b"cc -c foo.c\n") is LineAction.SHOW
+
+
+def test_batched_output():
+    stream, writer = _writer()
+    writer.write_lines(_filter, [b">>> stage 1\n", b"===> lib/a\n", b"===> lib/b\n", b"\n", b"warning: x\n",
+                                 b"===> lib/c\n"])
+    # lib/a is skipped since it would have been overwritten immediately, lib/b is kept as context for the warning
+    assert stream.getvalue() == b">>> stage 1\n===> lib/b \nwarning: x\n===> lib/c "
+    assert writer.status_line_visible
+    writer.end_status_line()
+    assert stream.getvalue().endswith(b"===> lib/c \n")
+    assert not writer.status_line_visible
+
+
+def test_status_line_rate_limit():
+    clock = _FakeClock()
+    stream, writer = _writer(clock)
+    writer.write_lines(_filter, [b"===> lib/a\n"])
+    assert stream.getvalue() == b"===> lib/a "
+    clock.now = 0.05
+    writer.write_lines(_filter, [b"===> lib/b\n"])
+    assert stream.getvalue() == b"===> lib/a ", "status line should not be redrawn yet"
+    clock.now = 0.11
+    writer.write_lines(_filter, [b"===> lib/c\n"])
+    assert stream.getvalue() == b"===> lib/a <CLEAR>===> lib/c "
+    clock.now = 0.12
+    writer.write_lines(_filter, [b"===> lib/d\n", b">>> stage 2\n"])
+    assert stream.getvalue() == b"===> lib/a <CLEAR>===> lib/c <CLEAR>>>> stage 2\n"
+    writer.end_status_line()
+    assert stream.getvalue() == b"===> lib/a <CLEAR>===> lib/c <CLEAR>>>> stage 2\n"
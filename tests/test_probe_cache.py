@@ -0,0 +1,72 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.probecache import ProbeCache
+
+
+def test_probe_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        tool = Path(tmp, "fake-cc")
+        tool.write_text("#!/bin/sh\n")
+        cache_file = Path(tmp, "cache", "probes.json")
+        calls = []
+
+        def probe(value):
+            calls.append(value)
+            return value
+
+        cache = ProbeCache(cache_file)
+        assert cache.get("version", tool, lambda: probe([1, 2])) == [1, 2]
+        assert cache.get("version", tool, lambda: probe([3, 4])) == [1, 2]
+        # different arguments are a different probe
+        assert cache.get("version", tool, lambda: probe("x"), args=["-v"]) == "x"
+        assert len(calls) == 2
+        # a new cache instance (i.e. the next cheribuild invocation) reads the results from disk
+        assert ProbeCache(cache_file).get("version", tool, lambda: probe([5, 6])) == [1, 2]
+        assert len(calls) == 2
+        # changes to the binary invalidate the cached results
+        tool.write_text("#!/bin/sh\necho changed\n")
+        assert ProbeCache(cache_file).get("version", tool, lambda: probe([7, 8])) == [7, 8]
+        assert len(calls) == 3
+        # entries written by a concurrent invocation are preserved
+        other = ProbeCache(cache_file)
+        other.get("other", tool, lambda: probe(True))
+        cache.get("version", tool, lambda: probe([9]), args=["--version"])
+        assert ProbeCache(cache_file).get("other", tool, lambda: probe(False)) is True
+        # binaries that don't exist and disabled caches always run the probe
+        assert cache.get("version", Path(tmp, "missing"), lambda: probe(1)) == 1
+        assert cache.get("version", Path(tmp, "missing"), lambda: probe(2)) == 2
+        assert ProbeCache(None).get("version", tool, lambda: probe(3)) == 3
+
+
+def test_symlinks_share_entries():
+    with tempfile.TemporaryDirectory() as tmp:
+        tool = Path(tmp, "clang-7")
+        tool.write_text("#!/bin/sh\n")
+        os.symlink(str(tool), str(Path(tmp, "clang")))
+        cache = ProbeCache(Path(tmp, "probes.json"))
+        assert cache.get("compiler-info", tool, lambda: "first") == "first"
+        assert cache.get("compiler-info", Path(tmp, "clang"), lambda: "second") == "first"
+
+
+def test_dependencies_and_failed_probes():
+    with tempfile.TemporaryDirectory() as tmp:
+        cc = Path(tmp, "cc")
+        cc.write_text("#!/bin/sh\n")
+        lld = Path(tmp, "ld.lld")
+        lld.write_text("#!/bin/sh\n")
+        cache = ProbeCache(Path(tmp, "probes.json"))
+        assert cache.get("fuse-ld=lld", cc, lambda: False, dependencies=[lld]) is False
+        assert cache.get("fuse-ld=lld", cc, lambda: True, dependencies=[lld]) is False
+        # rebuilding the linker invalidates the result even though the compiler is unchanged
+        lld.write_text("#!/bin/sh\necho rebuilt\n")
+        assert ProbeCache(Path(tmp, "probes.json")).get("fuse-ld=lld", cc, lambda: True, dependencies=[lld]) is True
+        # failed probes are not stored
+        failed = {"compiler": "unknown compiler"}
+        assert cache.get("compiler-info", cc, lambda: failed, cacheable=lambda r: r != failed) == failed
+        assert cache.get("compiler-info", cc, lambda: "clang", cacheable=lambda r: r != failed) == "clang"
+        assert ProbeCache(Path(tmp, "probes.json")).get("compiler-info", cc, lambda: "gcc") == "clang"
@@ -0,0 +1,56 @@
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.processrunner import LineBufferedOutputHandler, get_process_runner
+
+
+class _CollectingHandler(LineBufferedOutputHandler):
+    def __init__(self):
+        super().__init__()
+        self.stdout = []
+        self.stderr = []
+        self.returncode = None
+
+    def stdout_line(self, line):
+        self.stdout.append(line)
+
+    def stderr_line(self, line):
+        self.stderr.append(line)
+
+    def finished(self, returncode):
+        super().finished(returncode)
+        self.returncode = returncode
+        if returncode == 42:
+            raise SystemExit("failed")
+
+
+def _start(script: str, handler):
+    proc = subprocess.Popen(["sh", "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return get_process_runner().start(proc, handler)
+
+
+def test_concurrent_processes():
+    threads_before = threading.active_count()
+    handlers = [_CollectingHandler() for _ in range(8)]
+    futures = [_start("for i in 1 2 3; do echo out$i; echo err$i >&2; done; printf partial", h) for h in handlers]
+    assert [f.result(timeout=10) for f in futures] == [0] * 8
+    # no additional threads per process
+    assert threading.active_count() <= threads_before + 1
+    for h in handlers:
+        assert h.stdout == [b"out1\n", b"out2\n", b"out3\n", b"partial"]
+        assert h.stderr == [b"err1\n", b"err2\n", b"err3\n"]
+
+
+def test_exit_code_and_errors():
+    handler = _CollectingHandler()
+    assert _start("echo x; exit 3", handler).result(timeout=10) == 3
+    assert handler.returncode == 3
+    future = _start("exit 42", _CollectingHandler())
+    assert isinstance(future.exception(timeout=10), SystemExit)
+    # stdout redirected to a file -> only the exit status is reported
+    proc = subprocess.Popen(["sh", "-c", "exit 1"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    assert get_process_runner().start(proc).result(timeout=10) == 1
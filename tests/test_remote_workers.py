@@ -0,0 +1,182 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild import utils
+from pycheribuild.config.loader import ConfigLoaderBase
+from pycheribuild.projects.project import SimpleProject
+from pycheribuild.remoteworkers import RemoteWorker, WorkerPool
+from pycheribuild.targets import Target
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+def test_worker_spec():
+    remote = RemoteWorker("builder1", "cheribuild-worker")
+    assert not remote.is_local
+    assert remote.path("source", "llvm") == "cheribuild-worker/source/llvm"
+    assert remote._rsync_location(remote.path("output")) == "builder1:cheribuild-worker/output"
+    remote = RemoteWorker("user@builder2:/scratch/cheribuild", "cheribuild-worker")
+    assert remote.host == "user@builder2"
+    assert remote.path("build") == "/scratch/cheribuild/build"
+    local = RemoteWorker("localhost", "cheribuild-worker")
+    assert local.is_local
+    assert local.path() == os.path.join(os.path.expanduser("~"), "cheribuild-worker")
+    assert local._rsync_location(local.path("output")) == local.path("output")
+
+
+class _FakePathOption(object):
+    _owningClass = None
+
+    def __init__(self, value: Path):
+        self.fullOptionName = "llvm/source-directory"
+        self.value = value
+
+    def _loadOptionImpl(self, config, name):
+        return str(self.value)
+
+    def __get__(self, instance, owner):
+        return self.value
+
+
+class _FakeProject(object):
+    def __init__(self, config):
+        self.sourceDir = config.sourceRoot / "llvm"
+        self.installDir = config.outputRoot / "sdk"
+        self.updated = False
+
+    def update_sources(self):
+        self.updated = True
+
+
+class _FakeProjectClass(object):
+    dependenciesMustBeBuilt = False
+    isAlias = False
+
+
+class _FakeTarget(Target):
+    def __init__(self, config):
+        super().__init__("llvm", _FakeProjectClass)
+        self.project = _FakeProject(config)
+
+    def get_or_create_project(self, caller, config):
+        return self.project
+
+    def get_dependencies(self, config):
+        return []
+
+
+def _restore_global_state(monkeypatch):
+    # setup_mock_chericonfig() changes global state -> restore it afterwards so that it doesn't affect other tests
+    monkeypatch.setattr(utils, "_cheriConfig", utils._cheriConfig)
+    monkeypatch.setattr(ConfigLoaderBase, "_cheriConfig", ConfigLoaderBase._cheriConfig)
+    monkeypatch.setattr(SimpleProject, "_configLoader", SimpleProject._configLoader)
+    monkeypatch.setattr(Target, "instantiating_targets_should_warn", Target.instantiating_targets_should_warn)
+
+
+def test_dispatch_to_localhost_worker(monkeypatch):
+    _restore_global_state(monkeypatch)
+    with tempfile.TemporaryDirectory() as tmp:
+        config = setup_mock_chericonfig(Path(tmp, "cheri"))
+        monkeypatch.setitem(config.loader.options, "llvm/source-directory",
+                            _FakePathOption(config.sourceRoot / "llvm"))
+        pool = WorkerPool(config, ["localhost:" + tmp + "/worker"])
+        worker = pool.workers[0]
+        assert worker.is_local and str(worker.root) == tmp + "/worker"
+        commands = []
+        pushed = dict()
+
+        def push(local: Path, remote: str, delete=False):
+            if local.suffix == ".json":
+                with local.open("r") as f:
+                    pushed[remote] = json.load(f)
+            else:
+                pushed[remote] = str(local)
+        monkeypatch.setattr(worker, "run", lambda *args, **kwargs: commands.append(args))
+        monkeypatch.setattr(worker, "push", push)
+        monkeypatch.setattr(worker, "pull", lambda remote, local: commands.append(("pull", remote, str(local))))
+        target = _FakeTarget(config)
+        pool.execute(target)
+        assert target.project.updated
+        # forwarded paths must be absolute paths inside the worker's directory and not relative to its cwd
+        worker_config = pushed[worker.path("cheribuild.json")]
+        assert worker_config["llvm/source-directory"] == worker.path("source", "llvm")
+        assert worker_config["skip-update"] is True
+        assert pushed[worker.path("source", "llvm")] == str(config.sourceRoot / "llvm")
+        build = [c for c in commands if c[0] == "python3"]
+        assert build == [("python3", worker.path("cheribuild.py"), "--config-file", worker.path("cheribuild.json"),
+                          "--source-root", worker.path("source"), "--build-root", worker.path("build"),
+                          "--output-root", worker.path("output"), "llvm")]
+        assert commands[-1] == ("pull", worker.path("output", "sdk"), str(config.outputRoot / "sdk"))
+
+
+def test_install_dir_outside_roots_is_built_locally(monkeypatch):
+    _restore_global_state(monkeypatch)
+    with tempfile.TemporaryDirectory() as tmp:
+        config = setup_mock_chericonfig(Path(tmp, "cheri"))
+        pool = WorkerPool(config, ["localhost:" + tmp + "/worker"])
+        target = _FakeTarget(config)
+        assert pool.can_run_remotely(target, target.project)
+        # The install directory would not be copied back from the worker -> the target must not be dispatched
+        target.project.installDir = Path(tmp, "elsewhere")
+        assert not pool.can_run_remotely(target, target.project)
+
+
+def _have_ssh_to_localhost():
+    if not shutil.which("ssh") or not shutil.which("rsync"):
+        return False
+    try:
+        return subprocess.call(["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=5", "127.0.0.1", "true"],
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               timeout=30) == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+# Checks that the source directory and the remapped config file arrived on the worker and installs a file
+_FAKE_BUILD_SCRIPT = """
+import json, os, sys
+with open(sys.argv[1]) as f:
+    config = json.load(f)
+assert config["llvm/source-directory"] == sys.argv[2], config
+assert os.path.isfile(os.path.join(sys.argv[2], "CMakeLists.txt"))
+os.makedirs(os.path.join(sys.argv[3], "bin"))
+with open(os.path.join(sys.argv[3], "bin", "clang"), "w") as f:
+    f.write("built remotely")
+"""
+
+
+@pytest.mark.skipif(not _have_ssh_to_localhost(), reason="passwordless ssh to localhost and rsync are required")
+def test_ssh_worker_round_trip(monkeypatch):
+    _restore_global_state(monkeypatch)
+    with tempfile.TemporaryDirectory() as tmp:
+        config = setup_mock_chericonfig(Path(tmp, "cheri"))
+        config.pretend = False  # actually run ssh and rsync
+        monkeypatch.setitem(config.loader.options, "llvm/source-directory",
+                            _FakePathOption(config.sourceRoot / "llvm"))
+        (config.sourceRoot / "llvm").mkdir(parents=True)
+        (config.sourceRoot / "llvm" / "CMakeLists.txt").write_text("project(llvm)")
+        # "localhost" would run the commands directly -> use the IP address to go through ssh and rsync
+        pool = WorkerPool(config, ["127.0.0.1:" + tmp + "/worker"])
+        worker = pool.workers[0]
+        assert not worker.is_local
+        run = worker.run
+
+        def fake_build(*args, **kwargs):
+            if args[0] != "python3":
+                return run(*args, **kwargs)
+            # don't build LLVM, just check that the worker received everything that cheribuild.py would need
+            assert args[1] == worker.path("cheribuild.py")
+            return run("python3", "-c", _FAKE_BUILD_SCRIPT, worker.path("cheribuild.json"),
+                       worker.path("source", "llvm"), worker.path("output", "sdk"), **kwargs)
+        monkeypatch.setattr(worker, "run", fake_build)
+        pool.execute(_FakeTarget(config))
+        assert Path(worker.path("pycheribuild", "remoteworkers.py")).is_file()
+        assert (config.outputRoot / "sdk" / "bin" / "clang").read_text() == "built remotely"
@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.processrunner import get_process_runner
+from pycheribuild import resourceusage
+from pycheribuild.resourceusage import ResourceUsagePopen, collect_resource_usage
+from pycheribuild.utils import runCmd
+
+_BUSY_LOOP = [sys.executable, "-c", "x = 0\nfor i in range(300000): x += i"]
+
+
+def test_run_cmd_records_usage():
+    with collect_resource_usage() as outer:
+        with collect_resource_usage() as inner:
+            runCmd(_BUSY_LOOP)
+        runCmd(_BUSY_LOOP)
+    assert inner.processes == 1
+    assert outer.processes == 2
+    assert outer.user + outer.sys > 0
+    assert outer.maxrss_kb > 0
+    assert outer.nvcsw + outer.nivcsw > 0
+    assert "CPUs busy" in outer.summary(1.0)
+
+
+def test_usage_is_recorded_for_the_starting_thread():
+    other_thread_usage = []
+
+    def run_other():
+        with collect_resource_usage() as usage:
+            runCmd(_BUSY_LOOP)
+        other_thread_usage.append(usage)
+
+    with collect_resource_usage() as usage:
+        thread = threading.Thread(target=run_other)
+        thread.start()
+        thread.join()
+        # processes reaped by the ProcessRunner thread are attributed to the thread that started them
+        proc = ResourceUsagePopen([sys.executable, "-c", "import sys; sys.exit(3)"], stdout=subprocess.PIPE)
+        assert get_process_runner().start(proc).result() == 3
+    assert usage.processes == 1
+    assert proc.resource_usage is not None and proc.resource_usage.processes == 1
+    assert other_thread_usage[0].processes == 1
+
+
+def test_signal_exit_code():
+    proc = ResourceUsagePopen([sys.executable, "-c", "import os, signal; os.kill(os.getpid(), signal.SIGTERM)"])
+    assert proc.wait() == -15
+    assert proc.resource_usage is not None
+
+
+def test_lost_exit_status_is_not_success():
+    proc = ResourceUsagePopen([sys.executable, "-c", "import sys; sys.exit(1)"])
+    os.waitpid(proc.pid, 0)  # reaped by someone else -> the exit status is lost
+    with pytest.raises(ChildProcessError):
+        proc.poll()
+    with pytest.raises(ChildProcessError):
+        proc.wait()
+    assert proc.returncode is None
+
+
+def test_poll_respects_waitpid_lock():
+    proc = ResourceUsagePopen([sys.executable, "-c", "import sys; sys.exit(2)"])
+    with proc._waitpid_lock:
+        # another thread is in wait() -> poll() must not reap the process (even once it has exited)
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        assert proc.poll() is None
+    assert proc.wait() == 2
+    assert proc.poll() == 2
+
+
+@pytest.mark.parametrize("use_wait4", [True, False])
+def test_popen_methods(monkeypatch, use_wait4):
+    # ResourceUsagePopen overrides Popen internals -> check that the public API still works on this python version
+    if not use_wait4:
+        monkeypatch.setattr(resourceusage, "_can_use_wait4", False)
+    exit_with = [sys.executable, "-c", "import sys; sys.stdout.write(sys.stdin.read()); sys.exit(5)"]
+    proc = ResourceUsagePopen(exit_with, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    assert proc.communicate(b"input") == (b"input", None)
+    assert proc.returncode == 5
+    assert proc.poll() == 5
+    proc = ResourceUsagePopen(exit_with, stdin=subprocess.PIPE)
+    proc.stdin.close()
+    assert proc.wait() == 5
+    proc = ResourceUsagePopen([sys.executable, "-c", "pass"])
+    os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)  # wait until it has exited (without reaping it)
+    assert proc.poll() == 0
+    assert (proc.resource_usage is not None) == use_wait4
@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild import utils
+from pycheribuild.config.loader import ConfigLoaderBase
+from pycheribuild.projects.project import SimpleProject
+from pycheribuild.systemdeps import SystemDependencyChecker
+from pycheribuild.targets import Target, TargetManager
+from pycheribuild.utils import setEnv
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+def test_probes_are_memoised():
+    with tempfile.TemporaryDirectory() as tmp:
+        tool = Path(tmp, "my-tool")
+        tool.write_text("#!/bin/sh\n")
+        tool.chmod(0o755)
+        checker = SystemDependencyChecker(max_workers=4)
+        with setEnv(PATH=tmp):
+            checker.prefetch([("program", "my-tool"), ("program", "missing-tool"), ("program", "my-tool")])
+            assert len(checker._results) == 2
+            assert checker.which("my-tool") == str(tool)
+            assert checker.which("missing-tool") is None
+            # memoised for the run even if the tool is removed
+            tool.unlink()
+            assert checker.which("my-tool") == str(tool)
+        # but a different $PATH is a different probe
+        with setEnv(PATH=os.defpath):
+            assert checker.which("my-tool") is None
+
+
+def test_pkg_config_probe():
+    with tempfile.TemporaryDirectory() as tmp:
+        # a fake pkg-config that only knows about "foo"
+        fake = Path(tmp, "pkg-config")
+        fake.write_text("#!/bin/sh\ntest \"$2\" = foo\n")
+        fake.chmod(0o755)
+        checker = SystemDependencyChecker()
+        with setEnv(PATH=tmp + ":" + os.environ["PATH"]):
+            checker.prefetch([("pkg-config", "foo"), ("pkg-config", "bar")])
+            assert checker.has_pkg_config_package("foo")
+            assert not checker.has_pkg_config_package("bar")
+
+
+def test_combined_report(capsys):
+    checker = SystemDependencyChecker()
+    with pytest.raises(SystemExit):
+        with checker.collect_missing():
+            assert checker.collecting_missing
+            checker.add_missing("qemu", "Required library glib-2.0 is missing!", "apt install libglib2.0-dev")
+            checker.add_missing("elftoolchain", "Required program bmake is missing!", "cheribuild.py bmake")
+            checker.add_missing("cheribsd", "Required program bmake is missing!", "cheribuild.py bmake")
+    assert not checker.collecting_missing
+    err = capsys.readouterr().err
+    assert "2 system dependencies are missing" in err
+    assert "bmake is missing! (required by elftoolchain, cheribsd)" in err
+    assert "glib-2.0 is missing! (required by qemu)" in err
+
+
+class _ToolUsingProject(SimpleProject):
+    doNotAddToTargets = True
+    target = "tool-using-project"
+    projectName = "tool-using-project"
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._addRequiredSystemTool("cheribuild-test-missing-tool", installInstructions="install it")
+        self.ran_tool = False
+        self.built = False
+
+    def checkSystemDependencies(self):
+        super().checkSystemDependencies()
+        if self.has_missing_system_dependencies:
+            return
+        self.ran_tool = True  # e.g. querying the version of the tool
+
+    def process(self):
+        self.built = True
+
+
+def test_missing_tool_stops_before_building(monkeypatch, capsys):
+    # setup_mock_chericonfig() changes global state -> restore it afterwards so that it doesn't affect other tests
+    monkeypatch.setattr(utils, "_cheriConfig", utils._cheriConfig)
+    monkeypatch.setattr(ConfigLoaderBase, "_cheriConfig", ConfigLoaderBase._cheriConfig)
+    monkeypatch.setattr(SimpleProject, "_configLoader", SimpleProject._configLoader)
+    monkeypatch.setattr(Target, "instantiating_targets_should_warn", Target.instantiating_targets_should_warn)
+    with tempfile.TemporaryDirectory() as tmp:
+        config = setup_mock_chericonfig(Path(tmp))
+        monkeypatch.setattr(config, "pretend", False)
+        _ToolUsingProject.setupConfigOptions()
+        target = Target("tool-using-project", _ToolUsingProject)
+        with pytest.raises(SystemExit):
+            TargetManager.check_system_dependencies([target], config)
+            target.execute(config)  # only reached if the missing tool didn't abort the build
+        project = target.get_or_create_project(None, config)
+        assert project.has_missing_system_dependencies
+        assert not project.ran_tool
+        assert not project.built
+        assert "cheribuild-test-missing-tool is missing! (required by tool-using-project)" in capsys.readouterr().err
@@ -0,0 +1,74 @@
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.targetmanifest import TargetManifest, complete_command_line, project_module_fingerprint
+
+
+def _manifest(fingerprint=None):
+    targets = {"llvm": "pycheribuild.projects.llvm", "cheribsd": "pycheribuild.projects.cross.cheribsd",
+               "cheribsd-purecap": "pycheribuild.projects.cross.cheribsd", "qemu": "pycheribuild.projects.build_qemu"}
+    options = {"llvm/build-type": "pycheribuild.projects.llvm",
+               "cheribsd/build-tests": "pycheribuild.projects.cross.cheribsd",
+               "qemu/unaligned": "pycheribuild.projects.build_qemu"}
+    completion_options = {"--pretend": None, "-p": None, "--cheri-bits": ["128", "256"], "--llvm/build-type": [],
+                          "--cheribsd/build-tests": None, "--cheribsd/no-build-tests": None}
+    return TargetManifest(targets, options, fingerprint or [], completion_options)
+
+
+def test_modules_for_arguments():
+    manifest = _manifest()
+    assert manifest.modules_for_arguments(["--list-targets"]) == set()
+    assert manifest.modules_for_arguments(["-p", "llvm"]) == {"pycheribuild.projects.llvm"}
+    assert manifest.modules_for_arguments(["--get-config-option", "qemu/unaligned"]) == \
+        {"pycheribuild.projects.build_qemu"}
+    # options (including negated ones and --option=value) import the module that defines them
+    assert manifest.modules_for_arguments(["--cheribsd/no-build-tests", "--llvm/build-type=Debug"]) == \
+        {"pycheribuild.projects.cross.cheribsd", "pycheribuild.projects.llvm"}
+    assert manifest.modules_for_arguments(["cheribsd-purecap", "--skip-update"]) == \
+        {"pycheribuild.projects.cross.cheribsd"}
+    # printing the help or the full configuration needs all targets
+    assert manifest.modules_for_arguments(["llvm", "--help"]) is None
+    assert manifest.modules_for_arguments(["--dump-configuration"]) is None
+    assert manifest.modules_for_arguments(["--what-rebuilds=llvm"]) is None
+
+
+def test_manifest_is_invalidated_by_changes():
+    with tempfile.TemporaryDirectory() as tmp:
+        package = Path(tmp, "pkg")
+        (package / "projects" / "cross").mkdir(parents=True)
+        project = package / "projects" / "llvm.py"
+        project.write_text("# llvm\n")
+        (package / "projects" / "cross" / "cheribsd.py").write_text("# cheribsd\n")
+        fingerprint = project_module_fingerprint(package)
+        assert [f[0] for f in fingerprint] == ["projects/llvm.py", "projects/cross/cheribsd.py"]
+
+        path = Path(tmp, "cache", "manifest.json")
+        assert TargetManifest.load(path, fingerprint) is None
+        _manifest(fingerprint).save(path)
+        loaded = TargetManifest.load(path, fingerprint)
+        assert loaded.targets == _manifest().targets
+        assert loaded.options == _manifest().options
+
+        project.write_text("# llvm changed\n")
+        assert TargetManifest.load(path, project_module_fingerprint(package)) is None
+
+
+def test_completion_from_manifest():
+    manifest = _manifest()
+
+    def complete(line, **kwargs):
+        return complete_command_line(manifest, line, len(line), **kwargs)
+    assert complete("cheribuild.py cheri") == ["cheribsd", "cheribsd-purecap"]
+    assert complete("cheribuild.py -p ll") == ["llvm "]
+    assert complete("cheribuild.py ll", append_space=False) == ["llvm"]
+    assert complete("cheribuild.py --cheribsd/") == ["--cheribsd/build-tests", "--cheribsd/no-build-tests"]
+    assert complete("cheribuild.py --cheri-bits ") == ["128", "256"]
+    # bash splits words at '=' so only the value is returned
+    assert complete("cheribuild.py --cheri-bits=2") == ["256 "]
+    assert complete("cheribuild.py --cheri-bits=2", wordbreaks=" ") == ["--cheri-bits=256 "]
+    # options that take an arbitrary value fall back to the default shell completion
+    assert complete("cheribuild.py --llvm/build-type ") == []
+    assert complete("cheribuild.py llvm --pretend ") == ["cheribsd", "cheribsd-purecap", "llvm", "qemu"]
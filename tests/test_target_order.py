@@ -1,4 +1,5 @@
 import sys
+import threading
 
 try:
     import typing
@@ -14,7 +15,8 @@ sys.path.append(str(Path(__file__).parent.parent))
 # We can"t do from pycheribuild.configloader import ConfigLoader here because that will only update the local copy
 from pycheribuild.config.loader import DefaultValueOnlyConfigLoader, ConfigLoaderBase
 from pycheribuild.projects.project import SimpleProject
-from pycheribuild.targets import targetManager
+from pycheribuild.targets import targetManager, SourceUpdateStage, Target, TargetScheduler
+from pycheribuild.dashboard import show_dashboard
 # noinspection PyUnresolvedReferences
 from pycheribuild.projects import *  # make sure all projects are loaded so that targetManager gets populated
 from pycheribuild.projects.cross import *  # make sure all projects are loaded so that targetManager gets populated
@@ -97,6 +99,17 @@ def test_run_disk_image():
                           "llvm", "disk-image", "disk-image-freebsd-x86", "run", "run-freebsd-mips"]
 
 
+def test_topological_sort_keeps_input_order():
+    targetManager.reset()
+    config = get_global_config()
+    config.includeDependencies = False
+    config.skipSdk = False
+    targets = [targetManager.get_target(t, None, config) for t in ("cheribsd-sysroot", "qemu", "cheribsd", "llvm")]
+    # targets are only moved if one of their dependencies comes later in the input
+    assert [t.name for t in targetManager.topologicalSort(targets, config)] == [
+        "qemu", "llvm", "cheribsd-cheri", "cheribsd-sysroot"]
+
+
 def test_remove_duplicates():
     assert _sort_targets(["binutils", "elftoolchain"], add_dependencies=True) == ["elftoolchain", "binutils"]
 
@@ -123,3 +136,146 @@ def test_libcxx_deps(suffix, expected_suffix):
     # Now check that the cross-compile versions explicitly chose the matching target:
     assert expected == _sort_targets(["libcxx" + suffix], add_dependencies=True, skip_sdk=True)
 
+
+
+class _FakeTarget(Target):
+    def __init__(self, name, deps, log: list, while_running: "typing.Callable[[], typing.Any]"=None):
+        super().__init__(name, None)
+        self.deps = deps
+        self.log = log
+        # called between start and end (e.g. to wait for another target) so that the tests don't depend on timings
+        self.while_running = while_running
+
+    def get_dependencies(self, config):
+        return self.deps
+
+    def execute(self, config):
+        self.log.append(("start", self.name))
+        if self.while_running is not None:
+            self.while_running()
+        if self.name == "broken":
+            raise SystemExit("broken target failed")
+        self.log.append(("end", self.name))
+
+
+def test_parallel_scheduler_respects_dependencies():
+    log = []
+    # a and b are independent and must be running at the same time (otherwise the barrier times out)
+    both_running = threading.Barrier(2, timeout=10)
+    a = _FakeTarget("a", [], log, both_running.wait)
+    b = _FakeTarget("b", [], log, both_running.wait)
+    c = _FakeTarget("c", [a, b], log)
+    d = _FakeTarget("d", [c, a, b], log)
+    TargetScheduler([a, b, c, d], get_global_config(), 4).run()
+    assert log.index(("start", "b")) < log.index(("end", "a"))
+    assert log.index(("end", "a")) < log.index(("start", "c"))
+    assert log.index(("end", "b")) < log.index(("start", "c"))
+    assert log.index(("end", "c")) < log.index(("start", "d"))
+
+
+def test_parallel_scheduler_stops_after_failure():
+    log = []
+    broken_failed = threading.Event()
+    broken = _FakeTarget("broken", [], log, broken_failed.set)
+    # a is still running when broken fails -> the scheduler has to wait for it
+    a = _FakeTarget("a", [], log, lambda: broken_failed.wait(10))
+    after = _FakeTarget("after", [broken], log)
+    with pytest.raises(SystemExit):
+        TargetScheduler([broken, a, after], get_global_config(), 2).run()
+    assert ("end", "a") in log
+    assert ("start", "after") not in log
+
+
+class _FakeTimings(object):
+    def __init__(self, durations):
+        self.durations = durations
+
+    def estimate(self, name):
+        return self.durations.get(name)
+
+
+def test_parallel_scheduler_starts_critical_path_first():
+    log = []
+    leaf1 = _FakeTarget("leaf1", [], log)
+    leaf2 = _FakeTarget("leaf2", [], log)
+    llvm = _FakeTarget("llvm", [], log)
+    cheribsd = _FakeTarget("cheribsd", [llvm], log)
+    timings = _FakeTimings({"leaf1": 10, "leaf2": 10, "llvm": 100, "cheribsd": 200})
+    scheduler = TargetScheduler([leaf1, leaf2, llvm, cheribsd], get_global_config(), 1, timings)
+    assert scheduler.priority[llvm] == 300
+    scheduler.run()
+    assert [x[1] for x in log if x[0] == "start"] == ["llvm", "cheribsd", "leaf1", "leaf2"]
+    # with two jobs the leaves should be built while cheribsd is building
+    simulated = TargetScheduler([leaf1, leaf2, llvm, cheribsd], get_global_config(), 2, timings).simulate()
+    assert [(t.name, start, end) for t, start, end in simulated] == [
+        ("llvm", 0, 100), ("leaf1", 0, 10), ("leaf2", 10, 20), ("cheribsd", 100, 300)]
+
+
+def test_parallel_scheduler_with_dashboard():
+    log = []
+    llvm = _FakeTarget("llvm", [], log)
+    cheribsd = _FakeTarget("cheribsd", [llvm], log)
+    qemu = _FakeTarget("qemu", [], log)
+    timings = _FakeTimings({"llvm": 100, "cheribsd": 200})
+    with show_dashboard() as dashboard:
+        started = []
+        target_started = dashboard.target_started
+        dashboard.target_started = lambda name, estimate: (started.append((name, estimate)),
+                                                           target_started(name, estimate))
+        TargetScheduler([llvm, cheribsd, qemu], get_global_config(), 2, timings).run()
+    assert sorted(started) == [("cheribsd", 200), ("llvm", 100), ("qemu", None)]
+    assert ("end", "cheribsd") in log and ("end", "qemu") in log
+
+
+class _FakeUpdateProject(object):
+    def __init__(self, config):
+        self.config = config
+        self.update_env = None
+
+    def update_sources(self, in_background=False):
+        assert in_background
+        self.update_env = (getenv("PATH"), threading.current_thread())
+
+
+class _FakeUpdateTarget(_FakeTarget):
+    def __init__(self, name, config):
+        super().__init__(name, [], [])
+        self.project = _FakeUpdateProject(config)
+
+    def get_or_create_project(self, caller, config):
+        return self.project
+
+
+def test_source_update_stage_uses_build_environment():
+    config = get_global_config()
+    targets = [_FakeUpdateTarget("a", config), _FakeUpdateTarget("b", config)]
+    with SourceUpdateStage(targets, config, 2):
+        pass
+    for t in targets:
+        path, thread = t.project.update_env
+        assert thread is not threading.current_thread()
+        assert path == Target.build_environment(config)["PATH"]
+    assert getenv("PATH") != config.dollarPathWithOtherTools
+
+
+def test_what_rebuilds():
+    targetManager.reset()
+    config = get_global_config()
+    config.skipSdk = False
+    affected = [t.name for t in targetManager.what_rebuilds("libcxxrt", config)]
+    assert sorted(affected) == ["libcxx-cheri", "libcxx-mips", "libcxx-native",
+                                "libcxxrt-cheri", "libcxxrt-mips", "libcxxrt-native"]
+    # dependencies must come first
+    assert affected.index("libcxxrt-cheri") < affected.index("libcxx-cheri")
+    affected = [t.name for t in targetManager.what_rebuilds("qemu", config)]
+    assert affected[0] == "qemu"
+    assert "run" in affected and "llvm" not in affected and "cheribsd-cheri" not in affected
+
+
+def test_directory_queries_restore_instantiation_warning(monkeypatch):
+    config = get_global_config()
+    monkeypatch.setattr(Target, "instantiating_targets_should_warn", True)
+    # Note: the directories are only known if the options have been registered (e.g. by test_argument_parsing.py)
+    targetManager.build_directories("qtbase", config)
+    targetManager.what_rebuilds(str(config.sourceRoot / "qemu"), config)
+    assert Target.instantiating_targets_should_warn
@@ -0,0 +1,50 @@
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.telemetry import TelemetryLog, build_report
+
+
+def _record(run, target, wall, status="success"):
+    return {"run": run, "target": target, "status": status, "wall": wall, "phases": {}, "user": wall / 2, "sys": 0,
+            "maxrss_kb": 2048, "log_bytes": 0}
+
+
+def test_telemetry_log_last_runs():
+    with tempfile.TemporaryDirectory() as td:
+        log = TelemetryLog(Path(td, "telemetry.jsonl"))
+        assert log.records() == []
+        for run in ("r1", "r2", "r3"):
+            log.append(_record(run, "llvm", 100))
+            log.append(_record(run, "qemu", 10))
+        assert len(log.records()) == 6
+        assert [r["run"] for r in log.last_runs(2)] == ["r2", "r2", "r3", "r3"]
+
+
+def test_build_report():
+    records = [_record("r1", "llvm", 1000), _record("r1", "qemu", 100),
+               _record("r2", "llvm", 1100), _record("r2", "qemu", 0, status="skipped"),
+               _record("r3", "llvm", 2000), _record("r3", "qemu", 0, status="failed")]
+    report = "\n".join(build_report(records))
+    assert "last 3 runs (6 target executions)" in report
+    # llvm is the slowest target and the last build regressed
+    slowest = report.split("Slowest targets")[1].splitlines()
+    assert slowest[1].split()[0] == "llvm"
+    assert slowest[2].split()[0] == "qemu"
+    regressions = report.split("Regressions")[1].split("Up-to-date")[0]
+    assert "llvm" in regressions and "qemu" not in regressions
+    assert "cache hit rate: 1/6" in report
+
+
+def test_telemetry_log_is_trimmed():
+    with tempfile.TemporaryDirectory() as td:
+        log = TelemetryLog(Path(td, "telemetry.jsonl"), max_bytes=4096)
+        for i in range(100):
+            log.append(_record("r" + str(i), "llvm", 100))
+        assert log.path.stat().st_size <= 4096
+        records = log.records()
+        # only the newest records are kept and no line has been cut in half
+        assert 0 < len(records) < 100
+        assert [r["run"] for r in records] == ["r" + str(i) for i in range(100 - len(records), 100)]
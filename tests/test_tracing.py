@@ -0,0 +1,73 @@
+import concurrent.futures
+import json
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from pycheribuild.tracing import TraceRecorder
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.time = 100.0
+
+    def __call__(self):
+        return self.time
+
+
+def test_trace_events():
+    clock = FakeClock()
+    tracer = TraceRecorder(clock=clock, start=100.0)
+    with tracer.span("cheribsd", "target", target="cheribsd"):
+        clock.time += 1
+        with tracer.span("make", "command", argv=["make", "-j4"]):
+            clock.time += 2.5
+    tracer.complete("load configuration", "config", 99.5, 100.0)
+
+    def other_thread():
+        tracer.complete("delete /tmp/foo", "filesystem", 101.0, 102.0)
+    thread = threading.Thread(target=other_thread, name="Deleting /tmp/foo")
+    thread.start()
+    thread.join()
+
+    events = tracer.events()
+    metadata = [e for e in events if e["ph"] == "M"]
+    spans = [e for e in events if e["ph"] == "X"]
+    assert [e["name"] for e in spans] == ["load configuration", "cheribsd", "make", "delete /tmp/foo"]
+    config, target, make, delete = spans
+    assert (config["ts"], config["dur"]) == (-500000, 500000)
+    assert (target["ts"], target["dur"]) == (0, 3500000)
+    assert (make["ts"], make["dur"]) == (1000000, 2500000)
+    assert make["args"] == {"argv": ["make", "-j4"]}
+    assert target["tid"] == make["tid"] == config["tid"] != delete["tid"]
+    thread_names = {e["tid"]: e["args"]["name"] for e in metadata if e["name"] == "thread_name"}
+    assert thread_names[delete["tid"]] == "Deleting /tmp/foo"
+
+
+def test_trace_file_and_futures():
+    clock = FakeClock()
+    tracer = TraceRecorder(clock=clock, start=100.0)
+    future = concurrent.futures.Future()
+    start, thread = tracer.now(), threading.current_thread()
+    future.add_done_callback(lambda f: tracer.complete("ninja", "command", start, thread=thread))
+    clock.time += 4
+
+    # the span is added to the track of the thread that started the command
+    def complete_future():
+        future.set_result(0)
+    completer = threading.Thread(target=complete_future)
+    completer.start()
+    completer.join()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp, "traces", "run.json")
+        tracer.write(path)
+        with path.open("r", encoding="utf-8") as f:
+            data = json.load(f)
+    spans = [e for e in data["traceEvents"] if e["ph"] == "X"]
+    assert len(spans) == 1
+    assert spans[0]["dur"] == 4000000
+    thread_names = [e["args"]["name"] for e in data["traceEvents"] if e["name"] == "thread_name"]
+    assert thread_names == [threading.current_thread().name]